@@ -0,0 +1,79 @@
+from argparse import ArgumentParser
+from logging import WARNING, basicConfig
+from os import makedirs, path
+
+from ujson import dump, load
+
+from . import ingest, rest
+from .report import compare, metadata
+
+RESULTS_DIR = path.join(path.dirname(__file__), 'results')
+
+
+def run(args):
+    result = metadata(args)
+    result['results'] = {}
+    if args.suite in ('all', 'rest'):
+        result['results'].update(rest.run(
+            backend=args.backend, broker=args.broker, users=args.users, send_updates=not args.disable_updates,
+            cache_size=args.cache_size
+        ))
+    if args.suite in ('all', 'ingest'):
+        result['results'].update(ingest.run(
+            modes=args.modes, backend=args.backend, users=args.users, count=args.messages
+        ))
+
+    output = args.output or path.join(RESULTS_DIR, f'{result["timestamp"].replace(":", "")}-{result["commit"]}.json')
+    makedirs(path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as file:
+        dump(result, file, indent=2)
+
+    print(f'{"operation":<24} {"count":>8} {"per sec":>10} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9}')
+    for name, values in result['results'].items():
+        count, rate, p50, p95, p99 = values.values()
+        print(f'{name:<24} {count:>8} {rate:>10} {p50:>9} {p95:>9} {p99:>9}')
+    print(f'Results saved to {output}')
+
+
+def compare_results(args):
+    with open(args.base) as base, open(args.head) as head:
+        base, head = load(base), load(head)
+    if base['params'] != head['params']:
+        print(f'Warning: runs used different parameters ({base["params"]} vs {head["params"]})')
+    rows = list(compare(base, head, args.threshold))
+
+    print(f'{"operation":<24} {"base/s":>10} {"head/s":>10} {"change":>8} {"base p95":>9} {"head p95":>9} {"change":>8}')
+    for name, base_rate, head_rate, rate_change, base_p95, head_p95, p95_change, regression in rows:
+        print(f'{name:<24} {base_rate:>10} {head_rate:>10} {rate_change:>+7.1f}% {base_p95:>9} {head_p95:>9} '
+              f'{p95_change:>+7.1f}%{"  REGRESSION" if regression else ""}')
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    basicConfig(level=WARNING)
+    parser = ArgumentParser(prog='python -m benchmarks', description='Throughput and latency of the REST and MQTT paths')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmarks and save the results as JSON')
+    run_parser.add_argument('--suite', choices=('all', 'rest', 'ingest'), default='all')
+    run_parser.add_argument('--backend', choices=('memory', 'postgres'), default='memory',
+                            help='in-memory fakes, or the Postgres configured by POSTGRES_* variables')
+    run_parser.add_argument('--broker', choices=('memory', 'mqtt'), default='memory',
+                            help='in-memory fake, or the broker configured by BROKER_* variables')
+    run_parser.add_argument('--users', type=int, default=1000)
+    run_parser.add_argument('--messages', type=int, default=10000)
+    run_parser.add_argument('--modes', nargs='+', choices=ingest.MODES, default=list(ingest.MODES))
+    run_parser.add_argument('--cache-size', type=int, default=0)
+    run_parser.add_argument('--disable-updates', action='store_true')
+    run_parser.add_argument('--output', help=f'JSON file to write, by default a new file in {RESULTS_DIR}')
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser('compare', help='compare two saved results')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('head')
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help='percent change in throughput or p95 reported as a regression')
+    compare_parser.set_defaults(handler=compare_results)
+
+    args = parser.parse_args()
+    exit(args.handler(args) or 0)
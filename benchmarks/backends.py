@@ -0,0 +1,30 @@
+from itertools import count
+
+from paho.mqtt.client import MQTT_ERR_SUCCESS, MQTTMessageInfo
+
+
+class MemoryBroker:
+    # Stand-in for server.src.publisher.Publisher that acknowledges every message at once
+
+    def __init__(self):
+        self.published = 0
+        self._mids = count(1)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+    def send(self, topic, payload) -> MQTTMessageInfo:
+        info = MQTTMessageInfo(next(self._mids))
+        info.rc = MQTT_ERR_SUCCESS
+        info._set_as_published()
+        self.published += 1
+        return info
+
+    def stats(self):
+        return {'connected': True, 'published': self.published}
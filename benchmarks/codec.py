@@ -0,0 +1,35 @@
+from argparse import ArgumentParser
+from time import perf_counter
+from uuid import uuid4
+
+from ujson import dumps
+
+from server.src.codec import decode_event, encode_binary, encode_json
+
+ENCODERS = {'json': encode_json, 'binary': encode_binary}
+
+
+def run(events: int):
+    users = [('update', uuid4().hex, index - events // 2) for index in range(events)]
+    results = {}
+    for name, encode in ENCODERS.items():
+        start = perf_counter()
+        payloads = [encode(*user) for user in users]
+        encoded = perf_counter() - start
+        start = perf_counter()
+        for payload in payloads:
+            decode_event(payload)
+        decoded = perf_counter() - start
+        results[name] = {
+            'payload_bytes': round(sum(map(len, payloads)) / events, 1),
+            'encode_per_sec': round(events / encoded),
+            'decode_per_sec': round(events / decoded),
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Compare the JSON and binary event formats')
+    parser.add_argument('--events', type=int, default=200000)
+    args = parser.parse_args()
+    print(dumps(run(args.events), indent=2))
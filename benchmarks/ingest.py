@@ -0,0 +1,85 @@
+from typing import Dict
+from uuid import uuid4
+
+from paho.mqtt.client import MQTTMessage
+from ujson import dumps
+
+from subscriber.src.buffer import WriteBuffer
+from subscriber.src.database import Database, Fetch
+from subscriber.src.memory import MemoryDatabase
+from subscriber.src.subscriber import Subscriber
+from subscriber.src.workers import WorkerPool
+from .report import Recorder
+
+MODES = ('direct', 'workers', 'buffer', 'envelope')
+# Updates per message in envelope mode
+ENVELOPE_SIZE = 100
+
+
+def init_database(backend, uuids):
+    if 'memory' == backend:
+        db = MemoryDatabase()
+        for uuid in uuids:
+            db.insert_user(uuid, delta=0)
+        return db
+    db = Database()
+    db._execute_query(
+        "INSERT INTO users(uuid, delta, area) SELECT unnest(%(uuids)s), 0, ''",
+        {'uuids': uuids}, fetch=Fetch.NONE
+    )
+    return db
+
+
+def cleanup_database(db, uuids):
+    if isinstance(db, Database):
+        db._execute_query('DELETE FROM users WHERE uuid = ANY(%(uuids)s)', {'uuids': uuids}, fetch=Fetch.NONE)
+    db.close()
+
+
+def messages(uuids, count):
+    for index in range(count):
+        message = MQTTMessage(topic=b'bench')
+        message.payload = dumps({
+            'action': 'update', 'user': {'uuid': uuids[index % len(uuids)], 'delta': index}
+        }).encode()
+        yield message
+
+
+def envelopes(uuids, count):
+    for start in range(0, count, ENVELOPE_SIZE):
+        message = MQTTMessage(topic=b'bench')
+        message.payload = dumps({'events': [
+            {'action': 'update', 'user': {'uuid': uuids[index % len(uuids)], 'delta': index}}
+            for index in range(start, min(start + ENVELOPE_SIZE, count))
+        ]}).encode()
+        yield message
+
+
+def run_mode(mode, backend='memory', users=1000, count=10000) -> Dict[str, float]:
+    uuids = [f'{uuid4().hex[:8]}{index:024x}' for index in range(users)]
+    db = init_database(backend, uuids)
+    buffer = WriteBuffer(db) if 'buffer' == mode else None
+    workers = WorkerPool() if 'workers' == mode else None
+    for thread in (buffer, workers):
+        if thread:
+            thread.start()
+    subscriber = Subscriber(db=db, buffer=buffer, workers=workers)
+
+    recorder = Recorder(count)
+    payloads = list(envelopes(uuids, count) if 'envelope' == mode else messages(uuids, count))
+    with recorder.total():
+        for message in payloads:
+            with recorder.measure():
+                subscriber.sub_on_message(subscriber, None, message)
+        # Throughput only counts messages that reached the database
+        if workers:
+            workers.close()
+        if buffer:
+            buffer.close()
+
+    cleanup_database(db, uuids)
+    return recorder.result(unit='messages', count=count)
+
+
+def run(modes=MODES, **kwargs) -> Dict[str, dict]:
+    return {f'mqtt {mode}': run_mode(mode, **kwargs) for mode in modes}
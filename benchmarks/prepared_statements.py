@@ -0,0 +1,57 @@
+from argparse import ArgumentParser
+from os import sysconf
+from time import perf_counter
+
+from ujson import dumps
+
+from server.src.database import Database
+from server.src.pool import ConnectionPool
+
+CLOCK_TICKS = sysconf('SC_CLK_TCK')
+
+
+def backend_cpu(db: Database, pid) -> float:
+    # CPU seconds spent by the Postgres backend, readable when the server runs on this host
+    try:
+        with open(f'/proc/{pid}/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except OSError:
+        return float('nan')
+
+
+def run(prepare: bool, queries: int):
+    # A single connection, so that every query runs on the backend being measured
+    db = Database(pool=ConnectionPool(min_size=1, max_size=1))
+    db.prepare = prepare
+    db.insert_user('benchmark', delta=0, area='bench')
+    pid = db._execute_query('SELECT pg_backend_pid() AS pid')['pid']
+    workloads = {
+        'find_user': lambda index: db.find_user('benchmark'),
+        'update_user': lambda index: db.update_user('benchmark', delta=index, area='bench' if index % 2 else None),
+    }
+    results = {}
+    for name, workload in workloads.items():
+        workload(0)
+        cpu, start = backend_cpu(db, pid), perf_counter()
+        for index in range(queries):
+            workload(index)
+        elapsed, cpu = perf_counter() - start, backend_cpu(db, pid) - cpu
+        results[name] = {
+            'queries_per_sec': round(queries / elapsed),
+            'client_us_per_query': round(elapsed / queries * 1e6, 1),
+            'backend_cpu_us_per_query': round(cpu / queries * 1e6, 1),
+        }
+    db.delete_user('benchmark')
+    db.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Compare plain and prepared statements against a local Postgres')
+    parser.add_argument('--queries', type=int, default=5000)
+    args = parser.parse_args()
+    print(dumps({
+        'plain': run(prepare=False, queries=args.queries),
+        'prepared': run(prepare=True, queries=args.queries),
+    }, indent=2))
@@ -0,0 +1,70 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from subprocess import DEVNULL, CalledProcessError, check_output
+from time import perf_counter
+from typing import Dict
+
+from server.src.metrics import Histogram
+
+
+class Recorder:
+    # Latency samples and throughput of one benchmarked operation (an endpoint or an ingest mode)
+
+    def __init__(self, samples: int):
+        self.latency = Histogram(window=samples)
+        self.elapsed = 0.0
+
+    @contextmanager
+    def measure(self):
+        start = perf_counter()
+        yield
+        self.latency.observe(perf_counter() - start)
+
+    @contextmanager
+    def total(self):
+        start = perf_counter()
+        yield
+        self.elapsed += perf_counter() - start
+
+    def result(self, unit='requests', count=None) -> Dict[str, float]:
+        # `count` overrides the number of measured calls when each call handles several units
+        count = count if count is not None else self.latency.count
+        return {
+            unit: count,
+            f'{unit}_per_sec': round(count / self.elapsed, 1) if self.elapsed else 0.0,
+            'p50_ms': round(self.latency.percentile(50) * 1000, 3),
+            'p95_ms': round(self.latency.percentile(95) * 1000, 3),
+            'p99_ms': round(self.latency.percentile(99) * 1000, 3),
+        }
+
+
+def commit() -> str:
+    try:
+        return check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=DEVNULL, text=True).strip()
+    except (OSError, CalledProcessError):
+        return 'unknown'
+
+
+def metadata(args) -> dict:
+    return {
+        'commit': commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'params': {key: value for key, value in vars(args).items() if key not in ('command', 'handler')},
+    }
+
+
+def throughput(result: Dict[str, float]) -> float:
+    return next(value for key, value in result.items() if key.endswith('_per_sec'))
+
+
+def compare(base: dict, head: dict, threshold: float):
+    # Yields one row per operation present in both runs, flagging changes worse than `threshold` percent
+    for name, head_result in head['results'].items():
+        if not (base_result := base['results'].get(name)):
+            continue
+        rate_change = (throughput(head_result) / throughput(base_result) - 1) * 100 \
+            if throughput(base_result) else 0.0
+        p95_change = (head_result['p95_ms'] / base_result['p95_ms'] - 1) * 100 if base_result['p95_ms'] else 0.0
+        regression = rate_change < -threshold or p95_change > threshold
+        yield name, throughput(base_result), throughput(head_result), rate_change, base_result['p95_ms'], \
+            head_result['p95_ms'], p95_change, regression
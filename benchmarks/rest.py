@@ -0,0 +1,77 @@
+from typing import Dict
+from uuid import uuid4
+
+from server.app import app
+from server.src import server as server_module
+from server.src.cache import UserCache
+from server.src.database import Database
+from server.src.dispatcher import Dispatcher
+from server.src.memory import MemoryDatabase
+from server.src.publisher import Publisher
+from server.src.server import UserServer
+from .backends import MemoryBroker
+from .report import Recorder
+
+BULK_SIZE = 100
+
+
+def init_server(backend, broker, send_updates, cache_size) -> UserServer:
+    if 'memory' == backend:
+        db = MemoryDatabase(outbox=send_updates, snapshot_path='')
+    else:
+        db = Database(outbox=send_updates)
+    dispatcher = None
+    if send_updates:
+        dispatcher = Dispatcher(db, publisher=MemoryBroker() if 'memory' == broker else Publisher())
+        dispatcher.start()
+    cache = UserCache(max_size=cache_size) if cache_size > 0 else None
+    return UserServer(db=db, send_updates=send_updates, dispatcher=dispatcher, cache=cache)
+
+
+def run(backend='memory', broker='memory', users=1000, send_updates=True, cache_size=0) -> Dict[str, dict]:
+    server_module.server = server = init_server(backend, broker, send_updates, cache_size)
+    client = app.test_client()
+    # Unique per run, so a shared database is left as it was found
+    prefix = uuid4().hex[:8]
+    uuids = [f'{prefix}{index:024x}' for index in range(users)]
+    area = f'bench-{prefix}'
+    recorders = {}
+
+    def drive(name, requests, expected):
+        recorder = recorders[name] = Recorder(len(requests))
+        with recorder.total():
+            for method, url, body in requests:
+                with recorder.measure():
+                    response = client.open(url, method=method, json=body)
+                    # Streamed bodies are only produced while they are read
+                    response.get_data()
+                if response.status_code not in expected:
+                    raise RuntimeError(f'{method} {url} returned {response.status_code}')
+
+    drive('POST /users/<uuid>', [('POST', f'/users/{uuid}', {'delta': 0, 'area': area}) for uuid in uuids], {201})
+    drive('GET /users/<uuid>', [('GET', f'/users/{uuid}', None) for uuid in uuids], {200})
+    drive('PATCH /users/<uuid>', [
+        ('PATCH', f'/users/{uuid}', {'delta': index} if index % 2 else {'delta': index, 'area': area})
+        for index, uuid in enumerate(uuids)
+    ], {200})
+    drive('GET /users?area=', [('GET', f'/users?area={area}', None)] * max(1, users // 100), {200})
+    drive('GET /users?limit=', [
+        ('GET', f'/users?area={area}&limit=100&after={uuids[start - 1]}' if start else f'/users?area={area}&limit=100',
+         None)
+        for start in range(0, users, 100)
+    ], {200})
+    drive('GET /users?stream=', [('GET', f'/users?area={area}&stream=true', None)] * max(1, users // 100), {200})
+    drive('POST /users/_bulk', [
+        ('POST', '/users/_bulk', [
+            {'action': 'update', 'uuid': uuid, 'delta': 1} for uuid in uuids[start:start + BULK_SIZE]
+        ])
+        for start in range(0, users, BULK_SIZE)
+    ], {200})
+    drive('DELETE /users/<uuid>', [('DELETE', f'/users/{uuid}', None) for uuid in uuids], {200})
+
+    if server.dispatcher:
+        server.dispatcher.stop()
+        server.dispatcher.join()
+    server.db.close()
+    server_module.server = None
+    return {name: recorder.result() for name, recorder in recorders.items()}
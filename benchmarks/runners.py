@@ -0,0 +1,100 @@
+from argparse import ArgumentParser
+from http.client import HTTPConnection
+from multiprocessing import get_context
+from os import environ
+from socket import create_connection
+from subprocess import DEVNULL, Popen
+from sys import executable
+from time import perf_counter, sleep
+from uuid import uuid4
+
+from ujson import dumps
+
+from .report import Recorder
+
+RUNNERS = ('flask', 'gunicorn')
+PORT = 18080
+
+
+def wait_listening(port, timeout=30.0):
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        try:
+            create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            sleep(0.1)
+    raise RuntimeError(f'Server did not listen on port {port}')
+
+
+def request(connection, method, url, body=None) -> int:
+    # http.client reopens the connection itself when a server closes it after each response
+    connection.request(method, url, body=body and dumps(body), headers={'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+
+def client(port, uuids, duration):
+    # One client process: sequential keep-alive requests for `duration` seconds, returning their latencies
+    connection = HTTPConnection('127.0.0.1', port)
+    latencies = []
+    start = perf_counter()
+    while (now := perf_counter()) - start < duration:
+        status = request(connection, 'GET', f'/users/{uuids[len(latencies) % len(uuids)]}')
+        if 200 != status:
+            raise RuntimeError(f'GET /users/<uuid> returned {status}')
+        latencies.append(perf_counter() - now)
+    connection.close()
+    return perf_counter() - start, latencies
+
+
+def run_runner(runner, clients, users, duration, env) -> dict:
+    server = Popen([executable, '-m', 'server.app'], stdout=DEVNULL, stderr=DEVNULL,
+                   env={**environ, **env, 'SERVER_MODE': runner, 'SERVER_PORT': str(PORT)})
+    try:
+        wait_listening(PORT)
+        connection = HTTPConnection('127.0.0.1', PORT)
+        prefix = uuid4().hex[:8]
+        uuids = [f'{prefix}{index:024x}' for index in range(users)]
+        for uuid in uuids:
+            request(connection, 'POST', f'/users/{uuid}', {'delta': 0, 'area': f'bench-{prefix}'})
+        connection.close()
+
+        with get_context('fork').Pool(clients) as pool:
+            runs = pool.starmap(client, [(PORT, uuids, duration)] * clients)
+
+        # A new connection, the idle one may have outlived the server's keep-alive timeout
+        connection = HTTPConnection('127.0.0.1', PORT)
+        for uuid in uuids:
+            request(connection, 'DELETE', f'/users/{uuid}')
+        connection.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    # All clients' latencies in one histogram, throughput over the slowest client's wall time
+    recorder = Recorder(sum(len(latencies) for _, latencies in runs))
+    for _, latencies in runs:
+        for latency in latencies:
+            recorder.latency.observe(latency)
+    recorder.elapsed = max(elapsed for elapsed, _ in runs)
+    return recorder.result()
+
+
+def run(clients, users, duration, workers, threads, backend) -> dict:
+    env = {'STORAGE_BACKEND': backend, 'SERVER_WORKERS': str(workers), 'SERVER_THREADS': str(threads),
+           'DISABLE_UPDATES': 'true', 'USER_CACHE_SIZE': '0'}
+    return {runner: run_runner(runner, clients, users, duration, env) for runner in RUNNERS}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Compare the Flask development server with the gunicorn runner')
+    parser.add_argument('--backend', choices=('memory', 'postgres'), default='postgres')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    print(dumps(run(args.clients, args.users, args.duration, args.workers, args.threads, args.backend), indent=2))
@@ -0,0 +1,54 @@
+from argparse import ArgumentParser
+from time import perf_counter, process_time
+from uuid import uuid4
+
+from ujson import dumps
+
+from server.app import app
+from server.src import server as server_module
+from server.src.database import Database
+from server.src.memory import MemoryDatabase
+from server.src.server import UserServer
+
+SERIALIZERS = ('dict', 'tuple', 'postgres')
+
+
+def run(backend: str, users: int, requests: int):
+    db = MemoryDatabase(snapshot_path='') if 'memory' == backend else Database()
+    server_module.server = server = UserServer(db=db, send_updates=False)
+    client = app.test_client()
+    area = f'bench-{uuid4().hex[:8]}'
+    db.bulk_write([{'action': 'create', 'uuid': f'{area}-{index:08d}', 'delta': index, 'area': area}
+                   for index in range(users)])
+    results = {}
+    try:
+        for serializer in SERIALIZERS + ('not_modified',):
+            server.serializer = serializer if serializer in SERIALIZERS else 'tuple'
+            # The last one revalidates with the current ETag instead of fetching the rows
+            headers = {'If-None-Match': client.get(f'/users?area={area}').headers['ETag']} \
+                if 'not_modified' == serializer else {}
+            # Process time is the server's CPU, the database backend excluded
+            cpu, start = process_time(), perf_counter()
+            for _ in range(requests):
+                response = client.get(f'/users?area={area}', headers=headers)
+            elapsed, cpu = perf_counter() - start, process_time() - cpu
+            results[serializer] = {
+                'requests_per_sec': round(requests / elapsed, 1),
+                'ms_per_request': round(elapsed / requests * 1000, 2),
+                'server_cpu_ms_per_request': round(cpu / requests * 1000, 2),
+                'body_bytes': len(response.data),
+            }
+    finally:
+        db.bulk_write([{'action': 'delete', 'uuid': f'{area}-{index:08d}'} for index in range(users)])
+        db.close()
+        server_module.server = None
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Compare the GET /users serialisation paths')
+    parser.add_argument('--backend', choices=('memory', 'postgres'), default='postgres')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+    print(dumps(run(args.backend, args.users, args.requests), indent=2))
@@ -0,0 +1,13 @@
+create table outbox (
+    id bigserial primary key,
+    area text not null,
+    action text not null,
+    uuid text not null,
+    delta int not null,
+    created_at timestamp with time zone not null default NOW(),
+    sent_at timestamp with time zone,
+    -- A dispatcher owns the event until then, so that it publishes without holding a row lock
+    claimed_until timestamp with time zone
+);
+
+create index outbox_unsent_idx on outbox (id) where sent_at is null;
@@ -0,0 +1,52 @@
+-- Collection versions: a counter per area, bumped by every statement that writes users of the area. The row lock
+-- taken to bump it is held until commit, so each area's counter grows in commit order and no snapshot sees a later
+-- value without the writes it counts. Areas are never removed, a counter must not start over.
+create table area_versions (
+    area text primary key not null,
+    changes bigint not null
+);
+
+create function area_versions_bump(areas text[]) returns void language plpgsql as $$
+begin
+    -- In area order, so that concurrent statements lock the counters in the same order
+    insert into area_versions as versions (area, changes)
+    select area, 1 from unnest(areas) as changed(area)
+    group by area
+    order by area
+    on conflict (area) do update set changes = versions.changes + 1;
+end
+$$;
+
+create function area_versions_on_insert() returns trigger language plpgsql as $$
+begin
+    perform area_versions_bump(array_agg(area)) from new_rows;
+    return null;
+end
+$$;
+
+create function area_versions_on_update() returns trigger language plpgsql as $$
+begin
+    perform area_versions_bump(array_agg(area))
+    from (select area from old_rows union select area from new_rows) as changed;
+    return null;
+end
+$$;
+
+create function area_versions_on_delete() returns trigger language plpgsql as $$
+begin
+    perform area_versions_bump(array_agg(area)) from old_rows;
+    return null;
+end
+$$;
+
+create trigger area_versions_insert after insert on users
+    referencing new table as new_rows
+    for each statement execute function area_versions_on_insert();
+
+create trigger area_versions_update after update on users
+    referencing old table as old_rows new table as new_rows
+    for each statement execute function area_versions_on_update();
+
+create trigger area_versions_delete after delete on users
+    referencing old table as old_rows
+    for each statement execute function area_versions_on_delete();
@@ -0,0 +1,2 @@
+-- Version of the last event applied to each user by the subscriber, 0 before any versioned event
+alter table users add column version bigint not null default 0;
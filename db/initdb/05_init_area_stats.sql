@@ -0,0 +1,93 @@
+-- User count and delta totals of each area, maintained by the statement triggers below
+create table area_stats (
+    area text primary key not null,
+    users bigint not null,
+    delta_sum bigint not null,
+    delta_min int,
+    delta_max int
+);
+
+-- Finds the new extreme of an area when the user holding its minimum or maximum leaves
+create index users_area_delta_idx on users (area, delta);
+
+-- Applies users entering (sign 1) and leaving (sign -1) areas, given as parallel arrays
+create function area_stats_apply(areas text[], signs int[], deltas int[]) returns void language plpgsql as $$
+begin
+    if areas is null then
+        return;
+    end if;
+    -- One net change per area, in area order so that concurrent statements lock the summary rows in the same order
+    insert into area_stats as stats (area, users, delta_sum, delta_min, delta_max)
+    select area, sum(sign), sum(sign * delta), min(delta) filter (where sign > 0), max(delta) filter (where sign > 0)
+    from unnest(areas, signs, deltas) as changes(area, sign, delta)
+    where area <> ''
+    group by area
+    order by area
+    on conflict (area) do update set
+        users = stats.users + excluded.users,
+        delta_sum = stats.delta_sum + excluded.delta_sum,
+        delta_min = least(stats.delta_min, excluded.delta_min),
+        delta_max = greatest(stats.delta_max, excluded.delta_max);
+
+    if -1 <> all(signs) then
+        return;
+    end if;
+
+    -- A user that left may have held the minimum or maximum of its area
+    update area_stats as stats set
+        delta_min = (select min(delta) from users where users.area = stats.area),
+        delta_max = (select max(delta) from users where users.area = stats.area)
+    from (
+        select area, min(delta) as delta_min, max(delta) as delta_max
+        from unnest(areas, signs, deltas) as changes(area, sign, delta)
+        where sign < 0
+        group by area
+    ) as gone
+    where stats.area = gone.area and (gone.delta_min <= stats.delta_min or gone.delta_max >= stats.delta_max);
+    delete from area_stats
+    where users = 0 and area = any(areas);
+end
+$$;
+
+create function area_stats_on_insert() returns trigger language plpgsql as $$
+begin
+    perform area_stats_apply(array_agg(area), array_agg(1), array_agg(delta)) from new_rows;
+    return null;
+end
+$$;
+
+create function area_stats_on_update() returns trigger language plpgsql as $$
+begin
+    perform area_stats_apply(array_agg(changes.area), array_agg(changes.sign), array_agg(changes.delta))
+    from old_rows join new_rows using (uuid),
+        lateral (values (old_rows.area, -1, old_rows.delta), (new_rows.area, 1, new_rows.delta))
+            as changes(area, sign, delta)
+    where old_rows.area <> new_rows.area or old_rows.delta <> new_rows.delta;
+    return null;
+end
+$$;
+
+create function area_stats_on_delete() returns trigger language plpgsql as $$
+begin
+    perform area_stats_apply(array_agg(area), array_agg(-1), array_agg(delta)) from old_rows;
+    return null;
+end
+$$;
+
+create trigger area_stats_insert after insert on users
+    referencing new table as new_rows
+    for each statement execute function area_stats_on_insert();
+
+create trigger area_stats_update after update on users
+    referencing old table as old_rows new table as new_rows
+    for each statement execute function area_stats_on_update();
+
+create trigger area_stats_delete after delete on users
+    referencing old table as old_rows
+    for each statement execute function area_stats_on_delete();
+
+insert into area_stats
+select area, count(*), sum(delta), min(delta), max(delta)
+from users
+where area <> ''
+group by area;
@@ -0,0 +1,62 @@
+-- The change feed walks users in (updated_at, uuid) order, the uuid breaking ties between equal timestamps
+create index users_updated_at_uuid_idx on users (updated_at, uuid);
+
+-- Users that left an area, so that the change feed reports them too. `deleted` tells a deleted user from one that
+-- moved to another area, which only the feed of the area it left reports. Entering the area again removes the
+-- tombstone, creating the uuid again turns its other tombstones into moves.
+create table user_tombstones (
+    uuid text not null,
+    area text not null,
+    deleted boolean not null default true,
+    deleted_at timestamp with time zone not null default NOW(),
+    primary key (uuid, area)
+);
+
+create index user_tombstones_deleted_at_uuid_idx on user_tombstones (deleted_at, uuid);
+
+create function user_tombstones_on_insert() returns trigger language plpgsql as $$
+begin
+    delete from user_tombstones
+    using new_rows
+    where user_tombstones.uuid = new_rows.uuid and user_tombstones.area = new_rows.area;
+    update user_tombstones set deleted = false
+    from new_rows
+    where user_tombstones.uuid = new_rows.uuid and user_tombstones.deleted;
+    return null;
+end
+$$;
+
+create function user_tombstones_on_update() returns trigger language plpgsql as $$
+begin
+    delete from user_tombstones
+    using old_rows join new_rows using (uuid)
+    where old_rows.area <> new_rows.area
+        and user_tombstones.uuid = new_rows.uuid and user_tombstones.area = new_rows.area;
+    insert into user_tombstones (uuid, area, deleted, deleted_at)
+    select uuid, old_rows.area, false, now() from old_rows join new_rows using (uuid)
+    where old_rows.area <> new_rows.area
+    on conflict (uuid, area) do update set deleted = excluded.deleted, deleted_at = excluded.deleted_at;
+    return null;
+end
+$$;
+
+create function user_tombstones_on_delete() returns trigger language plpgsql as $$
+begin
+    insert into user_tombstones (uuid, area, deleted, deleted_at)
+    select uuid, area, true, now() from old_rows
+    on conflict (uuid, area) do update set deleted = excluded.deleted, deleted_at = excluded.deleted_at;
+    return null;
+end
+$$;
+
+create trigger user_tombstones_insert after insert on users
+    referencing new table as new_rows
+    for each statement execute function user_tombstones_on_insert();
+
+create trigger user_tombstones_update after update on users
+    referencing old table as old_rows new table as new_rows
+    for each statement execute function user_tombstones_on_update();
+
+create trigger user_tombstones_delete after delete on users
+    referencing old table as old_rows
+    for each statement execute function user_tombstones_on_delete();
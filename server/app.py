@@ -1,5 +1,8 @@
+from os import getenv
+
 from flask import Flask
 
+from .src import server as server_module
 from .src.server import server_blueprint
 
 # Init Flask application
@@ -10,4 +13,17 @@ app.register_blueprint(server_blueprint)
 app.config['JSON_SORT_KEYS'] = False
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=80)
+    port = int(getenv('SERVER_PORT', 80))
+    mode = getenv('SERVER_MODE', 'flask')
+    if 'asyncio' == mode:
+        from aiohttp.web import run_app
+        from .src.aio_server import create_app
+
+        run_app(create_app(), host='0.0.0.0', port=port)
+    elif 'gunicorn' == mode:
+        from .src.runner import ServerRunner
+
+        ServerRunner(app, port=port).run()
+    else:
+        server_module.server = server_module.init_server()
+        app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,6 @@
+from .src.database import Database
+from .src.dispatcher import Dispatcher
+
+if __name__ == '__main__':
+    dispatcher = Dispatcher(db=Database())
+    dispatcher.run()
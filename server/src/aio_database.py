@@ -0,0 +1,263 @@
+from datetime import datetime
+from logging import getLogger
+from os import getenv
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+from asyncpg import create_pool, PostgresError
+from asyncpg.pool import Pool
+
+from .database import (CHANGES_SQL, CLAIM_EVENTS_SQL, CREATE_EVENTS, DELETE_EVENTS, OUTBOX_SQL, SETTLE_EVENTS_SQL,
+                       UPDATE_EVENTS, UPDATED_USER_FIELDS, USER_FIELDS, bulk_batches, changes_condition,
+                       prepare_statement, tombstones_condition)
+
+logger = getLogger()
+
+BULK_SQL = {
+    'create': (f'''
+        INSERT INTO users(uuid, delta, area)
+        SELECT uuid, COALESCE(delta, 0), COALESCE(area, '')
+        FROM unnest($1::text[], $2::int[], $3::text[]) AS v(uuid, delta, area)
+        ON CONFLICT (uuid) DO NOTHING
+        RETURNING {USER_FIELDS}
+    ''', CREATE_EVENTS),
+    'update': (f'''
+        WITH v AS (
+            SELECT * FROM unnest($1::text[], $2::int[], $3::text[]) AS v(uuid, delta, area)
+        ), old AS (
+            SELECT users.uuid, users.area FROM users
+            JOIN v ON users.uuid = v.uuid
+            FOR UPDATE OF users
+        )
+        UPDATE users
+        SET delta = COALESCE(v.delta, users.delta), area = COALESCE(v.area, users.area), updated_at = NOW()
+        FROM v, old
+        WHERE users.uuid = v.uuid AND old.uuid = v.uuid
+        RETURNING {UPDATED_USER_FIELDS}, old.area AS old_area
+    ''', UPDATE_EVENTS),
+    'delete': (f'''
+        DELETE FROM users
+        WHERE uuid = ANY($1::text[])
+        RETURNING {USER_FIELDS}
+    ''', DELETE_EVENTS),
+}
+
+
+class AsyncDatabase:
+    def __init__(self, pool: Optional[Pool] = None, outbox: bool = False):
+        self.pool = pool
+        self.outbox = outbox
+        self.feed_lag = float(getenv('CHANGE_FEED_LAG', 1))
+        self.claim_lease = float(getenv('OUTBOX_CLAIM_LEASE', 30))
+
+    async def connect(self, connection_conf=None):
+        connection_conf = connection_conf or {
+            'user': getenv('POSTGRES_USER'),
+            'password': getenv('POSTGRES_PASSWORD'),
+            'host': getenv('POSTGRES_HOST'),
+            'port': int(getenv('POSTGRES_PORT', 5432)),
+            'database': getenv('POSTGRES_DB'),
+        }
+        self.pool = await create_pool(
+            **connection_conf,
+            min_size=int(getenv('POSTGRES_POOL_MIN', 1)),
+            max_size=int(getenv('POSTGRES_POOL_MAX', 10))
+        )
+        logger.info('Successfully connected to database')
+        return self
+
+    @property
+    def closed(self) -> bool:
+        return self.pool is None or self.pool.is_closing()
+
+    async def close(self):
+        await self.pool.close()
+
+    def stats(self):
+        return {
+            'min_size': self.pool.get_min_size(),
+            'max_size': self.pool.get_max_size(),
+            'size': self.pool.get_size(),
+            'idle': self.pool.get_idle_size(),
+        }
+
+    def _with_events(self, sql, events):
+        if not self.outbox:
+            return sql
+        return OUTBOX_SQL.format(sql=sql, events=events)
+
+    async def _fetch(self, sql, *args) -> List[dict]:
+        try:
+            return [dict(row) for row in await self.pool.fetch(sql, *args)]
+        except PostgresError as e:
+            logger.exception(f'Failed to execute query "{sql}" with values "{args}"')
+            raise e
+
+    async def _fetchrow(self, sql, *args) -> Optional[dict]:
+        try:
+            row = await self.pool.fetchrow(sql, *args)
+            return dict(row) if row else None
+        except PostgresError as e:
+            logger.exception(f'Failed to execute query "{sql}" with values "{args}"')
+            raise e
+
+    async def find_all_users(self) -> List[dict]:
+        sql = f'''
+            SELECT {USER_FIELDS} FROM users
+        '''
+        return await self._fetch(sql)
+
+    async def find_user(self, uuid) -> Optional[dict]:
+        sql = f'''
+            SELECT {USER_FIELDS} FROM users
+            WHERE uuid = $1
+        '''
+        return await self._fetchrow(sql, uuid)
+
+    async def find_user_version(self, uuid) -> Optional[datetime]:
+        sql = '''
+            SELECT updated_at FROM users
+            WHERE uuid = $1
+        '''
+        row = await self._fetchrow(sql, uuid)
+        return row['updated_at'] if row else None
+
+    async def find_users_version(self, area=None) -> dict:
+        sql, args = 'SELECT COALESCE(sum(changes), 0)::bigint AS changes FROM area_versions ', []
+        if area is not None:
+            args.append(area)
+            sql += 'WHERE area = $1'
+        return await self._fetchrow(sql, *args)
+
+    async def find_users_by_area(self, area) -> List[dict]:
+        sql = f'''
+            SELECT {USER_FIELDS} FROM users
+            WHERE area = $1
+        '''
+        return await self._fetch(sql, area)
+
+    async def find_users_page(self, area=None, after=None, limit=100) -> List[dict]:
+        sql, args = f'SELECT {USER_FIELDS} FROM users WHERE TRUE ', []
+        if area is not None:
+            args.append(area)
+            sql += f'AND area = ${len(args)} '
+        if after is not None:
+            args.append(after)
+            sql += f'AND uuid > ${len(args)} '
+        args.append(limit)
+        sql += f'ORDER BY uuid LIMIT ${len(args)}'
+        return await self._fetch(sql, *args)
+
+    async def find_users_changed(self, since: datetime, after=None, area=None, limit=100) -> List[dict]:
+        sql, params = prepare_statement(CHANGES_SQL.format(users=changes_condition('updated_at', area, after),
+                                                           tombstones=tombstones_condition(area, after)))
+        values = {
+            'since': since,
+            'after': after,
+            'area': area,
+            'lag': self.feed_lag,
+            'limit': limit
+        }
+        return await self._fetch(sql, *[values[param] for param in params])
+
+    async def find_areas(self) -> List[dict]:
+        sql = '''
+            SELECT * FROM area_stats
+            ORDER BY area
+        '''
+        return await self._fetch(sql)
+
+    async def find_area_stats(self, area) -> Optional[dict]:
+        sql = '''
+            SELECT * FROM area_stats
+            WHERE area = $1
+        '''
+        return await self._fetchrow(sql, area)
+
+    async def iter_users(self, area=None, chunk_size=1000) -> AsyncIterator[List[dict]]:
+        sql, args = f'SELECT {USER_FIELDS} FROM users ', []
+        if area is not None:
+            args.append(area)
+            sql += 'WHERE area = $1 '
+        sql += 'ORDER BY uuid'
+        async with self.pool.acquire() as connection, connection.transaction():
+            cursor = await connection.cursor(sql, *args)
+            while rows := await cursor.fetch(chunk_size):
+                yield [dict(row) for row in rows]
+
+    async def update_user(self, uuid, delta=None, area=None) -> Optional[dict]:
+        sql, args = '''
+            WITH old AS (
+                SELECT uuid, area FROM users
+                WHERE uuid = $1
+                FOR UPDATE
+            )
+            UPDATE users SET updated_at = NOW()
+        ''', [uuid]
+        if area is not None:
+            args.append(area)
+            sql += f', area = ${len(args)} '
+        if delta is not None:
+            args.append(delta)
+            sql += f', delta = ${len(args)} '
+        sql += f'''
+            FROM old
+            WHERE users.uuid = old.uuid
+            RETURNING {UPDATED_USER_FIELDS}, old.area AS old_area
+        '''
+        return await self._fetchrow(self._with_events(sql, UPDATE_EVENTS), *args)
+
+    async def insert_user(self, uuid, delta=None, area=None) -> Optional[dict]:
+        sql = f'''
+            INSERT INTO users(uuid, delta, area)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (uuid) DO NOTHING
+            RETURNING {USER_FIELDS}
+        '''
+        return await self._fetchrow(self._with_events(sql, CREATE_EVENTS), uuid, delta or 0, area or '')
+
+    async def delete_user(self, uuid) -> Optional[dict]:
+        sql = f'''
+            DELETE FROM users
+            WHERE uuid = $1
+            RETURNING {USER_FIELDS}
+        '''
+        return await self._fetchrow(self._with_events(sql, DELETE_EVENTS), uuid)
+
+    async def bulk_write(self, operations: List[dict]) -> List[Optional[dict]]:
+        results = [None] * len(operations)
+        try:
+            async with self.pool.acquire() as connection, connection.transaction():
+                for batch in bulk_batches(operations):
+                    action = batch[0][1]['action']
+                    sql, events = BULK_SQL[action]
+                    args = [[operation['uuid'] for _, operation in batch]]
+                    if action != 'delete':
+                        args.append([operation['delta'] for _, operation in batch])
+                        args.append([operation['area'] for _, operation in batch])
+                    rows = {row['uuid']: dict(row) for row in await connection.fetch(self._with_events(sql, events), *args)}
+                    for index, operation in batch:
+                        results[index] = rows.get(operation['uuid'])
+            return results
+
+        except PostgresError as e:
+            logger.exception(f'Failed to execute {len(operations)} bulk operations')
+            raise e
+
+    async def dispatch_events(self, publish: Callable[[List[dict]], Awaitable[int]], limit: int) -> int:
+        claim, claim_params = prepare_statement(CLAIM_EVENTS_SQL)
+        settle, settle_params = prepare_statement(SETTLE_EVENTS_SQL)
+        async with self.pool.acquire() as connection:
+            values = {'limit': limit, 'lease': self.claim_lease}
+            rows = await connection.fetch(claim, *[values[param] for param in claim_params])
+        events = sorted((dict(row) for row in rows), key=lambda event: event['id'])
+        if not events:
+            return 0
+        sent = 0
+        try:
+            # Only the first `sent` events are known to have reached the broker
+            sent = await publish(events)
+        finally:
+            values = {'sent': [event['id'] for event in events[:sent]], 'ids': [event['id'] for event in events]}
+            async with self.pool.acquire() as connection:
+                await connection.execute(settle, *[values[param] for param in settle_params])
+        return sent
@@ -0,0 +1,346 @@
+from asyncio import CancelledError, create_task, gather, sleep
+from contextlib import suppress
+from datetime import date
+from json import dumps
+from logging import getLogger
+from math import ceil
+from os import getenv
+from time import perf_counter
+from typing import Optional
+
+from aiohttp import web
+from asyncio_mqtt import Client, MqttError
+from werkzeug.http import http_date
+
+from .aio_database import AsyncDatabase
+from .cache import UserCache
+from .codec import acknowledged_prefix, encode_events
+from .connection import CircuitOpen
+from .metrics import REGISTRY
+from .server import STREAM_CHUNK_SIZE, UserServer, init_cache, user_etag, users_etag
+
+logger = getLogger()
+
+
+class AsyncDispatcher:
+
+    def __init__(self, db: AsyncDatabase, batch_size=None, interval=None, ack_timeout=None, qos=None,
+                 event_format=None, envelope_size=None):
+        self.db = db
+        self.batch_size = batch_size or int(getenv('OUTBOX_BATCH_SIZE', 500))
+        self.interval = interval if interval is not None else float(getenv('OUTBOX_INTERVAL', 0.1))
+        self.ack_timeout = ack_timeout if ack_timeout is not None else float(getenv('OUTBOX_ACK_TIMEOUT', 5))
+        self.qos = qos if qos is not None else int(getenv('USERSERVICE_QOS', 0))
+        self.event_format = event_format or getenv('EVENT_FORMAT', 'json')
+        self.envelope_size = envelope_size if envelope_size is not None else int(getenv('OUTBOX_ENVELOPE_SIZE', 0))
+        self.dispatched = 0
+        self.messages = 0
+        self.client: Optional[Client] = None
+
+    async def run(self):
+        while True:
+            try:
+                async with Client(hostname=getenv('BROKER_HOST', 'mosquitto'),
+                                  port=int(getenv('BROKER_PORT', 1884)), keepalive=60) as client:
+                    logger.info('Successfully connected to mqtt broker.')
+                    self.client = client
+                    await self._drain()
+            except MqttError as e:
+                logger.warning(f'Lost connection to mqtt broker ({e}), reconnecting.')
+            self.client = None
+            await sleep(1)
+
+    async def _drain(self):
+        while True:
+            try:
+                sent = await self.db.dispatch_events(self.publish, limit=self.batch_size)
+            except MqttError:
+                raise
+            except Exception:
+                logger.exception('Failed to dispatch outbox events')
+                sent = 0
+            # Keep draining without pause while there is a backlog
+            if sent < self.batch_size:
+                await sleep(self.interval)
+
+    async def publish(self, events) -> int:
+        groups = encode_events(events, self.event_format, self.envelope_size)
+        results = iter(await gather(*(
+            self.client.publish(topic, payload, qos=self.qos, timeout=self.ack_timeout)
+            for _, messages in groups for topic, payload in messages
+        ), return_exceptions=True))
+        errors = [[result for result in (next(results) for _ in messages) if isinstance(result, Exception)]
+                  for _, messages in groups]
+        sent = acknowledged_prefix(groups, [not group_errors for group_errors in errors])
+        if not sent and any(errors):
+            raise next(error for group_errors in errors for error in group_errors)
+        self.dispatched += sent
+        self.messages += sum(len(messages) for _, messages in groups)
+        return sent
+
+    def stats(self):
+        return {'dispatched': self.dispatched, 'messages': self.messages, 'connected': self.client is not None}
+
+
+class AsyncUserServer(UserServer):
+    def __init__(self, db: AsyncDatabase, send_updates: bool = True,
+                 dispatcher: Optional[AsyncDispatcher] = None, cache: Optional[UserCache] = None):
+        self.db = db
+        self.send_updates = send_updates
+        self.dispatcher = dispatcher
+        self.cache = cache
+
+    async def find_all_users(self, data=None):
+        data = data or {}
+        if area := data.get('area'):
+            result = await self.db.find_users_by_area(area)
+        else:
+            result = await self.db.find_all_users()
+        return result, 200
+
+    async def find_users_page(self, data=None):
+        data = data or {}
+        if not (limit := self._page_limit(data)):
+            return None, 400, None
+
+        result = await self.db.find_users_page(area=data.get('area'), after=data.get('after'), limit=limit)
+        return result, 200, self._next_after(result, limit)
+
+    async def find_users_changed(self, data=None):
+        data = data or {}
+        if not (position := self._changes_position(data)):
+            return None, 400, None
+
+        limit, since, after = position
+        result = await self.db.find_users_changed(since, after=after, area=self._area_filter(data), limit=limit)
+        return result, 200, self._changes_next(result, data)
+
+    async def stream_users(self, data=None):
+        data = data or {}
+        async for rows in self.db.iter_users(area=data.get('area'), chunk_size=STREAM_CHUNK_SIZE):
+            yield ''.join(json_dumps(row) + '\n' for row in rows)
+
+    async def find_user(self, uuid):
+        if result := self._cached_user(uuid):
+            return result, 200
+        generation = self.cache.generation if self.cache else None
+        result = await self.db.find_user(uuid)
+        self._cache_user(uuid, result, generation)
+        return self._found(result)
+
+    async def find_user_etag(self, uuid) -> Optional[str]:
+        if etag := self._cached_etag(uuid):
+            return etag
+        updated_at = await self.db.find_user_version(uuid)
+        return user_etag(updated_at) if updated_at else None
+
+    async def find_all_users_etag(self, data=None) -> str:
+        return users_etag(await self.db.find_users_version(self._area_filter(data or {})))
+
+    async def find_areas(self):
+        return await self.db.find_areas(), 200
+
+    async def find_area_stats(self, area):
+        return self._found(await self.db.find_area_stats(area))
+
+    async def update_user(self, uuid, data=None):
+        data = data or {}
+        result = await self.db.update_user(uuid=uuid, delta=data.get('delta'), area=data.get('area'))
+        return self._written(uuid, result, 200)
+
+    async def create_user(self, uuid, data=None):
+        data = data or {}
+        result = await self.db.insert_user(uuid=uuid, delta=data.get('delta'), area=data.get('area'))
+        return self._written(uuid, result, 201, failed_code=409)
+
+    async def bulk_write(self, data=None):
+        if rejected := self._bulk_rejected(data):
+            return rejected
+
+        result, operations = self._bulk_operations(data)
+        rows = await self.db.bulk_write(operations) if operations else []
+        return self._bulk_result(result, operations, rows)
+
+    async def remove_user(self, uuid):
+        return self._written(uuid, await self.db.delete_user(uuid=uuid), 200)
+
+
+def _json_default(value):
+    # Same datetime representation as Flask's jsonify
+    if isinstance(value, date):
+        return http_date(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def json_dumps(value) -> str:
+    return dumps(value, default=_json_default)
+
+
+def json_response(result, code, headers=None) -> web.Response:
+    return web.json_response(result, status=code, headers=headers, dumps=json_dumps)
+
+
+def if_none_match(request: web.Request, etag) -> bool:
+    # Weak comparison, as If-None-Match requires
+    return any(tag.value in (etag, '*') for tag in request.if_none_match or ())
+
+
+def not_modified(etag) -> web.Response:
+    response = web.Response(status=304)
+    response.etag = etag
+    return response
+
+
+async def request_json(request: web.Request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+# aiohttp routes, mirroring server_blueprint
+routes = web.RouteTableDef()
+
+
+@web.middleware
+async def request_latency(request, handler):
+    start = perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else 'unmatched'
+        REGISTRY.histogram('userservice_http_request_seconds', 'HTTP request latency', method=request.method,
+                           route=route).observe(perf_counter() - start)
+
+
+@web.middleware
+async def database_unavailable(request, handler):
+    try:
+        return await handler(request)
+    except CircuitOpen as error:
+        return json_response(None, 503, {'Retry-After': str(max(1, ceil(error.retry_after)))})
+
+
+@routes.get('/metrics')
+async def metrics(request):
+    return web.Response(body=REGISTRY.render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
+@routes.get('/stats')
+async def stats(request):
+    result, code = request.app['server'].stats()
+    return json_response(result, code)
+
+
+@routes.get('/users')
+async def find_all_users(request):
+    server = request.app['server']
+    if 'true' == request.query.get('stream'):
+        response = web.StreamResponse()
+        response.content_type = 'application/x-ndjson'
+        response.charset = 'utf-8'
+        await response.prepare(request)
+        async for chunk in server.stream_users(data=request.query):
+            await response.write(chunk.encode())
+        await response.write_eof()
+        return response
+
+    if 'updated_since' in request.query:
+        result, code, after = await server.find_users_changed(data=request.query)
+        headers = {}
+        if after:
+            headers['Link'] = f'<{request.rel_url.update_query(after=after)}>; rel="next"'
+        return json_response(result, code, headers)
+
+    if 'limit' in request.query or 'after' in request.query:
+        result, code, after = await server.find_users_page(data=request.query)
+        headers = {}
+        if after:
+            headers['Link'] = f'<{request.rel_url.update_query(after=after)}>; rel="next"'
+        return json_response(result, code, headers)
+
+    # Looked up before the rows, so a concurrent write can only make the tag older than the body, never newer
+    etag = await server.find_all_users_etag(data=request.query)
+    if if_none_match(request, etag):
+        return not_modified(etag)
+
+    result, code = await server.find_all_users(data=request.query)
+    response = json_response(result, code)
+    response.etag = etag
+    return response
+
+
+@routes.get('/areas')
+async def find_areas(request):
+    result, code = await request.app['server'].find_areas()
+    return json_response(result, code)
+
+
+@routes.get('/areas/{area}/stats')
+async def find_area_stats(request):
+    result, code = await request.app['server'].find_area_stats(request.match_info['area'])
+    return json_response(result, code)
+
+
+@routes.post('/users/_bulk')
+async def bulk_write(request):
+    result, code = await request.app['server'].bulk_write(await request_json(request))
+    return json_response(result, code)
+
+
+@routes.get('/users/{uuid}')
+async def find_user(request):
+    server, uuid = request.app['server'], request.match_info['uuid']
+    if request.if_none_match and (etag := await server.find_user_etag(uuid)) and if_none_match(request, etag):
+        return not_modified(etag)
+
+    result, code = await server.find_user(uuid)
+    response = json_response(result, code)
+    if result:
+        response.etag = user_etag(result['updated_at'])
+    return response
+
+
+@routes.put('/users/{uuid}')
+@routes.patch('/users/{uuid}')
+async def update_user(request):
+    result, code = await request.app['server'].update_user(request.match_info['uuid'], await request_json(request))
+    return json_response(result, code)
+
+
+@routes.post('/users/{uuid}')
+async def create_user(request):
+    result, code = await request.app['server'].create_user(request.match_info['uuid'], await request_json(request))
+    return json_response(result, code)
+
+
+@routes.delete('/users/{uuid}')
+async def remove_user(request):
+    result, code = await request.app['server'].remove_user(request.match_info['uuid'])
+    return json_response(result, code)
+
+
+async def server_context(app):
+    if 'memory' == getenv('STORAGE_BACKEND', 'postgres'):
+        raise RuntimeError('The asyncio server mode needs the postgres storage backend')
+    send_updates = 'true' != getenv('DISABLE_UPDATES', 'false')
+    db = await AsyncDatabase(outbox=send_updates).connect()
+    dispatcher, task = None, None
+    if send_updates and 'thread' == getenv('OUTBOX_DISPATCHER', 'thread'):
+        dispatcher = AsyncDispatcher(db)
+        task = create_task(dispatcher.run())
+    app['server'] = AsyncUserServer(db, send_updates=send_updates, dispatcher=dispatcher, cache=init_cache())
+    yield
+    if task:
+        task.cancel()
+        # Let the dispatcher leave its transaction before the pool closes under it
+        with suppress(CancelledError):
+            await task
+    await db.close()
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[request_latency, database_unavailable])
+    app.add_routes(routes)
+    app.cleanup_ctx.append(server_context)
+    return app
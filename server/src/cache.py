@@ -0,0 +1,141 @@
+from collections import OrderedDict
+from logging import getLogger
+from os import getenv
+from threading import Lock
+from time import monotonic
+from typing import List, Optional
+
+from paho.mqtt.client import Client, topic_matches_sub
+
+from .codec import decode_users, subscription_topic
+
+logger = getLogger()
+
+
+class UserCache:
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size or int(getenv('USER_CACHE_SIZE', 10000))
+        self.ttl = ttl if ttl is not None else float(getenv('USER_CACHE_TTL', 30))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        # Generation at the latest invalidation of each uuid, the oldest forgotten past max_size. A row read before
+        # the floor may have missed an invalidation that is no longer tracked.
+        self._invalidated = OrderedDict()
+        self._floor = 0
+        self._lock = Lock()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, uuid) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(uuid)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, row = entry
+            if expires_at < monotonic():
+                del self._entries[uuid]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(uuid)
+            self.hits += 1
+            return row
+
+    def put(self, uuid, row, generation=None):
+        with self._lock:
+            # Skip rows read before an invalidation of their uuid that happened while they were being fetched
+            if generation is not None and generation < max(self._floor, self._invalidated.get(uuid, 0)):
+                return
+            self._entries[uuid] = (monotonic() + self.ttl, row)
+            self._entries.move_to_end(uuid)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, uuid):
+        with self._lock:
+            self._generation += 1
+            self._invalidated[uuid] = self._generation
+            self._invalidated.move_to_end(uuid)
+            while len(self._invalidated) > self.max_size:
+                self._floor = self._invalidated.popitem(last=False)[1]
+            if self._entries.pop(uuid, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._floor = self._generation
+            self._invalidated.clear()
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        return {
+            'size': size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+        }
+
+
+def invalidation_topics() -> List[str]:
+    # Only messages sent once their write committed: what the subscriber wrote, and the area topics the outbox
+    # dispatchers of every server publish to
+    areas = getenv('USER_CACHE_INVALIDATION_TOPICS') or subscription_topic('+', getenv('EVENT_FORMAT', 'json'))
+    return [written_topic()] + [topic.strip() for topic in areas.split(',') if topic.strip()]
+
+
+def written_topic() -> str:
+    return getenv('USER_CACHE_WRITTEN_TOPIC', '_userservice/written')
+
+
+class CacheInvalidator(Client):
+
+    def __init__(self, cache: UserCache, topics=None):
+        super().__init__()
+        self.cache = cache
+        self.topics = topics or invalidation_topics()
+        # Deltas for the subscriber arrive before it wrote them, invalidating on those would let a read cache the
+        # old row again
+        self.ignored = [topic.strip() for topic in getenv('USERSERVICE_TOPIC', '').split(',') if topic.strip()]
+        self.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.on_connect = self.inv_on_connect
+        self.on_message = self.inv_on_message
+
+    def start(self):
+        self.connect_async(host=getenv('BROKER_HOST', 'mosquitto'), port=int(getenv('BROKER_PORT', 1884)))
+        self.loop_start()
+
+    def stop(self):
+        self.disconnect()
+        self.loop_stop()
+
+    def inv_on_connect(self, client, userdata, flags, rc):
+        logger.info('Successfully connected to mqtt broker.')
+        # Entries may have gone stale while disconnected
+        self.cache.clear()
+        client.subscribe([(topic, 0) for topic in self.topics])
+
+    def inv_on_message(self, client, userdata, message):
+        if any(topic_matches_sub(topic, message.topic) for topic in self.ignored):
+            return
+        try:
+            users = decode_users(message.payload)
+        except (ValueError, AttributeError):
+            return
+        for user in users:
+            if user.get('uuid'):
+                self.cache.invalidate(user['uuid'])
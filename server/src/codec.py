@@ -0,0 +1,161 @@
+from struct import Struct, error as StructError
+from typing import List, Optional, Tuple
+
+from ujson import dumps, loads
+
+# Binary events are published on the area topic with this suffix, JSON events on the plain area topic
+BINARY_TOPIC_SUFFIX = '/bin'
+
+# Version 1: version byte, action code, 16 raw uuid bytes, signed 32-bit delta, all big-endian. A payload starting
+# with one of the version bytes is binary, anything else is JSON, which may start with whitespace.
+BINARY_V1 = Struct('>BB16si')
+VERSION_1 = 1
+# Envelope version 1: version byte and a 16-bit event count, followed by one action, uuid and delta record per event
+ENVELOPE_V1 = Struct('>BH')
+ENVELOPE_RECORD = Struct('>B16si')
+VERSION_ENVELOPE_1 = 2
+# Versions 2 append the signed 64-bit event version to each event, the outbox id it was published from
+BINARY_V2 = Struct('>BB16siq')
+VERSION_2 = 3
+ENVELOPE_RECORD_V2 = Struct('>B16siq')
+VERSION_ENVELOPE_2 = 4
+
+ENVELOPE_RECORDS = {VERSION_ENVELOPE_1: ENVELOPE_RECORD, VERSION_ENVELOPE_2: ENVELOPE_RECORD_V2}
+
+ACTION_CODES = {'create': 1, 'update': 2, 'delete': 3}
+ACTIONS = {code: action for action, code in ACTION_CODES.items()}
+
+
+def _json_event(action, uuid, delta, version=None) -> dict:
+    user = {'uuid': uuid, 'delta': delta}
+    if version is not None:
+        user['version'] = version
+    return {'action': action, 'user': user}
+
+
+def _raw_uuid(uuid) -> Optional[bytes]:
+    # Only lowercase 32-digit hex uuids survive the trip through 16 raw bytes
+    try:
+        raw = bytes.fromhex(uuid)
+    except (TypeError, ValueError):
+        return None
+    return raw if len(raw) == 16 and raw.hex() == uuid else None
+
+
+def encode_json(action, uuid, delta, version=None) -> bytes:
+    return dumps(_json_event(action, uuid, delta, version)).encode()
+
+
+def encode_binary(action, uuid, delta, version=None) -> bytes:
+    # Any event the binary layout cannot hold stays JSON
+    if (raw := _raw_uuid(uuid)) is not None:
+        try:
+            if version is None:
+                return BINARY_V1.pack(VERSION_1, ACTION_CODES[action], raw, delta)
+            return BINARY_V2.pack(VERSION_2, ACTION_CODES[action], raw, delta, version)
+        except StructError:
+            pass
+    return encode_json(action, uuid, delta, version)
+
+
+def encode_json_envelope(events) -> bytes:
+    return dumps({'events': [
+        _json_event(event['action'], event['uuid'], event['delta'], event.get('id')) for event in events
+    ]}).encode()
+
+
+def encode_binary_envelope(events) -> bytes:
+    raws = [_raw_uuid(event['uuid']) for event in events]
+    if None not in raws:
+        try:
+            if all(event.get('id') is not None for event in events):
+                records = (ENVELOPE_RECORD_V2.pack(ACTION_CODES[event['action']], raw, event['delta'], event['id'])
+                           for event, raw in zip(events, raws))
+                return ENVELOPE_V1.pack(VERSION_ENVELOPE_2, len(events)) + b''.join(records)
+            records = (ENVELOPE_RECORD.pack(ACTION_CODES[event['action']], raw, event['delta'])
+                       for event, raw in zip(events, raws))
+            return ENVELOPE_V1.pack(VERSION_ENVELOPE_1, len(events)) + b''.join(records)
+        except StructError:
+            pass
+    return encode_json_envelope(events)
+
+
+def encode_event(event, event_format='json') -> List[Tuple[str, bytes]]:
+    # The (topic, payload) messages that carry one outbox event, its id serving as the event version
+    action, uuid, delta, version = event['action'], event['uuid'], event['delta'], event.get('id')
+    messages = []
+    if event_format in ('json', 'both'):
+        messages.append((event['area'], encode_json(action, uuid, delta, version)))
+    if event_format in ('binary', 'both'):
+        messages.append((event['area'] + BINARY_TOPIC_SUFFIX, encode_binary(action, uuid, delta, version)))
+    return messages
+
+
+def encode_envelope(events, event_format='json') -> List[Tuple[str, bytes]]:
+    # The (topic, payload) messages that carry several outbox events of one area
+    area = events[0]['area']
+    messages = []
+    if event_format in ('json', 'both'):
+        messages.append((area, encode_json_envelope(events)))
+    if event_format in ('binary', 'both'):
+        messages.append((area + BINARY_TOPIC_SUFFIX, encode_binary_envelope(events)))
+    return messages
+
+
+def encode_events(events, event_format='json', envelope_size=0) -> List[Tuple[List[int], List[Tuple[str, bytes]]]]:
+    # Messages to publish, each group with the positions of the events it carries. With envelopes the events of
+    # an area travel together, in their original order, up to envelope_size per message.
+    if not envelope_size:
+        return [([index], encode_event(event, event_format)) for index, event in enumerate(events)]
+    areas = {}
+    for index, event in enumerate(events):
+        areas.setdefault(event['area'], []).append(index)
+    return [
+        (chunk, encode_envelope([events[index] for index in chunk], event_format))
+        for indexes in areas.values()
+        for chunk in (indexes[start:start + envelope_size] for start in range(0, len(indexes), envelope_size))
+    ]
+
+
+def acknowledged_prefix(groups, acknowledged: List[bool]) -> int:
+    # Number of leading events whose every message reached the broker
+    failed = min((min(indexes) for (indexes, _), ok in zip(groups, acknowledged) if not ok), default=None)
+    return sum(len(indexes) for indexes, _ in groups) if failed is None else failed
+
+
+def subscription_topic(topic, event_format='json') -> str:
+    # Consumers pick a format by topic, as MQTT 3.1.1 carries no content type
+    return topic + BINARY_TOPIC_SUFFIX if 'binary' == event_format else topic
+
+
+def decode_event(payload: bytes) -> dict:
+    # Either format, single events and envelopes, returned in the JSON shape
+    if payload and payload[0] in (VERSION_1, VERSION_2):
+        try:
+            if payload[0] == VERSION_1:
+                _, code, raw, delta = BINARY_V1.unpack(payload)
+                return _json_event(ACTIONS[code], raw.hex(), delta)
+            _, code, raw, delta, version = BINARY_V2.unpack(payload)
+            return _json_event(ACTIONS[code], raw.hex(), delta, version)
+        except (StructError, KeyError):
+            raise ValueError('Malformed binary event')
+    if payload and (record := ENVELOPE_RECORDS.get(payload[0])):
+        try:
+            _, count = ENVELOPE_V1.unpack_from(payload)
+            if len(payload) != ENVELOPE_V1.size + count * record.size:
+                raise ValueError('Malformed binary envelope')
+            return {'events': [
+                _json_event(ACTIONS[fields[0]], fields[1].hex(), *fields[2:])
+                for fields in record.iter_unpack(payload[ENVELOPE_V1.size:])
+            ]}
+        except (StructError, KeyError):
+            raise ValueError('Malformed binary envelope')
+    return loads(payload)
+
+
+def decode_users(payload: bytes) -> List[dict]:
+    # The users carried by a single event or an envelope
+    event = decode_event(payload)
+    if 'events' in event:
+        return [user for item in event['events'] if (user := item.get('user'))]
+    return [user] if (user := event.get('user')) else []
@@ -0,0 +1,120 @@
+from logging import getLogger
+from os import getenv
+from random import uniform
+from threading import Lock
+from time import monotonic
+from typing import Callable, Iterator, TypeVar
+
+from psycopg2 import Error, InterfaceError, OperationalError
+from psycopg2.pool import PoolError
+
+from .metrics import REGISTRY
+
+logger = getLogger()
+
+T = TypeVar('T')
+
+# Errors that can mean the server went away, rather than that the statement itself failed
+CONNECTION_ERRORS = (OperationalError, InterfaceError)
+
+
+def connection_lost(error: Error) -> bool:
+    # Errors raised by a cursor only count if they also closed its connection, e.g. not a statement timeout
+    if not isinstance(error, CONNECTION_ERRORS):
+        return False
+    return error.cursor is None or bool(error.cursor.connection.closed)
+
+
+class CircuitOpen(PoolError):
+    def __init__(self, message, retry_after: float = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Backoff:
+    def __init__(self, base=None, cap=None):
+        self.base = base if base is not None else float(getenv('POSTGRES_BACKOFF_BASE', 0.1))
+        self.cap = cap if cap is not None else float(getenv('POSTGRES_BACKOFF_MAX', 10))
+
+    def delay(self, attempt: int) -> float:
+        # Full jitter, so that clients which lost the database at the same moment do not come back in lockstep
+        return uniform(0, min(self.cap, self.base * 2 ** min(attempt, 32)))
+
+    def delays(self) -> Iterator[float]:
+        attempt = 0
+        while True:
+            yield self.delay(attempt)
+            attempt += 1
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=None, reset_timeout=None):
+        self.threshold = threshold or int(getenv('POSTGRES_BREAKER_THRESHOLD', 5))
+        self.reset_timeout = reset_timeout if reset_timeout is not None \
+            else float(getenv('POSTGRES_BREAKER_RESET', 5))
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == CircuitBreaker.OPEN and monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = CircuitBreaker.HALF_OPEN
+                self._trial = False
+            if self.state == CircuitBreaker.CLOSED:
+                return
+            # While half open a single caller probes the database, everybody else keeps failing fast
+            if self.state == CircuitBreaker.HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+            self.rejected += 1
+            retry_after = max(0.0, self._opened_at + self.reset_timeout - monotonic())
+        raise CircuitOpen('Database circuit breaker is open', retry_after)
+
+    def success(self):
+        with self._lock:
+            if self.state != CircuitBreaker.CLOSED:
+                logger.info('Database is reachable again, closing the circuit breaker')
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or \
+                    (self.state == CircuitBreaker.CLOSED and self.failures >= self.threshold):
+                logger.warning(f'Database unreachable after {self.failures} attempts, '
+                               f'failing fast for {self.reset_timeout}s')
+                self.state = CircuitBreaker.OPEN
+                self.opened += 1
+                REGISTRY.counter('userservice_db_circuit_opened_total',
+                                 'Times the database circuit breaker opened').inc()
+            if self.state == CircuitBreaker.OPEN:
+                self._opened_at = monotonic()
+
+    def call(self, function: Callable[[], T]) -> T:
+        self.allow()
+        try:
+            result = function()
+        except Exception:
+            self.failure()
+            raise
+        self.success()
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'opened': self.opened,
+            }
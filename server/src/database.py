@@ -1,10 +1,20 @@
+from contextlib import contextmanager
+from datetime import datetime
 from enum import Enum
+from functools import lru_cache
 from logging import getLogger
 from os import getenv
-from typing import List
+from re import compile
+from time import sleep
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from weakref import WeakKeyDictionary
 
-from psycopg2 import connect, Error
-from psycopg2.extras import RealDictCursor, RealDictRow
+from psycopg2 import Error
+from psycopg2.extras import RealDictCursor, RealDictRow, execute_values
+
+from .connection import Backoff, connection_lost
+from .metrics import REGISTRY, timed
+from .pool import ConnectionPool
 
 logger = getLogger()
 
@@ -15,105 +25,482 @@ class Fetch(Enum):
     ALL = -1
 
 
+# Columns of a user as the API returns it, in the order find_users_rows returns them. The version the subscriber
+# keeps is internal to event ordering.
+USER_COLUMNS = ('uuid', 'delta', 'area', 'created_at', 'updated_at')
+USER_FIELDS = ', '.join(USER_COLUMNS)
+UPDATED_USER_FIELDS = ', '.join(f'users.{column}' for column in USER_COLUMNS)
+
+OUTBOX_SQL = '''
+    WITH changed AS ({sql}), event AS (
+        INSERT INTO outbox(area, action, uuid, delta)
+        SELECT area, action, uuid, delta FROM ({events}) AS events
+        WHERE area <> ''
+        ORDER BY area, seq
+    )
+    SELECT * FROM changed
+'''
+
+CREATE_EVENTS = '''
+    SELECT 1 AS seq, area, 'create' AS action, uuid, delta FROM changed
+'''
+
+UPDATE_EVENTS = '''
+    SELECT 1 AS seq, old_area AS area, CASE WHEN area <> old_area THEN 'delete' ELSE 'update' END AS action,
+        uuid, delta
+    FROM changed
+    UNION ALL
+    SELECT 2 AS seq, area, 'create' AS action, uuid, delta
+    FROM changed WHERE area <> old_area
+'''
+
+DELETE_EVENTS = '''
+    SELECT 1 AS seq, area, 'delete' AS action, uuid, delta FROM changed
+'''
+
+BULK_SQL = {
+    'create': (f'''
+        INSERT INTO users(uuid, delta, area)
+        VALUES %s
+        ON CONFLICT (uuid) DO NOTHING
+        RETURNING {USER_FIELDS}
+    ''', "(%(uuid)s, COALESCE(%(delta)s, 0), COALESCE(%(area)s, ''))", CREATE_EVENTS),
+    'update': (f'''
+        WITH v(uuid, delta, area) AS (VALUES %s), old AS (
+            SELECT users.uuid, users.area FROM users
+            JOIN v ON users.uuid = v.uuid
+            FOR UPDATE OF users
+        )
+        UPDATE users
+        SET delta = COALESCE(v.delta, users.delta), area = COALESCE(v.area, users.area), updated_at = NOW()
+        FROM v, old
+        WHERE users.uuid = v.uuid AND old.uuid = v.uuid
+        RETURNING {UPDATED_USER_FIELDS}, old.area AS old_area
+    ''', '(%(uuid)s, %(delta)s::int, %(area)s::text)', UPDATE_EVENTS),
+    'delete': (f'''
+        DELETE FROM users
+        WHERE uuid IN (SELECT uuid FROM (VALUES %s) AS v(uuid))
+        RETURNING {USER_FIELDS}
+    ''', '(%(uuid)s)', DELETE_EVENTS),
+}
+
+
+# Timestamps rendered by Postgres the way jsonify renders a datetime, cheaper than parsing them into datetimes
+HTTP_DATE_SQL = "to_char({column} AT TIME ZONE 'UTC', 'Dy, DD Mon YYYY HH24:MI:SS \"GMT\"')"
+
+USERS_ROWS_SQL = f'''
+    SELECT uuid, delta, area, {HTTP_DATE_SQL.format(column='created_at')},
+        {HTTP_DATE_SQL.format(column='updated_at')}
+    FROM users
+'''
+
+# Postgres renders the whole users list itself
+USERS_JSON_SQL = f'''
+    SELECT COALESCE(json_agg(json_build_object(
+        'uuid', uuid,
+        'delta', delta,
+        'area', area,
+        'created_at', {HTTP_DATE_SQL.format(column='created_at')},
+        'updated_at', {HTTP_DATE_SQL.format(column='updated_at')}
+    )), '[]')::text AS users
+    FROM users
+'''
+
+# Users and tombstones changed after a point of the change feed, in (updated_at, uuid) order. Each branch reads
+# at most `limit` rows off its (timestamp, uuid) index.
+CHANGES_SQL = '''
+    SELECT * FROM (
+        (
+            SELECT uuid, delta, area, created_at, updated_at, FALSE AS deleted
+            FROM users
+            WHERE {users}
+            ORDER BY updated_at, uuid
+            LIMIT %(limit)s
+        )
+        UNION ALL
+        (
+            SELECT uuid, NULL, area, NULL, deleted_at, TRUE
+            FROM user_tombstones
+            WHERE {tombstones}
+            ORDER BY deleted_at, uuid
+            LIMIT %(limit)s
+        )
+    ) AS changes
+    ORDER BY updated_at, uuid
+    LIMIT %(limit)s
+'''
+
+
+def changes_condition(column, area=None, after=None) -> str:
+    condition = f'{column} >= %(since)s ' if after is None else f'({column}, uuid) > (%(since)s, %(after)s) '
+    # Timestamps are taken when a transaction starts, so the newest ones may still be joined by slower
+    # transactions committing later. Holding them back for a moment keeps the cursor from skipping those.
+    condition += f"AND {column} < NOW() - %(lag)s * interval '1 second' "
+    if area is not None:
+        condition += 'AND area = %(area)s '
+    return condition
+
+
+def tombstones_condition(area=None, after=None) -> str:
+    # Only the feed of an area reports users that moved out of it, they still exist for everybody else
+    return changes_condition('deleted_at', area, after) + ('AND deleted ' if area is None else '')
+
+
+PARAMETER = compile(r'%\((\w+)\)s')
+
+
+# Claims commit before publishing, so no transaction stays open while waiting for the broker. An event whose
+# dispatcher died is claimed again once its lease ran out.
+CLAIM_EVENTS_SQL = '''
+    WITH claimed AS (
+        SELECT id FROM outbox
+        WHERE sent_at IS NULL AND (claimed_until IS NULL OR claimed_until < NOW())
+        ORDER BY id
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE outbox SET claimed_until = NOW() + make_interval(secs => %(lease)s)
+    FROM claimed WHERE outbox.id = claimed.id
+    RETURNING outbox.*
+'''
+
+# Marks the acknowledged events sent and releases the others for the next tick
+SETTLE_EVENTS_SQL = '''
+    UPDATE outbox SET sent_at = CASE WHEN id = ANY(%(sent)s::bigint[]) THEN NOW() END, claimed_until = NULL
+    WHERE id = ANY(%(ids)s::bigint[])
+'''
+
+
+@lru_cache(maxsize=256)
+def prepare_statement(sql) -> Tuple[str, Tuple[str, ...]]:
+    # Turn named psycopg2 placeholders into positional $n parameters usable by PREPARE
+    params = []
+
+    def placeholder(match):
+        if match.group(1) not in params:
+            params.append(match.group(1))
+        return f'${params.index(match.group(1)) + 1}'
+
+    return PARAMETER.sub(placeholder, sql), tuple(params)
+
+
+def bulk_batches(operations):
+    # Consecutive operations of the same kind share one statement. A new statement is started whenever the
+    # kind changes or a uuid repeats, so the result is the same as applying the operations one by one.
+    batch, uuids = [], set()
+    for index, operation in enumerate(operations):
+        if batch and (operation['action'] != batch[0][1]['action'] or operation['uuid'] in uuids):
+            yield batch
+            batch, uuids = [], set()
+        batch.append((index, operation))
+        uuids.add(operation['uuid'])
+    if batch:
+        yield batch
+
+
 class Database:
-    def __init__(self, connection=None, connection_conf=None):
-        self.connection = connection or Database._init_connection(connection_conf)
+    def __init__(self, connection=None, connection_conf=None, pool: Optional[ConnectionPool] = None,
+                 outbox: bool = False):
+        self.pool = pool or Database._init_pool(connection, connection_conf)
+        self.outbox = outbox
+        self.prepare = 'true' == getenv('POSTGRES_PREPARE', 'true')
+        # Reads are retried on a fresh connection when theirs turns out to be broken, writes never are
+        self.read_retries = int(getenv('POSTGRES_READ_RETRIES', 2))
+        self.backoff = Backoff()
+        self.feed_lag = float(getenv('CHANGE_FEED_LAG', 1))
+        self.claim_lease = float(getenv('OUTBOX_CLAIM_LEASE', 30))
+        # Statements prepared on each pooled connection, by name
+        self._prepared: WeakKeyDictionary = WeakKeyDictionary()
 
     @staticmethod
-    def _init_connection(connection_conf):
-        connection_conf = connection_conf or {
-            'user': getenv('POSTGRES_USER'),
-            'password': getenv('POSTGRES_PASSWORD'),
-            'host': getenv('POSTGRES_HOST'),
-            'port': getenv('POSTGRES_PORT'),
-            'dbname': getenv('POSTGRES_DB'),
-        }
-        connection = connect(**connection_conf)
-        logger.info('Successfully connected to database')
-        return connection
+    def _init_pool(connection, connection_conf):
+        if connection:
+            return ConnectionPool(connection_conf, min_size=1, max_size=1, connections=[connection])
+        return ConnectionPool(connection_conf)
+
+    @property
+    def closed(self) -> bool:
+        return self.pool.closed
 
-    def _open_cursor(self):
-        return self.connection.cursor(cursor_factory=RealDictCursor)
+    def close(self):
+        self.pool.closeall()
 
-    def _execute_query(self, sql, values=None, fetch: Fetch = Fetch.ONE):
-        with self._open_cursor() as cursor:
+    def stats(self):
+        return self.pool.stats()
+
+    @staticmethod
+    def _open_cursor(connection, cursor_factory=RealDictCursor):
+        return connection.cursor(cursor_factory=cursor_factory)
+
+    @contextmanager
+    def _transaction(self, cursor_factory=RealDictCursor):
+        with self.pool.connection() as connection, self._open_cursor(connection, cursor_factory) as cursor:
             try:
+                yield cursor
+                connection.commit()
+            except Error:
+                if not connection.closed:
+                    connection.rollback()
+                raise
+
+    def _execute_prepared(self, cursor, name, sql, values):
+        statement, params = prepare_statement(sql)
+        prepared: Dict[str, str] = self._prepared.setdefault(cursor.connection, {})
+        if prepared.get(name) != statement:
+            if name in prepared:
+                cursor.execute(f'DEALLOCATE {name}')
+                del prepared[name]
+            cursor.execute(f'PREPARE {name} AS {statement}')
+            prepared[name] = statement
+        if params:
+            cursor.execute(f'EXECUTE {name}({", ".join(["%s"] * len(params))})', [values[param] for param in params])
+        else:
+            cursor.execute(f'EXECUTE {name}')
+
+    @staticmethod
+    def _query_latency(name):
+        return REGISTRY.histogram('userservice_db_query_seconds', 'Database query latency', query=name)
+
+    def _run_query(self, sql, values, fetch: Fetch, name, cursor_factory):
+        with timed(self._query_latency(name or 'unnamed')), self._transaction(cursor_factory) as cursor:
+            if name and self.prepare:
+                self._execute_prepared(cursor, name, sql, values)
+            else:
                 cursor.execute(sql, values)
-                if fetch == Fetch.NONE:
-                    result = None
-                elif fetch == Fetch.ONE:
-                    result = cursor.fetchone()
-                elif fetch == Fetch.ALL:
-                    result = cursor.fetchall()
-                self.connection.commit()
-                return result
+            if fetch == Fetch.NONE:
+                return None
+            elif fetch == Fetch.ONE:
+                return cursor.fetchone()
+            elif fetch == Fetch.ALL:
+                return cursor.fetchall()
+
+    def _execute_query(self, sql, values=None, fetch: Fetch = Fetch.ONE, name=None, cursor_factory=RealDictCursor,
+                       idempotent=False):
+        retries = self.read_retries if idempotent else 0
+        for attempt in range(retries + 1):
+            try:
+                return self._run_query(sql, values, fetch, name, cursor_factory)
 
             except Error as e:
+                if attempt < retries and connection_lost(e):
+                    logger.warning(f'Lost the database connection, retrying query "{name or sql}"')
+                    sleep(self.backoff.delay(attempt))
+                    continue
                 logger.exception(f'Failed to execute query "{sql}" with values "{values}"')
-                self.connection.rollback()
                 raise e
 
+    def _with_events(self, sql, events):
+        if not self.outbox:
+            return sql
+        return OUTBOX_SQL.format(sql=sql, events=events)
+
     def find_all_users(self) -> List[RealDictRow]:
-        sql = '''
-            SELECT * FROM users
+        sql = f'''
+            SELECT {USER_FIELDS} FROM users
         '''
-        return self._execute_query(sql, fetch=Fetch.ALL)
+        return self._execute_query(sql, fetch=Fetch.ALL, name='find_all_users', idempotent=True)
 
     def find_user(self, uuid) -> RealDictRow:
+        sql = f'''
+            SELECT {USER_FIELDS} FROM users
+            WHERE uuid = %(uuid)s
+        '''
+        values = {'uuid': uuid}
+        return self._execute_query(sql, values, name='find_user', idempotent=True)
+
+    def find_user_version(self, uuid) -> Optional[datetime]:
         sql = '''
-            SELECT * FROM users
+            SELECT updated_at FROM users
             WHERE uuid = %(uuid)s
         '''
         values = {'uuid': uuid}
-        return self._execute_query(sql, values)
+        row = self._execute_query(sql, values, name='find_user_version', idempotent=True)
+        return row['updated_at'] if row else None
+
+    def find_users_version(self, area=None) -> RealDictRow:
+        # Grows with every committed write to a user of the collection
+        sql = 'SELECT COALESCE(sum(changes), 0)::bigint AS changes FROM area_versions '
+        if area is not None:
+            sql += 'WHERE area = %(area)s'
+        values = {'area': area}
+        return self._execute_query(sql, values, name=f'find_users_version_{area is not None:d}',
+                                   idempotent=True)
 
     def find_users_by_area(self, area) -> List[RealDictRow]:
+        sql = f'''
+            SELECT {USER_FIELDS} FROM users
+            WHERE area = %(area)s
+        '''
+        values = {'area': area}
+        return self._execute_query(sql, values, fetch=Fetch.ALL, name='find_users_by_area',
+                                   idempotent=True)
+
+    def find_users_rows(self, area=None) -> List[tuple]:
+        # Plain tuples in USER_COLUMNS order, which skip building a dict per row
+        sql = USERS_ROWS_SQL
+        if area is not None:
+            sql += 'WHERE area = %(area)s'
+        values = {'area': area}
+        return self._execute_query(sql, values, fetch=Fetch.ALL, name=f'find_users_rows_{area is not None:d}',
+                                   cursor_factory=None, idempotent=True)
+
+    def find_users_json(self, area=None) -> str:
+        sql = USERS_JSON_SQL
+        if area is not None:
+            sql += 'WHERE area = %(area)s'
+        values = {'area': area}
+        return self._execute_query(sql, values, name=f'find_users_json_{area is not None:d}',
+                                   idempotent=True)['users']
+
+    def find_users_page(self, area=None, after=None, limit=100) -> List[RealDictRow]:
+        sql = f'SELECT {USER_FIELDS} FROM users WHERE TRUE '
+        if area is not None:
+            sql += 'AND area = %(area)s '
+        if after is not None:
+            sql += 'AND uuid > %(after)s '
+        sql += 'ORDER BY uuid LIMIT %(limit)s'
+        values = {
+            'area': area,
+            'after': after,
+            'limit': limit
+        }
+        name = f'find_users_page_{area is not None:d}{after is not None:d}'
+        return self._execute_query(sql, values, fetch=Fetch.ALL, name=name, idempotent=True)
+
+    def find_areas(self) -> List[RealDictRow]:
+        sql = '''
+            SELECT * FROM area_stats
+            ORDER BY area
+        '''
+        return self._execute_query(sql, fetch=Fetch.ALL, name='find_areas', idempotent=True)
+
+    def find_area_stats(self, area) -> Optional[RealDictRow]:
+        # Maintained by triggers on users in the writing transaction, so a single row lookup whatever the area size
         sql = '''
-            SELECT * FROM users
+            SELECT * FROM area_stats
             WHERE area = %(area)s
         '''
         values = {'area': area}
-        return self._execute_query(sql, values, fetch=Fetch.ALL)
+        return self._execute_query(sql, values, name='find_area_stats', idempotent=True)
+
+    def find_users_changed(self, since: datetime, after=None, area=None, limit=100) -> List[RealDictRow]:
+        # From `since` on, or past the (since, after) position of a previous page
+        sql = CHANGES_SQL.format(users=changes_condition('updated_at', area, after),
+                                 tombstones=tombstones_condition(area, after))
+        values = {
+            'since': since,
+            'after': after,
+            'area': area,
+            'lag': self.feed_lag,
+            'limit': limit
+        }
+        name = f'find_users_changed_{area is not None:d}{after is not None:d}'
+        return self._execute_query(sql, values, fetch=Fetch.ALL, name=name, idempotent=True)
+
+    def iter_users(self, area=None, chunk_size=1000) -> Iterator[List[RealDictRow]]:
+        sql = f'SELECT {USER_FIELDS} FROM users '
+        if area is not None:
+            sql += 'WHERE area = %(area)s '
+        sql += 'ORDER BY uuid'
+        values = {'area': area}
+        # A named (server-side) cursor only keeps one chunk of rows in memory at a time
+        with self.pool.connection() as connection:
+            with connection.cursor(name='iter_users', cursor_factory=RealDictCursor) as cursor:
+                cursor.execute(sql, values)
+                while rows := cursor.fetchmany(chunk_size):
+                    yield rows
+            connection.commit()
 
     def update_user(self, uuid, delta=None, area=None) -> RealDictRow:
-        sql = 'UPDATE users SET updated_at = NOW() '
+        sql = '''
+            WITH old AS (
+                SELECT uuid, area FROM users
+                WHERE uuid = %(uuid)s
+                FOR UPDATE
+            )
+            UPDATE users SET updated_at = NOW()
+        '''
         if area is not None:
             sql += ', area = %(area)s '
         if delta is not None:
             sql += ', delta = %(delta)s '
-        sql += 'WHERE uuid = %(uuid)s '
-        sql += '''
-            RETURNING *, (
-                SELECT area FROM users WHERE uuid = %(uuid)s
-            ) AS old_area
+        sql += f'''
+            FROM old
+            WHERE users.uuid = old.uuid
+            RETURNING {UPDATED_USER_FIELDS}, old.area AS old_area
         '''
+        sql = self._with_events(sql, UPDATE_EVENTS)
         values = {
             'uuid': uuid,
             'delta': delta,
             'area': area
         }
-        return self._execute_query(sql, values)
+        # One prepared variant per combination of updated columns
+        name = f'update_user_{area is not None:d}{delta is not None:d}'
+        return self._execute_query(sql, values, name=name)
 
     def insert_user(self, uuid, delta=None, area=None) -> RealDictRow:
         delta = delta or 0
         area = area or ''
-        sql = '''
+        sql = f'''
             INSERT INTO users(uuid, delta, area)
             VALUES (%(uuid)s, %(delta)s, %(area)s)
-            RETURNING *
+            ON CONFLICT (uuid) DO NOTHING
+            RETURNING {USER_FIELDS}
         '''
+        sql = self._with_events(sql, CREATE_EVENTS)
         values = {
             'uuid': uuid,
             'delta': delta,
             'area': area
         }
-        return self._execute_query(sql, values)
+        return self._execute_query(sql, values, name='insert_user')
 
     def delete_user(self, uuid) -> RealDictRow:
-        sql = '''
+        sql = f'''
             DELETE FROM users
             WHERE uuid = %(uuid)s
-            RETURNING *
+            RETURNING {USER_FIELDS}
         '''
+        sql = self._with_events(sql, DELETE_EVENTS)
         values = {'uuid': uuid}
-        return self._execute_query(sql, values)
+        return self._execute_query(sql, values, name='delete_user')
+
+    def bulk_write(self, operations: List[dict]) -> List[Optional[RealDictRow]]:
+        results = [None] * len(operations)
+        try:
+            with timed(self._query_latency('bulk_write')), self._transaction() as cursor:
+                for batch in bulk_batches(operations):
+                    sql, template, events = BULK_SQL[batch[0][1]['action']]
+                    rows = execute_values(
+                        cursor, self._with_events(sql, events), [operation for _, operation in batch],
+                        template=template, page_size=len(batch), fetch=True
+                    )
+                    rows = {row['uuid']: row for row in rows}
+                    for index, operation in batch:
+                        results[index] = rows.get(operation['uuid'])
+            return results
+
+        except Error as e:
+            logger.exception(f'Failed to execute {len(operations)} bulk operations')
+            raise e
+
+    def dispatch_events(self, publish: Callable[[List[RealDictRow]], int], limit: int) -> int:
+        with timed(self._query_latency('dispatch_events')):
+            with self._transaction() as cursor:
+                cursor.execute(CLAIM_EVENTS_SQL, {'limit': limit, 'lease': self.claim_lease})
+                events = sorted(cursor.fetchall(), key=lambda event: event['id'])
+            if not events:
+                return 0
+            sent = 0
+            try:
+                # Only the first `sent` events are known to have reached the broker
+                sent = publish(events)
+            finally:
+                # The rest are released for the next tick
+                with self._transaction() as cursor:
+                    cursor.execute(
+                        SETTLE_EVENTS_SQL,
+                        {'sent': [event['id'] for event in events[:sent]], 'ids': [event['id'] for event in events]}
+                    )
+            return sent
@@ -0,0 +1,78 @@
+from logging import getLogger
+from os import getenv
+from threading import Event, Thread
+from time import monotonic
+from typing import List, Optional
+
+from paho.mqtt.client import MQTT_ERR_NO_CONN, MQTT_ERR_SUCCESS, MQTTMessageInfo
+from psycopg2.extras import RealDictRow
+
+from .codec import acknowledged_prefix, encode_events
+from .connection import CircuitOpen
+from .database import Database
+from .publisher import Publisher
+
+logger = getLogger()
+
+
+class Dispatcher(Thread):
+
+    def __init__(self, db: Database, publisher: Optional[Publisher] = None, batch_size=None, interval=None,
+                 ack_timeout=None, event_format=None, envelope_size=None):
+        super().__init__(name='outbox-dispatcher', daemon=True)
+        self.db = db
+        self.publisher = publisher or Publisher()
+        self.batch_size = batch_size or int(getenv('OUTBOX_BATCH_SIZE', 500))
+        self.interval = interval if interval is not None else float(getenv('OUTBOX_INTERVAL', 0.1))
+        self.ack_timeout = ack_timeout if ack_timeout is not None else float(getenv('OUTBOX_ACK_TIMEOUT', 5))
+        self.event_format = event_format or getenv('EVENT_FORMAT', 'json')
+        # Events of one area fetched in the same tick go out as envelopes of up to this many, 0 sends one by one
+        self.envelope_size = envelope_size if envelope_size is not None else int(getenv('OUTBOX_ENVELOPE_SIZE', 0))
+        self.dispatched = 0
+        self.messages = 0
+        self._stopped = Event()
+
+    def run(self):
+        self.publisher.start()
+        while not self._stopped.is_set():
+            sent = 0
+            if self.publisher.is_connected():
+                try:
+                    sent = self.db.dispatch_events(self.publish, limit=self.batch_size)
+                except CircuitOpen:
+                    # The outage was already logged when the breaker opened
+                    pass
+                except Exception:
+                    logger.exception('Failed to dispatch outbox events')
+            # Keep draining without pause while there is a backlog
+            if sent < self.batch_size:
+                self._stopped.wait(self.interval)
+        self.publisher.stop()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _acknowledged(self, info: MQTTMessageInfo, deadline) -> bool:
+        if info.rc == MQTT_ERR_NO_CONN and self.publisher.qos > 0:
+            # Handed off: paho delivers it once reconnected, publishing it again on the next tick would duplicate it
+            return True
+        if info.rc != MQTT_ERR_SUCCESS:
+            return False
+        return self.publisher.wait_published(info, max(0.0, deadline - monotonic()))
+
+    def publish(self, events: List[RealDictRow]) -> int:
+        # An event may be carried by more than one message, one per configured format
+        groups = encode_events(events, self.event_format, self.envelope_size)
+        infos = [[self.publisher.send(topic=topic, payload=payload) for topic, payload in messages]
+                 for _, messages in groups]
+        deadline = monotonic() + self.ack_timeout
+        sent = acknowledged_prefix(groups, [all(self._acknowledged(info, deadline) for info in group_infos)
+                                            for group_infos in infos])
+        self.dispatched += sent
+        self.messages += sum(map(len, infos))
+        if sent < len(events):
+            logger.warning(f'Broker acknowledged {sent} of {len(events)} events, the rest will be retried')
+        return sent
+
+    def stats(self):
+        return {'dispatched': self.dispatched, 'messages': self.messages, 'publisher': self.publisher.stats()}
@@ -0,0 +1,442 @@
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timezone
+from decimal import Decimal, ROUND_HALF_UP
+from logging import getLogger
+from os import fsync, getenv, path, replace
+from threading import Lock
+from time import time_ns
+from typing import Callable, Dict, Iterator, List, Optional
+
+from psycopg2 import DataError
+from ujson import dumps, loads
+
+logger = getLogger()
+
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+class User:
+    __slots__ = ('uuid', 'delta', 'area', 'created_at', 'updated_at', 'version')
+
+    def __init__(self, uuid, delta, area, created_at, updated_at, version=0):
+        self.uuid = uuid
+        self.delta = delta
+        self.area = area
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.version = version
+
+    def as_dict(self, **extra) -> dict:
+        # The version stays internal, as it does in the postgres responses
+        return {'uuid': self.uuid, 'delta': self.delta, 'area': self.area, 'created_at': self.created_at,
+                'updated_at': self.updated_at, **extra}
+
+    def as_row(self) -> tuple:
+        return self.uuid, self.delta, self.area, self.created_at, self.updated_at
+
+    def as_record(self) -> list:
+        return ['put', self.uuid, self.delta, self.area, self.created_at.isoformat(), self.updated_at.isoformat(),
+                self.version]
+
+
+class Journal:
+    # Append-only log of changes, rewritten as a compact snapshot of the current state when opened
+
+    def __init__(self, file_path, sync=False):
+        self.path = file_path
+        self.sync = sync
+        self._file = None
+
+    def replay(self) -> Iterator[list]:
+        if not path.exists(self.path):
+            return
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    yield loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid-write
+                    logger.warning(f'Ignoring corrupt record in "{self.path}"')
+
+    def open(self, records: Iterator[list]):
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as file:
+            file.writelines(dumps(record) + '\n' for record in records)
+            file.flush()
+            fsync(file.fileno())
+        replace(temporary, self.path)
+        self._file = open(self.path, 'a')
+
+    def append(self, *records):
+        self._file.write(''.join(dumps(record) + '\n' for record in records))
+        self._file.flush()
+        if self.sync:
+            fsync(self._file.fileno())
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+
+def _integer(value) -> Optional[int]:
+    # Coerced the way Postgres assigns a parameter to the integer delta column
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise DataError(f'cannot coerce {type(value).__name__} to integer')
+    try:
+        number = int(Decimal(str(value).strip()).to_integral_value(ROUND_HALF_UP))
+    except (ArithmeticError, ValueError):
+        raise DataError(f'invalid input syntax for type integer: "{value}"')
+    if not INT_MIN <= number <= INT_MAX:
+        raise DataError('integer out of range')
+    return number
+
+
+def _text(value) -> Optional[str]:
+    # Coerced the way Postgres assigns a parameter to the text area column
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, (int, float)):
+        return str(value)
+    raise DataError(f'cannot coerce {type(value).__name__} to text')
+
+
+class MemoryDatabase:
+    def __init__(self, outbox: bool = False, snapshot_path=None):
+        self.outbox = outbox
+        self.closed = False
+        self._users: Dict[str, User] = {}
+        # Uuids in sorted order, overall and per area
+        self._uuids: List[str] = []
+        self._areas: Dict[str, List[str]] = {}
+        # Deltas in sorted order and their sum, per non-empty area
+        self._area_deltas: Dict[str, List[int]] = {}
+        self._area_sums: Dict[str, int] = {}
+        # Deletion time and whether the user was deleted rather than moved, per uuid and area it left. And the
+        # (timestamp, uuid) of every user and tombstone in change feed order, a key repeating when several share it.
+        self._tombstones: Dict[str, Dict[str, tuple]] = {}
+        self._changes: List[tuple] = []
+        self._events: List[dict] = []
+        self._last_event_id = 0
+        # Collection versions: a counter bumped by every write, and its value at the latest write to each area. It
+        # starts from the clock, so that tags handed out before a restart never come back.
+        self._version = time_ns() // 1000
+        self._area_versions: Dict[str, int] = {}
+        self._lock = Lock()
+        self._dispatch_lock = Lock()
+        snapshot_path = snapshot_path if snapshot_path is not None else getenv('STORAGE_SNAPSHOT_PATH', '')
+        self._journal = None
+        if snapshot_path:
+            self._journal = Journal(snapshot_path, sync='true' == getenv('STORAGE_SNAPSHOT_FSYNC', 'false'))
+            self._restore()
+
+    def _restore(self):
+        for record in self._journal.replay():
+            kind = record[0]
+            if 'put' == kind:
+                # Journals written before users had a version lack the last field
+                _, uuid, delta, area, created_at, updated_at, *version = record
+                self._put(User(uuid, delta, area, datetime.fromisoformat(created_at),
+                               datetime.fromisoformat(updated_at), *version))
+            elif 'del' == kind:
+                # Journals written before the change feed lack the area and deletion time
+                _, uuid, *tombstone = record
+                self._remove(uuid)
+                if tombstone:
+                    self._bury(uuid, tombstone[0], datetime.fromisoformat(tombstone[1]))
+            elif 'tomb' == kind:
+                # Journals written before moves left tombstones only hold deletions
+                _, uuid, area, deleted_at, *deleted = record
+                self._bury(uuid, area, datetime.fromisoformat(deleted_at), *deleted)
+            elif 'event' == kind:
+                _, event_id, area, action, uuid, delta = record
+                self._events.append({'id': event_id, 'area': area, 'action': action, 'uuid': uuid, 'delta': delta})
+                self._last_event_id = max(self._last_event_id, event_id)
+            elif 'sent' == kind:
+                self._events = [event for event in self._events if event['id'] > record[1]]
+        self._journal.open(self._snapshot())
+        logger.info(f'Restored {len(self._users)} users and {len(self._events)} unsent events')
+
+    def _snapshot(self) -> Iterator[list]:
+        for user in self._users.values():
+            yield user.as_record()
+        for uuid, tombstones in self._tombstones.items():
+            for area, (deleted_at, deleted) in tombstones.items():
+                yield ['tomb', uuid, area, deleted_at.isoformat(), deleted]
+        for event in self._events:
+            yield ['event', event['id'], event['area'], event['action'], event['uuid'], event['delta']]
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            if self._journal:
+                self._journal.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'users': len(self._users),
+                'areas': len(self._areas),
+                'pending_events': len(self._events),
+            }
+
+    def _put(self, user: User):
+        old = self._users.get(user.uuid)
+        if old is None:
+            insort(self._uuids, user.uuid)
+            # The user exists again, wherever it was deleted from it now only moved away
+            for area, (deleted_at, _) in self._tombstones.get(user.uuid, {}).items():
+                self._tombstones[user.uuid][area] = (deleted_at, False)
+        else:
+            self._unaggregate(old)
+            self._unchange(old.updated_at, user.uuid)
+            if old.area != user.area:
+                self._unindex(old.area, user.uuid)
+                self._bury(user.uuid, old.area, user.updated_at, False)
+        if old is None or old.area != user.area:
+            insort(self._areas.setdefault(user.area, []), user.uuid)
+            self._unbury(user.uuid, user.area)
+        self._aggregate(user)
+        insort(self._changes, (user.updated_at, user.uuid))
+        self._users[user.uuid] = user
+        self._bump(user.area, old.area if old else user.area)
+
+    def _remove(self, uuid) -> Optional[User]:
+        user = self._users.pop(uuid, None)
+        if user:
+            del self._uuids[bisect_left(self._uuids, uuid)]
+            self._unindex(user.area, uuid)
+            self._unaggregate(user)
+            self._unchange(user.updated_at, uuid)
+            self._bump(user.area)
+        return user
+
+    def _bump(self, *areas):
+        self._version += 1
+        for area in areas:
+            self._area_versions[area] = self._version
+
+    def _bury(self, uuid, area, deleted_at, deleted=True):
+        self._unbury(uuid, area)
+        self._tombstones.setdefault(uuid, {})[area] = (deleted_at, deleted)
+        insort(self._changes, (deleted_at, uuid))
+
+    def _unbury(self, uuid, area):
+        tombstones = self._tombstones.get(uuid, {})
+        if tombstone := tombstones.pop(area, None):
+            self._unchange(tombstone[0], uuid)
+            if not tombstones:
+                del self._tombstones[uuid]
+
+    def _unchange(self, timestamp, uuid):
+        del self._changes[bisect_left(self._changes, (timestamp, uuid))]
+
+    def _unindex(self, area, uuid):
+        uuids = self._areas[area]
+        del uuids[bisect_left(uuids, uuid)]
+        if not uuids:
+            del self._areas[area]
+
+    def _aggregate(self, user: User):
+        if user.area:
+            insort(self._area_deltas.setdefault(user.area, []), user.delta)
+            self._area_sums[user.area] = self._area_sums.get(user.area, 0) + user.delta
+
+    def _unaggregate(self, user: User):
+        if user.area:
+            deltas = self._area_deltas[user.area]
+            del deltas[bisect_left(deltas, user.delta)]
+            self._area_sums[user.area] -= user.delta
+            if not deltas:
+                del self._area_deltas[user.area]
+                del self._area_sums[user.area]
+
+    def _area_stats(self, area) -> dict:
+        deltas = self._area_deltas[area]
+        return {'area': area, 'users': len(deltas), 'delta_sum': self._area_sums[area], 'delta_min': deltas[0],
+                'delta_max': deltas[-1]}
+
+    def _event(self, records, action, user: User, area=None):
+        area = user.area if area is None else area
+        if self.outbox and area:
+            self._last_event_id += 1
+            event = {'id': self._last_event_id, 'area': area, 'action': action, 'uuid': user.uuid,
+                     'delta': user.delta}
+            self._events.append(event)
+            records.append(['event', event['id'], area, action, user.uuid, user.delta])
+
+    def _journaled(self, records):
+        if self._journal and records:
+            self._journal.append(*records)
+
+    def find_all_users(self) -> List[dict]:
+        with self._lock:
+            return [user.as_dict() for user in self._users.values()]
+
+    def find_user(self, uuid) -> Optional[dict]:
+        user = self._users.get(uuid)
+        return user.as_dict() if user else None
+
+    def find_user_version(self, uuid) -> Optional[datetime]:
+        user = self._users.get(uuid)
+        return user.updated_at if user else None
+
+    def find_users_version(self, area=None) -> dict:
+        with self._lock:
+            return {'changes': self._version if area is None else self._area_versions.get(area, 0)}
+
+    def find_users_by_area(self, area) -> List[dict]:
+        with self._lock:
+            return [self._users[uuid].as_dict() for uuid in self._areas.get(area, ())]
+
+    def find_users_rows(self, area=None) -> List[tuple]:
+        # Tuples in the users table column order, as the postgres backend returns them
+        with self._lock:
+            uuids = self._users if area is None else self._areas.get(area, ())
+            return [self._users[uuid].as_row() for uuid in uuids]
+
+    def find_users_page(self, area=None, after=None, limit=100) -> List[dict]:
+        with self._lock:
+            uuids = self._uuids if area is None else self._areas.get(area, [])
+            start = 0 if after is None else bisect_right(uuids, after)
+            return [self._users[uuid].as_dict() for uuid in uuids[start:start + limit]]
+
+    def find_areas(self) -> List[dict]:
+        with self._lock:
+            return [self._area_stats(area) for area in sorted(self._area_deltas)]
+
+    def find_area_stats(self, area) -> Optional[dict]:
+        with self._lock:
+            return self._area_stats(area) if area in self._area_deltas else None
+
+    def _change(self, timestamp, uuid, area=None) -> Optional[dict]:
+        # The user or tombstone that a (timestamp, uuid) key of the feed stands for, at most one per feed
+        user = self._users.get(uuid)
+        if user and user.updated_at == timestamp and area in (None, user.area):
+            return user.as_dict(deleted=False)
+        # Only the feed of an area reports users that moved out of it, they still exist for everybody else
+        for tombstone_area, (deleted_at, deleted) in self._tombstones.get(uuid, {}).items():
+            if deleted_at == timestamp and (tombstone_area == area if area is not None else deleted):
+                return {'uuid': uuid, 'delta': None, 'area': tombstone_area, 'created_at': None,
+                        'updated_at': deleted_at, 'deleted': True}
+        return None
+
+    def find_users_changed(self, since: datetime, after=None, area=None, limit=100) -> List[dict]:
+        # Writes are serialized here, so unlike in postgres no change can appear behind the newest one
+        with self._lock:
+            if after is None:
+                start = bisect_left(self._changes, (since,))
+            else:
+                start = bisect_right(self._changes, (since, after))
+            result = []
+            for index in range(start, len(self._changes)):
+                if len(result) == limit:
+                    break
+                if index > start and self._changes[index] == self._changes[index - 1]:
+                    continue
+                if change := self._change(*self._changes[index], area):
+                    result.append(change)
+            return result
+
+    def iter_users(self, area=None, chunk_size=1000) -> Iterator[List[dict]]:
+        after = None
+        while rows := self.find_users_page(area=area, after=after, limit=chunk_size):
+            yield rows
+            after = rows[-1]['uuid']
+
+    def _update(self, records, now, uuid, delta=None, area=None, version=None) -> Optional[dict]:
+        if not (old := self._users.get(uuid)):
+            return None
+        # A versioned update only applies over an older version
+        if version is not None and old.version >= version:
+            return None
+        user = User(uuid, old.delta if delta is None else delta, old.area if area is None else area,
+                    old.created_at, now, old.version if version is None else version)
+        records.append(user.as_record())
+        if user.area != old.area:
+            self._event(records, 'delete', user, old.area)
+            self._event(records, 'create', user)
+        else:
+            self._event(records, 'update', user)
+        self._put(user)
+        return user.as_dict(old_area=old.area)
+
+    def _insert(self, records, now, uuid, delta=None, area=None) -> Optional[dict]:
+        if uuid in self._users:
+            return None
+        user = User(uuid, delta or 0, area or '', now, now)
+        records.append(user.as_record())
+        self._event(records, 'create', user)
+        self._put(user)
+        return user.as_dict()
+
+    def _delete(self, records, now, uuid) -> Optional[dict]:
+        if not (user := self._remove(uuid)):
+            return None
+        self._bury(uuid, user.area, now)
+        records.append(['del', uuid, user.area, now.isoformat()])
+        self._event(records, 'delete', user)
+        return user.as_dict()
+
+    def _write(self, write, *args, **kwargs):
+        records = []
+        with self._lock:
+            result = write(records, datetime.now(timezone.utc), *args, **kwargs)
+            self._journaled(records)
+            return result
+
+    def update_user(self, uuid, delta=None, area=None, version=None) -> Optional[dict]:
+        return self._write(self._update, uuid, delta=_integer(delta), area=_text(area), version=version)
+
+    def insert_user(self, uuid, delta=None, area=None) -> Optional[dict]:
+        return self._write(self._insert, uuid, delta=_integer(delta), area=_text(area))
+
+    def delete_user(self, uuid) -> Optional[dict]:
+        return self._write(self._delete, uuid)
+
+    def update_users(self, deltas: Dict[str, int], versions: Optional[Dict[str, int]] = None) -> int:
+        deltas = {uuid: _integer(delta) for uuid, delta in deltas.items()}
+        versions = versions or {}
+
+        def update_all(records, now):
+            return sum(self._update(records, now, uuid, delta=delta, version=versions.get(uuid)) is not None
+                       for uuid, delta in deltas.items())
+        return self._write(update_all)
+
+    def bulk_write(self, operations: List[dict]) -> List[Optional[dict]]:
+        # Coerced up front so that, as in one SQL transaction, either every operation applies or none does
+        operations = [
+            {**operation, 'delta': _integer(operation['delta']), 'area': _text(operation['area'])}
+            if operation['action'] != 'delete' else operation
+            for operation in operations
+        ]
+        writes = {
+            'create': lambda records, now, operation: self._insert(records, now, operation['uuid'],
+                                                                   operation['delta'], operation['area']),
+            'update': lambda records, now, operation: self._update(records, now, operation['uuid'],
+                                                                   operation['delta'], operation['area']),
+            'delete': lambda records, now, operation: self._delete(records, now, operation['uuid']),
+        }
+
+        def write_all(records, now):
+            return [writes[operation['action']](records, now, operation) for operation in operations]
+        return self._write(write_all)
+
+    def dispatch_events(self, publish: Callable[[List[dict]], int], limit: int) -> int:
+        # Publishing happens outside the data lock, so a slow broker never blocks writes
+        with self._dispatch_lock:
+            with self._lock:
+                events = self._events[:limit]
+            if not events:
+                return 0
+            # Only the first `sent` events are known to have reached the broker
+            sent = publish(events)
+            if sent:
+                with self._lock:
+                    del self._events[:sent]
+                    self._journaled([['sent', events[sent - 1]['id']]])
+            return sent
@@ -0,0 +1,141 @@
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from typing import Dict, List, Sequence, Tuple, Union
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS, window: int = 1024):
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._samples = deque(maxlen=window)
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.bucket_counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+            self._samples.append(value)
+
+    def percentile(self, q: float) -> float:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        index = min(len(samples) - 1, max(0, round(q / 100 * len(samples)) - 1))
+        return samples[index]
+
+    def cumulative(self) -> Tuple[List[Tuple[float, int]], float, int]:
+        # Observations at or below each bucket bound, with sum and count taken at the same instant
+        with self._lock:
+            counts, total, count = list(self.bucket_counts), self.sum, self.count
+        cumulative, running = [], 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            running += bucket_count
+            cumulative.append((bound, running))
+        return cumulative, total, count
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+
+Metric = Union[Histogram, Counter]
+
+
+@contextmanager
+def timed(histogram: Histogram):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(perf_counter() - start)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, **extra) -> str:
+    labels = {**dict(labels), **extra}
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Tuple[str, Dict[Tuple, Metric]]] = {}
+        self._lock = Lock()
+
+    def register(self, name, description, metric: Metric, **labels) -> Metric:
+        # Replaces whatever was registered before under the same name and labels
+        with self._lock:
+            self._metrics.setdefault(name, (description, {}))[1][tuple(sorted(labels.items()))] = metric
+        return metric
+
+    def _get(self, factory, name, description, **labels) -> Metric:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metrics = self._metrics.setdefault(name, (description, {}))[1]
+            if key not in metrics:
+                metrics[key] = factory()
+            return metrics[key]
+
+    def histogram(self, name, description, **labels) -> Histogram:
+        return self._get(Histogram, name, description, **labels)
+
+    def counter(self, name, description, **labels) -> Counter:
+        return self._get(Counter, name, description, **labels)
+
+    def render(self) -> str:
+        # Prometheus text exposition format 0.0.4
+        with self._lock:
+            metrics = [(name, description, list(values.items()))
+                       for name, (description, values) in sorted(self._metrics.items())]
+        lines = []
+        for name, description, values in metrics:
+            lines.append(f'# HELP {name} {description}')
+            if isinstance(values[0][1], Counter):
+                lines.append(f'# TYPE {name} counter')
+                lines.extend(f'{name}{_labels(labels)} {counter.value}' for labels, counter in values)
+                continue
+            lines.append(f'# TYPE {name} histogram')
+            for labels, histogram in values:
+                cumulative, total, count = histogram.cumulative()
+                for bound, bucket_count in cumulative:
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f'{name}_bucket{_labels(labels, le=le)} {bucket_count}')
+                lines.append(f'{name}_sum{_labels(labels)} {total}')
+                lines.append(f'{name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
@@ -0,0 +1,166 @@
+from collections import deque
+from contextlib import contextmanager
+from logging import getLogger
+from os import getenv
+from threading import Condition
+from time import monotonic
+from typing import Optional
+
+from psycopg2 import connect, Error
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.pool import PoolError
+
+from .connection import CircuitBreaker
+from .metrics import REGISTRY, Histogram
+
+logger = getLogger()
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, connection_conf=None, min_size=None, max_size=None, timeout=None,
+                 health_check_interval=None, connections=None, breaker: Optional[CircuitBreaker] = None):
+        self.connection_conf = connection_conf or {
+            'user': getenv('POSTGRES_USER'),
+            'password': getenv('POSTGRES_PASSWORD'),
+            'host': getenv('POSTGRES_HOST'),
+            'port': getenv('POSTGRES_PORT'),
+            'dbname': getenv('POSTGRES_DB'),
+            'connect_timeout': getenv('POSTGRES_CONNECT_TIMEOUT', 5),
+        }
+        self.min_size = min_size if min_size is not None else int(getenv('POSTGRES_POOL_MIN', 1))
+        self.max_size = max(self.min_size, max_size or int(getenv('POSTGRES_POOL_MAX', 10)))
+        self.timeout = timeout if timeout is not None else float(getenv('POSTGRES_POOL_TIMEOUT', 30))
+        self.health_check_interval = health_check_interval if health_check_interval is not None \
+            else float(getenv('POSTGRES_POOL_HEALTH_CHECK_INTERVAL', 30))
+        self.breaker = breaker or CircuitBreaker()
+        self.closed = False
+        self.discarded = 0
+        self.wait_time = REGISTRY.register('userservice_db_pool_wait_seconds',
+                                           'Time spent waiting for a pooled connection', Histogram())
+        self._idle = deque()
+        self._size = 0
+        self._in_use = 0
+        self._condition = Condition()
+        # Connections idle since before a connection was last found broken are probed before reuse
+        self._lost_at = float('-inf')
+
+        for connection in connections or ():
+            self._idle.append((connection, monotonic()))
+            self._size += 1
+        while self._size < self.min_size:
+            self._idle.append((self._connect(), monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        # Fails fast without touching the network while the database is known to be down
+        connection = self.breaker.call(lambda: connect(**self.connection_conf))
+        logger.info('Successfully connected to database')
+        return connection
+
+    def _is_healthy(self, connection, idle_since) -> bool:
+        if connection.closed or connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            return False
+        if monotonic() - idle_since < self.health_check_interval and idle_since > self._lost_at:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except Error:
+            return False
+
+    def _discard(self, connection):
+        self.discarded += 1
+        try:
+            connection.close()
+        except Error:
+            pass
+
+    def getconn(self):
+        start = monotonic()
+        deadline = start + self.timeout
+        with self._condition:
+            while True:
+                if self.closed:
+                    raise PoolError('Connection pool is closed')
+                if self._idle:
+                    # LIFO, so that the most recently used connections are kept warm
+                    connection, idle_since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    connection, idle_since = None, None
+                    self._size += 1
+                    break
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f'Timed out after {self.timeout}s waiting for a database connection')
+                self._condition.wait(remaining)
+            self._in_use += 1
+        self.wait_time.observe(monotonic() - start)
+
+        try:
+            if connection is not None and not self._is_healthy(connection, idle_since):
+                logger.warning('Discarding unhealthy database connection')
+                self._discard(connection)
+                connection = None
+            return connection or self._connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+    def putconn(self, connection, discard=False):
+        if not (discard or connection.closed) and connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except Error:
+                discard = True
+        with self._condition:
+            self._in_use -= 1
+            if connection.closed and not self.closed:
+                # A failover or restart usually breaks every connection of the pool at once
+                self._lost_at = monotonic()
+            if discard or connection.closed or self.closed:
+                self._size -= 1
+                self._discard(connection)
+            else:
+                self._idle.append((connection, monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        connection = self.getconn()
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+    def closeall(self):
+        with self._condition:
+            self.closed = True
+            while self._idle:
+                connection, _ = self._idle.pop()
+                self._size -= 1
+                connection.close()
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            stats = {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'discarded': self.discarded,
+            }
+        stats['wait_time'] = self.wait_time.snapshot()
+        stats['circuit'] = self.breaker.stats()
+        return stats
@@ -0,0 +1,102 @@
+from logging import getLogger
+from os import getenv
+from threading import Event, Lock
+from time import perf_counter
+
+from paho.mqtt.client import Client, MQTTMessageInfo, MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN
+
+from .metrics import REGISTRY, Histogram
+
+logger = getLogger()
+
+
+class Publisher(Client):
+
+    def __init__(self, host=None, port=None, qos=None, max_queue_size=None):
+        super().__init__()
+        self.host = host or getenv('BROKER_HOST', 'mosquitto')
+        self.port = port or int(getenv('BROKER_PORT', 1884))
+        self.qos = qos if qos is not None else int(getenv('USERSERVICE_QOS', 0))
+        self.max_queued_messages_set(max_queue_size or int(getenv('BROKER_MAX_QUEUE', 10000)))
+        self.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.on_connect = self.pub_on_connect
+        self.on_disconnect = self.pub_on_disconnect
+        self.on_publish = self.pub_on_publish
+        self.dropped = 0
+        self.latency = REGISTRY.register('userservice_mqtt_publish_seconds',
+                                         'Time from publish until the broker acknowledged it', Histogram())
+        self._pending = {}
+        self._published = {}
+        # Set once the broker acknowledged the message, by mid
+        self._acks = {}
+        self._lock = Lock()
+
+    def start(self):
+        self.connect_async(host=self.host, port=self.port, keepalive=60)
+        self.loop_start()
+
+    def stop(self):
+        self.disconnect()
+        self.loop_stop()
+
+    def pub_on_connect(self, client, userdata, flags, rc):
+        logger.info('Successfully connected to mqtt broker.')
+
+    def pub_on_disconnect(self, client, userdata, rc):
+        if rc != MQTT_ERR_SUCCESS:
+            logger.warning(f'Lost connection to mqtt broker (rc={rc}), reconnecting.')
+
+    def pub_on_publish(self, client, userdata, mid):
+        now = perf_counter()
+        with self._lock:
+            start = self._pending.pop(mid, None)
+            if start is None:
+                # Acknowledged before send() got to record it
+                self._published[mid] = now
+                return
+            acked = self._acks.get(mid)
+        if acked:
+            acked.set()
+        self.latency.observe(now - start)
+
+    def send(self, topic, payload) -> MQTTMessageInfo:
+        start = perf_counter()
+        info = self.publish(topic=topic, payload=payload, qos=self.qos)
+        # With qos > 0 paho keeps the message queued until the broker is reachable again
+        if info.rc == MQTT_ERR_SUCCESS or (info.rc == MQTT_ERR_NO_CONN and self.qos > 0):
+            with self._lock:
+                published_at = self._published.pop(info.mid, None)
+                if published_at is None:
+                    self._pending[info.mid] = start
+                # A mid is reused once it wraps around, replacing the event of the earlier message
+                acked = self._acks[info.mid] = Event()
+            if published_at is not None:
+                acked.set()
+                self.latency.observe(published_at - start)
+        else:
+            self.dropped += 1
+            logger.warning(f'Dropped message for "{topic}" topic (rc={info.rc})')
+        return info
+
+    def wait_published(self, info: MQTTMessageInfo, timeout) -> bool:
+        # Unlike MQTTMessageInfo.wait_for_publish, gives up after timeout
+        with self._lock:
+            acked = self._acks.get(info.mid)
+        if acked is None:
+            return False
+        if not acked.wait(timeout):
+            return False
+        with self._lock:
+            if self._acks.get(info.mid) is acked:
+                del self._acks[info.mid]
+        return True
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'connected': self.is_connected(),
+            'pending': pending,
+            'dropped': self.dropped,
+            'latency': self.latency.snapshot(),
+        }
@@ -0,0 +1,56 @@
+from multiprocessing import cpu_count
+from os import getenv
+
+from gunicorn.app.base import BaseApplication
+
+from . import server as server_module
+
+
+def post_fork(arbiter, worker):
+    # Pool connections, the dispatcher and the broker clients are opened in each worker, never shared across a fork
+    server_module.server = server_module.init_server()
+
+
+def worker_exit(arbiter, worker):
+    if server_module.server:
+        server_module.server.close()
+        server_module.server = None
+
+
+def runner_options(port) -> dict:
+    # Every worker holds its own connection pool, so SERVER_THREADS should not exceed POSTGRES_POOL_MAX
+    workers = int(getenv('SERVER_WORKERS', 0)) or cpu_count()
+    if 'memory' == getenv('STORAGE_BACKEND', 'postgres'):
+        # The in-memory store lives in the worker, several would each hold different data
+        workers = 1
+    if workers > 1 and int(getenv('USER_CACHE_SIZE', 10000)) > 0 \
+            and 'mqtt' != getenv('USER_CACHE_INVALIDATION', 'mqtt'):
+        # A write handled by one worker would leave the old row in the caches of all the others
+        raise RuntimeError('Several server workers need USER_CACHE_INVALIDATION=mqtt, or USER_CACHE_SIZE=0')
+    return {
+        'bind': f'0.0.0.0:{port}',
+        'workers': workers,
+        'threads': int(getenv('SERVER_THREADS', 4)),
+        'worker_class': 'gthread',
+        'graceful_timeout': int(getenv('SERVER_GRACEFUL_TIMEOUT', 30)),
+        'keepalive': int(getenv('SERVER_KEEPALIVE', 5)),
+        'post_fork': post_fork,
+        'worker_exit': worker_exit,
+    }
+
+
+class ServerRunner(BaseApplication):
+    # Pre-forking gunicorn master: SIGHUP re-reads the environment and replaces the workers gracefully,
+    # SIGTERM lets in-flight requests finish for up to SERVER_GRACEFUL_TIMEOUT seconds
+
+    def __init__(self, app, port=80):
+        self.application = app
+        self.port = port
+        super().__init__()
+
+    def load_config(self):
+        for key, value in runner_options(self.port).items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
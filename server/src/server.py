@@ -1,32 +1,126 @@
+from datetime import datetime, timedelta, timezone
+from math import ceil
 from os import getenv
-from typing import Optional
+from time import perf_counter
+from typing import Optional, Tuple
 
-from flask import Blueprint, jsonify, request
-from paho.mqtt import publish
-from ujson import dumps
+from flask import Blueprint, Response, g, json, jsonify, request, stream_with_context, url_for
 
-from .database import Database
+from .cache import CacheInvalidator, UserCache
+from .connection import CircuitOpen
+from .database import USER_COLUMNS, Database
+from .dispatcher import Dispatcher
+from .memory import MemoryDatabase
+from .metrics import REGISTRY
+from .serializer import row_encoder
 
+BULK_MAX_OPERATIONS = int(getenv('BULK_MAX_OPERATIONS', 10000))
+PAGE_DEFAULT_LIMIT = int(getenv('PAGE_DEFAULT_LIMIT', 100))
+PAGE_MAX_LIMIT = int(getenv('PAGE_MAX_LIMIT', 1000))
+STREAM_CHUNK_SIZE = int(getenv('STREAM_CHUNK_SIZE', 1000))
 
-def send_update(user, action, area):
-    data = {'action': action, 'user': user}
-    publish.single(
-        topic=area,
-        payload=dumps(data),
-        hostname=getenv('BROKER_HOST', 'mosquitto'),
-        port=int(getenv('BROKER_PORT', 1884)),
-        keepalive=1
-    )
+# Per-item status codes, indexed by whether the operation affected a row
+BULK_STATUS = {
+    'create': (409, 201),
+    'update': (404, 200),
+    'delete': (404, 200),
+}
+
+# Range of the integer delta column
+DELTA_MIN, DELTA_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _microseconds(value: Optional[datetime]) -> int:
+    return (value - EPOCH) // timedelta(microseconds=1) if value else 0
+
+
+def user_etag(updated_at: datetime) -> str:
+    return f'{_microseconds(updated_at):x}'
+
+
+def users_etag(version) -> str:
+    return f'{version["changes"]:x}'
+
+
+def change_cursor(change) -> str:
+    # Exact to the microsecond, unlike the HTTP dates of the response body
+    return f'{_microseconds(change["updated_at"]):x}-{change["uuid"]}'
+
+
+def parse_change_cursor(cursor: str) -> Optional[Tuple[datetime, str]]:
+    microseconds, _, uuid = cursor.partition('-')
+    try:
+        return EPOCH + timedelta(microseconds=int(microseconds, 16)), uuid
+    except (ValueError, OverflowError):
+        return None
+
+
+def parse_timestamp(value: str) -> Optional[datetime]:
+    # ISO 8601, naive timestamps taken as UTC
+    try:
+        timestamp = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    except ValueError:
+        return None
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+
+
+def init_database(outbox: bool = False):
+    if 'memory' == getenv('STORAGE_BACKEND', 'postgres'):
+        return MemoryDatabase(outbox=outbox)
+    return Database(outbox=outbox)
+
+
+def init_cache() -> Optional[UserCache]:
+    if int(getenv('USER_CACHE_SIZE', 10000)) <= 0:
+        return None
+    cache = UserCache()
+    # The subscriber changes deltas behind the server's back, it announces them once committed on a topic every
+    # cache listens to. 'local' only suits a single server process with no other writer.
+    if 'mqtt' == getenv('USER_CACHE_INVALIDATION', 'mqtt'):
+        CacheInvalidator(cache).start()
+    return cache
 
 
 class UserServer:
-    def __init__(self, db: Optional[Database] = None, send_updates: bool = True):
-        self.db = db or Database()
+    def __init__(self, db: Optional[Database] = None, send_updates: bool = True,
+                 dispatcher: Optional[Dispatcher] = None, cache: Optional[UserCache] = None):
+        self.db = db or init_database(outbox=send_updates)
         self.send_updates = send_updates
+        self.dispatcher = dispatcher
+        self.cache = cache
+        # How GET /users builds its body: dict rows through jsonify, tuples through column encoders,
+        # or postgres rendering the JSON itself
+        self.serializer = getenv('USERS_SERIALIZER', 'tuple')
+        if send_updates and not dispatcher and 'thread' == getenv('OUTBOX_DISPATCHER', 'thread'):
+            self.dispatcher = Dispatcher(db=self.db)
+            self.dispatcher.start()
 
     def before_request(self):
-        if not (self.db and self.db.connection):
-            self.db = Database()
+        if not self.db or self.db.closed:
+            self.db = init_database(outbox=self.send_updates)
+
+    def close(self):
+        # Unsent events stay in the outbox for the next dispatcher
+        if self.dispatcher:
+            self.dispatcher.stop()
+            self.dispatcher.join()
+        self.db.close()
+
+    def stats(self):
+        result = {'database': self.db.stats()}
+        if self.dispatcher:
+            result['dispatcher'] = self.dispatcher.stats()
+        if self.cache:
+            result['cache'] = self.cache.stats()
+        return result, 200
+
+    def _invalidate(self, *uuids):
+        if self.cache:
+            for uuid in uuids:
+                self.cache.invalidate(uuid)
 
     def find_all_users(self, data=None):
         data = data or {}
@@ -36,60 +130,176 @@ class UserServer:
             result = self.db.find_all_users()
         return result, 200
 
+    def find_all_users_json(self, data=None):
+        area = self._area_filter(data or {})
+        if 'postgres' == self.serializer and hasattr(self.db, 'find_users_json'):
+            return self.db.find_users_json(area) + '\n', 200
+        return row_encoder(USER_COLUMNS).encode(self.db.find_users_rows(area)), 200
+
+    @staticmethod
+    def _page_limit(data) -> Optional[int]:
+        try:
+            limit = int(data.get('limit', PAGE_DEFAULT_LIMIT))
+        except ValueError:
+            return None
+        return limit if 0 < limit <= PAGE_MAX_LIMIT else None
+
+    @staticmethod
+    def _next_after(result, limit) -> Optional[str]:
+        return result[-1]['uuid'] if len(result) == limit else None
+
+    @staticmethod
+    def _found(result):
+        return result, 200 if result else 404
+
+    @staticmethod
+    def _area_filter(data) -> Optional[str]:
+        return data.get('area') or None
+
+    @staticmethod
+    def _changes_position(data) -> Optional[Tuple[int, datetime, Optional[str]]]:
+        # Limit, timestamp and uuid to resume the change feed from, None if any of them is malformed
+        if not (limit := UserServer._page_limit(data)) or not (since := parse_timestamp(data.get('updated_since', ''))):
+            return None
+        if not (cursor := data.get('after')):
+            return limit, since, None
+        if not (position := parse_change_cursor(cursor)):
+            return None
+        return (limit, *position)
+
+    @staticmethod
+    def _changes_next(result, data) -> Optional[str]:
+        # The cursor to resume from even on an empty page, so that a sync job can keep polling with it
+        return change_cursor(result[-1]) if result else data.get('after')
+
+    def _cached_user(self, uuid) -> Optional[dict]:
+        return self.cache.get(uuid) if self.cache else None
+
+    def _cache_user(self, uuid, result, generation):
+        if self.cache and result:
+            self.cache.put(uuid, result, generation)
+
+    def _cached_etag(self, uuid) -> Optional[str]:
+        # Only the version, from the cached row if there is one
+        result = self._cached_user(uuid)
+        return user_etag(result['updated_at']) if result else None
+
+    def find_users_page(self, data=None):
+        data = data or {}
+        if not (limit := self._page_limit(data)):
+            return None, 400, None
+
+        result = self.db.find_users_page(area=data.get('area'), after=data.get('after'), limit=limit)
+        return result, 200, self._next_after(result, limit)
+
+    def find_users_changed(self, data=None):
+        data = data or {}
+        if not (position := self._changes_position(data)):
+            return None, 400, None
+
+        limit, since, after = position
+        result = self.db.find_users_changed(since, after=after, area=self._area_filter(data), limit=limit)
+        return result, 200, self._changes_next(result, data)
+
+    def stream_users(self, data=None):
+        data = data or {}
+        for rows in self.db.iter_users(area=data.get('area'), chunk_size=STREAM_CHUNK_SIZE):
+            yield ''.join(json.dumps(row) + '\n' for row in rows)
+
     def find_user(self, uuid):
+        if result := self._cached_user(uuid):
+            return result, 200
+        generation = self.cache.generation if self.cache else None
         result = self.db.find_user(uuid)
-        return result, 200 if result else 404
+        self._cache_user(uuid, result, generation)
+        return self._found(result)
+
+    def find_user_etag(self, uuid) -> Optional[str]:
+        if etag := self._cached_etag(uuid):
+            return etag
+        updated_at = self.db.find_user_version(uuid)
+        return user_etag(updated_at) if updated_at else None
+
+    def find_all_users_etag(self, data=None) -> str:
+        return users_etag(self.db.find_users_version(self._area_filter(data or {})))
+
+    def find_areas(self):
+        return self.db.find_areas(), 200
+
+    def find_area_stats(self, area):
+        return self._found(self.db.find_area_stats(area))
+
+    def _written(self, uuid, result, code, failed_code=404):
+        self._invalidate(uuid)
+        return (result, code) if result else (None, failed_code)
 
     def update_user(self, uuid, data=None):
         data = data or {}
-        delta = data.get('delta')
-        area = data.get('area')
-
-        result = self.db.update_user(uuid=uuid, delta=delta, area=area)
-        if result:
-            if self.send_updates:
-                old_area = result.get('old_area')
-                user_data = {
-                    'uuid': result['uuid'],
-                    'delta': result['delta']
-                }
-                if area is not None and old_area != area:
-                    send_update(user=user_data, action='delete', area=old_area)
-                    send_update(user=user_data, action='create', area=area)
-                else:
-                    send_update(user=user_data, action='update', area=old_area)
-            return result, 200
-        else:
-            return None, 404
+        result = self.db.update_user(uuid=uuid, delta=data.get('delta'), area=data.get('area'))
+        return self._written(uuid, result, 200)
 
     def create_user(self, uuid, data=None):
         data = data or {}
-        area = data.get('area')
-        delta = data.get('delta')
-        if not self.db.find_user(uuid):
-            result = self.db.insert_user(uuid=uuid, delta=delta, area=area)
-            if self.send_updates:
-                user_data = {
-                    'uuid': result['uuid'],
-                    'delta': result['delta']
-                }
-                send_update(user=user_data, action='create', area=area)
-            return result, 201
-        else:
-            return None, 409
+        result = self.db.insert_user(uuid=uuid, delta=data.get('delta'), area=data.get('area'))
+        return self._written(uuid, result, 201, failed_code=409)
+
+    @staticmethod
+    def _bulk_fields_valid(item) -> bool:
+        # Checked here so that one malformed item is rejected alone, instead of failing the whole statement
+        delta, area = item.get('delta'), item.get('area')
+        if delta is not None and (isinstance(delta, bool) or not isinstance(delta, int)
+                                  or not DELTA_MIN <= delta <= DELTA_MAX):
+            return False
+        return area is None or isinstance(area, str)
+
+    @staticmethod
+    def _bulk_operations(data):
+        result, operations = [], []
+        for item in data:
+            item = item if isinstance(item, dict) else {}
+            action, uuid = item.get('action'), item.get('uuid')
+            if action in BULK_STATUS and isinstance(uuid, str) \
+                    and (action == 'delete' or UserServer._bulk_fields_valid(item)):
+                operations.append({'action': action, 'uuid': uuid, 'delta': item.get('delta'), 'area': item.get('area')})
+                result.append({'uuid': uuid, 'action': action, 'status': None, 'user': None})
+            else:
+                result.append({'uuid': uuid, 'action': action, 'status': 400, 'user': None})
+        return result, operations
+
+    def _bulk_result(self, result, operations, rows):
+        self._invalidate(*{operation['uuid'] for operation in operations})
+        rows = iter(rows)
+        for item in result:
+            if item['status'] is None:
+                item['user'] = next(rows)
+                item['status'] = BULK_STATUS[item['action']][item['user'] is not None]
+        return result, 200
+
+    @staticmethod
+    def _bulk_rejected(data) -> Optional[Tuple[None, int]]:
+        if not isinstance(data, list):
+            return None, 400
+        if len(data) > BULK_MAX_OPERATIONS:
+            return None, 413
+        return None
+
+    def bulk_write(self, data=None):
+        if rejected := self._bulk_rejected(data):
+            return rejected
+
+        result, operations = self._bulk_operations(data)
+        rows = self.db.bulk_write(operations) if operations else []
+        return self._bulk_result(result, operations, rows)
 
     def remove_user(self, uuid):
-        if self.db.find_user(uuid):
-            result = self.db.delete_user(uuid=uuid)
-            if self.send_updates:
-                user_data = {
-                    'uuid': result['uuid'],
-                    'delta': result['delta']
-                }
-                send_update(user=user_data, action='delete', area=result.get('area'))
-            return result, 200
-        else:
-            return None, 404
+        return self._written(uuid, self.db.delete_user(uuid=uuid), 200)
+
+
+def init_server() -> UserServer:
+    send_updates = True
+    if 'true' == getenv('DISABLE_UPDATES', 'false'):
+        send_updates = False
+    return UserServer(send_updates=send_updates, cache=init_cache())
 
 
 # Flask blueprint initialization
@@ -102,24 +312,112 @@ server: Optional[UserServer] = None
 @server_blueprint.before_request
 def before_request():
     global server
+    g.request_start = perf_counter()
     if not server:
-        send_updates = True
-        if 'true' == getenv('DISABLE_UPDATES', 'false'):
-            send_updates = False
-        server = UserServer(send_updates=send_updates)
+        server = init_server()
     server.before_request()
 
 
+@server_blueprint.after_request
+def after_request(response):
+    # Streamed responses are only timed until their headers are ready
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    REGISTRY.histogram('userservice_http_request_seconds', 'HTTP request latency', method=request.method,
+                       route=route).observe(perf_counter() - g.request_start)
+    return response
+
+
+@server_blueprint.errorhandler(CircuitOpen)
+def database_unavailable(error: CircuitOpen):
+    response = jsonify(None)
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, ceil(error.retry_after)))
+    return response
+
+
+@server_blueprint.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@server_blueprint.route('/stats', methods=['GET'])
+def stats():
+    result, code = server.stats()
+    return jsonify(result), code
+
+
+def not_modified(etag) -> Response:
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
 @server_blueprint.route('/users', methods=['GET'])
 def find_all_users():
-    result, code = server.find_all_users(data=request.args)
+    if 'true' == request.args.get('stream'):
+        stream = stream_with_context(server.stream_users(data=request.args))
+        return Response(stream, mimetype='application/x-ndjson')
+
+    if 'updated_since' in request.args:
+        result, code, after = server.find_users_changed(data=request.args)
+        response = jsonify(result)
+        if after:
+            next_changes = url_for('.find_all_users', **{**request.args.to_dict(), 'after': after})
+            response.headers['Link'] = f'<{next_changes}>; rel="next"'
+        return response, code
+
+    if 'limit' in request.args or 'after' in request.args:
+        result, code, after = server.find_users_page(data=request.args)
+        response = jsonify(result)
+        if after:
+            next_page = url_for('.find_all_users', **{**request.args.to_dict(), 'after': after})
+            response.headers['Link'] = f'<{next_page}>; rel="next"'
+        return response, code
+
+    # Looked up before the rows, so a concurrent write can only make the tag older than the body, never newer
+    etag = server.find_all_users_etag(data=request.args)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    if 'dict' != server.serializer:
+        body, code = server.find_all_users_json(data=request.args)
+        response = Response(body, status=code, mimetype='application/json')
+    else:
+        result, code = server.find_all_users(data=request.args)
+        response = jsonify(result)
+        response.status_code = code
+    response.set_etag(etag)
+    return response
+
+
+@server_blueprint.route('/areas', methods=['GET'])
+def find_areas():
+    result, code = server.find_areas()
+    return jsonify(result), code
+
+
+@server_blueprint.route('/areas/<string:area>/stats', methods=['GET'])
+def find_area_stats(area):
+    result, code = server.find_area_stats(area)
+    return jsonify(result), code
+
+
+@server_blueprint.route('/users/_bulk', methods=['POST'])
+def bulk_write():
+    result, code = server.bulk_write(request.json)
     return jsonify(result), code
 
 
 @server_blueprint.route('/users/<string:uuid>', methods=['GET'])
 def find_user(uuid):
+    if request.if_none_match and (etag := server.find_user_etag(uuid)) and request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
     result, code = server.find_user(uuid)
-    return jsonify(result), code
+    response = jsonify(result)
+    if result:
+        response.set_etag(user_etag(result['updated_at']))
+    return response, code
 
 
 @server_blueprint.route('/users/<string:uuid>', methods=['PUT', 'PATCH'])
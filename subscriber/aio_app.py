@@ -0,0 +1,37 @@
+from asyncio import create_task, get_running_loop, run
+from os import getenv
+from signal import SIGTERM
+
+from .src.aio_database import AsyncDatabase
+from .src.aio_subscriber import AsyncSubscriber
+from .src.exporter import MetricsExporter
+from .src.launcher import Launcher
+
+
+async def main(index=0):
+    exporter = None
+    if (port := int(getenv('SUBSCRIBER_METRICS_PORT', 9100))) > 0:
+        exporter = MetricsExporter(port=port + index)
+        exporter.start()
+    db = await AsyncDatabase().connect(keep_retrying=True)
+    subscriber = AsyncSubscriber(db=db)
+    task = create_task(subscriber.run())
+    get_running_loop().add_signal_handler(SIGTERM, subscriber.drain)
+    try:
+        await task
+    finally:
+        await subscriber.close()
+        await db.close()
+        if exporter:
+            exporter.stop()
+
+
+def run_subscriber(index=0):
+    run(main(index))
+
+
+if __name__ == '__main__':
+    if int(getenv('SUBSCRIBER_PROCESSES', 1)) > 1:
+        Launcher(run_subscriber).run()
+    else:
+        run_subscriber()
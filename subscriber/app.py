@@ -1,11 +1,49 @@
 from os import getenv
+from signal import signal, SIGTERM
 
-from .src.subscriber import Subscriber
+from .src.buffer import WriteBuffer
+from .src.exporter import MetricsExporter
+from .src.launcher import Launcher
+from .src.subscriber import Subscriber, init_database
+from .src.workers import WorkerPool
 
-if __name__ == '__main__':
-    subscriber = Subscriber()
+
+def run_subscriber(index=0):
+    # Every process has its own database connection, and its own metrics port next to the first one
+    exporter = None
+    if (port := int(getenv('SUBSCRIBER_METRICS_PORT', 9100))) > 0:
+        exporter = MetricsExporter(port=port + index)
+        exporter.start()
+    db = init_database()
+    buffer = None
+    if int(getenv('SUBSCRIBER_BATCH_SIZE', 500)) > 1:
+        buffer = WriteBuffer(db)
+        buffer.start()
+    workers = None
+    if int(getenv('SUBSCRIBER_WORKERS', 4)) > 1:
+        workers = WorkerPool()
+        workers.start()
+
+    subscriber = Subscriber(db=db, buffer=buffer, workers=workers)
+    signal(SIGTERM, lambda signum, frame: subscriber.drain())
     subscriber.connect(
         host=getenv('BROKER_HOST', 'mosquitto'),
         port=int(getenv('BROKER_PORT', 1884))
     )
-    subscriber.loop_forever()
+    try:
+        subscriber.loop_forever()
+    finally:
+        if workers:
+            workers.close()
+        if buffer:
+            buffer.close()
+        db.close()
+        if exporter:
+            exporter.stop()
+
+
+if __name__ == '__main__':
+    if int(getenv('SUBSCRIBER_PROCESSES', 1)) > 1:
+        Launcher(run_subscriber).run()
+    else:
+        run_subscriber()
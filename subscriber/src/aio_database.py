@@ -0,0 +1,68 @@
+from asyncio import TimeoutError, sleep
+from logging import getLogger
+from os import getenv
+from typing import Optional
+
+from asyncpg import create_pool, PostgresError
+from asyncpg.pool import Pool
+
+from .connection import Backoff
+
+logger = getLogger()
+
+
+class AsyncDatabase:
+    def __init__(self, pool: Optional[Pool] = None):
+        self.pool = pool
+
+    async def connect(self, connection_conf=None, keep_retrying=False, backoff: Optional[Backoff] = None):
+        connection_conf = connection_conf or {
+            'user': getenv('POSTGRES_USER'),
+            'password': getenv('POSTGRES_PASSWORD'),
+            'host': getenv('POSTGRES_HOST'),
+            'port': int(getenv('POSTGRES_PORT', 5432)),
+            'database': getenv('POSTGRES_DB'),
+            'timeout': float(getenv('POSTGRES_CONNECT_TIMEOUT', 5)),
+        }
+        for delay in (backoff or Backoff()).delays():
+            try:
+                self.pool = await create_pool(
+                    **connection_conf,
+                    min_size=int(getenv('POSTGRES_POOL_MIN', 1)),
+                    max_size=int(getenv('POSTGRES_POOL_MAX', 10))
+                )
+                logger.info('Successfully connected to database')
+                return self
+            except (OSError, TimeoutError, PostgresError) as e:
+                if not keep_retrying:
+                    raise e
+                logger.warning(f'Database not available yet, retrying in {delay:.2f}s: {e}')
+                await sleep(delay)
+
+    async def close(self):
+        await self.pool.close()
+
+    def stats(self):
+        return {
+            'min_size': self.pool.get_min_size(),
+            'max_size': self.pool.get_max_size(),
+            'size': self.pool.get_size(),
+            'idle': self.pool.get_idle_size(),
+        }
+
+    async def update_user(self, uuid, delta, version=None) -> Optional[dict]:
+        args = [uuid, delta]
+        sql = 'UPDATE users SET delta = $2, updated_at = now() '
+        if version is not None:
+            args.append(version)
+            sql += ', version = $3 WHERE uuid = $1 AND version < $3 '
+        else:
+            sql += 'WHERE uuid = $1 '
+        sql += 'RETURNING *'
+        try:
+            row = await self.pool.fetchrow(sql, *args)
+            return dict(row) if row else None
+
+        except PostgresError as e:
+            logger.exception(f'Failed to execute query "{sql}" with values "{args}"')
+            raise e
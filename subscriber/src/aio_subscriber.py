@@ -0,0 +1,167 @@
+from asyncio import FIRST_COMPLETED, Event, Semaphore, create_task, gather, sleep, wait
+from logging import getLogger
+from os import getenv
+from typing import Dict, Optional, Set, Tuple
+
+from asyncio_mqtt import Client, MqttError, ProtocolVersion
+
+from .aio_database import AsyncDatabase
+from .codec import decode_users
+from .metrics import REGISTRY, Histogram, timed
+from .subscriber import share_group, subscription_topics, written_payload, written_topic
+from .versions import VersionTracker
+
+logger = getLogger()
+
+# Once unsubscribed, every message the broker sent before acknowledging is queued locally already, so the queue
+# going idle this long means none is left
+DRAIN_IDLE = 0.1
+
+
+class AsyncSubscriber:
+
+    def __init__(self, db: AsyncDatabase, topic=None, concurrency=None):
+        self.db = db
+        if topic:
+            self.topics = [topic] if isinstance(topic, str) else list(topic)
+        else:
+            self.topics = subscription_topics()
+        self.concurrency = concurrency or int(getenv('SUBSCRIBER_CONCURRENCY', 64))
+        self.slots = Semaphore(self.concurrency)
+        self.writing: Set[str] = set()
+        # Newest delta and version received for a uuid while its previous write was in flight
+        self.pending: Dict[str, Tuple[int, Optional[int]]] = {}
+        self.versions = VersionTracker()
+        self.tasks: Set = set()
+        self.client: Optional[Client] = None
+        self.written_topic = written_topic()
+        self.draining = False
+        self._left = Event()
+        self._leaving = None
+        self.processed = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.latency = REGISTRY.register('userservice_subscriber_message_seconds',
+                                         'Time to handle one user message', Histogram())
+
+    async def run(self):
+        while not self.draining:
+            try:
+                # Shared subscriptions are an MQTT 5 feature
+                async with Client(hostname=getenv('BROKER_HOST', 'mosquitto'),
+                                  port=int(getenv('BROKER_PORT', 1884)), keepalive=60,
+                                  protocol=ProtocolVersion.V5 if share_group() else None) as client:
+                    logger.info('Successfully connected to mqtt broker.')
+                    if self.draining:
+                        return
+                    async with client.unfiltered_messages() as messages:
+                        qos = int(getenv('USERSERVICE_QOS', 0))
+                        await client.subscribe([(topic, qos) for topic in self.topics])
+                        logger.info(f'Successfully subscribed to {", ".join(f"{topic!r}" for topic in self.topics)}.')
+                        self.client = client
+                        await self.consume(messages)
+            except MqttError as e:
+                if self.draining:
+                    return
+                logger.warning(f'Lost connection to mqtt broker ({e}), reconnecting.')
+            finally:
+                self.client = None
+            await sleep(1)
+
+    async def consume(self, messages):
+        # Handles messages until the subscriptions are left, then whatever arrived before that
+        left = create_task(self._left.wait())
+        message = create_task(messages.__anext__())
+        try:
+            while True:
+                await wait({message, left}, return_when=FIRST_COMPLETED)
+                if not message.done():
+                    break
+                await self.on_message(message.result())
+                message = create_task(messages.__anext__())
+            while (await wait({message}, timeout=DRAIN_IDLE))[0]:
+                await self.on_message(message.result())
+                message = create_task(messages.__anext__())
+            logger.info('Left the subscriptions, disconnecting.')
+        finally:
+            message.cancel()
+            left.cancel()
+
+    def drain(self):
+        # Unsubscribe first, so the broker stops handing this process messages, in a share group to the other
+        # members. run() then handles what already arrived and returns, close() waits for the writes.
+        self.draining = True
+        self._leaving = create_task(self._leave())
+
+    async def _leave(self):
+        if self.client:
+            try:
+                await self.client.unsubscribe(self.topics)
+            except MqttError as e:
+                logger.warning(f'Failed to unsubscribe ({e}), handling what already arrived.')
+        self._left.set()
+
+    async def on_message(self, message):
+        logger.info(f'Received message: {message}')
+        # The users of an envelope go through the same per-uuid ordering as single events
+        for user in decode_users(message.payload):
+            await self.handle_user(user)
+
+    async def handle_user(self, user):
+        uuid, delta, version = user.get('uuid'), user.get('delta'), user.get('version')
+        if not self.versions.accept(uuid, version):
+            return
+        if uuid in self.writing:
+            # The running writer picks up the newest delta afterwards, keeping per-user order
+            self.coalesced += int(uuid in self.pending)
+            self.pending[uuid] = delta, version
+            return
+        # Stop reading from the broker while every slot is busy
+        await self.slots.acquire()
+        self.writing.add(uuid)
+        task = create_task(self._write(uuid, delta, version))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _write(self, uuid, delta, version=None):
+        try:
+            while True:
+                try:
+                    with timed(self.latency):
+                        written = await self.db.update_user(uuid=uuid, delta=delta, version=version)
+                    self.processed += 1
+                    if written:
+                        await self._written(uuid, delta)
+                except Exception:
+                    logger.exception(f'Failed to update user "{uuid}"')
+                    self.failed += 1
+                    self.versions.forget(uuid, version)
+                if uuid not in self.pending:
+                    break
+                delta, version = self.pending.pop(uuid)
+        finally:
+            self.writing.discard(uuid)
+            self.slots.release()
+
+    async def _written(self, uuid, delta):
+        if self.written_topic and self.client:
+            try:
+                await self.client.publish(self.written_topic, written_payload({uuid: delta}))
+            except MqttError as e:
+                # Server caches expire the user after their ttl instead
+                logger.warning(f'Failed to announce the write of user "{uuid}" ({e})')
+
+    async def close(self):
+        if self.tasks:
+            await gather(*self.tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            'in_flight': len(self.tasks),
+            'concurrency': self.concurrency,
+            'processed': self.processed,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'versions': self.versions.stats(),
+            'database': self.db.stats(),
+        }
@@ -0,0 +1,137 @@
+from logging import getLogger
+from os import getenv
+from threading import Condition, Thread
+from time import monotonic, perf_counter, sleep
+
+from psycopg2 import Error
+
+from .connection import CONNECTION_ERRORS, Backoff, CircuitOpen
+from .database import Database
+from .metrics import REGISTRY, Histogram
+
+logger = getLogger()
+
+
+class WriteBuffer(Thread):
+
+    def __init__(self, db: Database, max_size=None, max_delay=None, flush_timeout=None):
+        super().__init__(name='write-buffer', daemon=True)
+        self.db = db
+        self.max_size = max_size or int(getenv('SUBSCRIBER_BATCH_SIZE', 500))
+        self.max_delay = max_delay if max_delay is not None else float(getenv('SUBSCRIBER_BATCH_WINDOW', 0.05))
+        # How long closing keeps retrying the last deltas while the database is unreachable
+        self.flush_timeout = flush_timeout if flush_timeout is not None \
+            else float(getenv('SUBSCRIBER_FLUSH_TIMEOUT', 10))
+        self.backoff = Backoff()
+        self.received = 0
+        self.coalesced = 0
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.flush_latency = REGISTRY.register('userservice_subscriber_flush_seconds',
+                                               'Time to write one batch of buffered deltas', Histogram())
+        self.flush_size = Histogram(buckets=(1, 10, 50, 100, 250, 500, 1000, 5000))
+        # Called with the deltas of every batch once it committed, and with those of a batch the database refused
+        self.on_written = None
+        self.on_failed = None
+        self._deltas = {}
+        self._versions = {}
+        self._closed = False
+        self._condition = Condition()
+
+    def add(self, uuid, delta, version=None):
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Write buffer is closed')
+            if uuid in self._deltas:
+                self.coalesced += 1
+            # Only the last delta of each user within a window is ever written
+            self._deltas[uuid] = delta
+            if version is not None:
+                self._versions[uuid] = version
+            else:
+                self._versions.pop(uuid, None)
+            self.received += 1
+            if len(self._deltas) >= self.max_size:
+                self._condition.notify()
+
+    def run(self):
+        closed = False
+        while not closed:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed or len(self._deltas) >= self.max_size,
+                                         timeout=self.max_delay)
+                deltas, versions = self._take()
+                closed = self._closed
+            if deltas:
+                self.flush(deltas, versions)
+        self._flush_remaining()
+
+    def _flush_remaining(self):
+        # Deltas a failed flush put back have no later batch to go out with once closed
+        deadline = monotonic() + self.flush_timeout
+        for delay in self.backoff.delays():
+            with self._condition:
+                deltas, versions = self._take()
+            if not deltas:
+                return
+            if monotonic() + delay > deadline:
+                self.dropped += len(deltas)
+                logger.error(f'Dropped {len(deltas)} buffered deltas, the database stayed unreachable for '
+                             f'{self.flush_timeout}s')
+                return
+            sleep(delay)
+            self.flush(deltas, versions)
+
+    def _take(self):
+        deltas, self._deltas = self._deltas, {}
+        versions, self._versions = self._versions, {}
+        return deltas, versions
+
+    def flush(self, deltas, versions=None):
+        start = perf_counter()
+        try:
+            self.written += self.db.update_users(deltas, versions)
+        except CONNECTION_ERRORS + (CircuitOpen,):
+            # Connection problems are transient: retry with the next batch unless newer deltas arrived meanwhile
+            with self._condition:
+                for uuid, delta in deltas.items():
+                    if uuid not in self._deltas:
+                        self._deltas[uuid] = delta
+                        if versions and uuid in versions:
+                            self._versions[uuid] = versions[uuid]
+            return
+        except Error:
+            self.failed += len(deltas)
+            if self.on_failed:
+                self.on_failed(deltas, versions or {})
+            return
+        self.flush_latency.observe(perf_counter() - start)
+        self.flush_size.observe(len(deltas))
+        if self.on_written:
+            self.on_written(deltas)
+        logger.debug(f'Flushed {len(deltas)} users in {perf_counter() - start:.4f}s')
+
+    def close(self, timeout=None) -> bool:
+        # False when some deltas never made it to the database
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self.join(timeout)
+        stats = self.stats()
+        logger.info(f'Write buffer closed: {stats}')
+        return not self.is_alive() and not stats['pending'] and not self.dropped
+
+    def stats(self):
+        with self._condition:
+            pending = len(self._deltas)
+        return {
+            'received': self.received,
+            'coalesced': self.coalesced,
+            'written': self.written,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'pending': pending,
+            'flush_latency': self.flush_latency.snapshot(),
+            'flush_size': self.flush_size.snapshot(),
+        }
@@ -1,10 +1,19 @@
+from contextlib import contextmanager
 from enum import Enum
+from functools import lru_cache
 from logging import getLogger
 from os import getenv
+from re import compile
 from time import sleep
+from typing import Dict, Optional, Tuple
+from weakref import WeakKeyDictionary
 
 from psycopg2 import connect, Error
-from psycopg2.extras import RealDictCursor, RealDictRow
+from psycopg2.extras import RealDictCursor, RealDictRow, execute_values
+
+from .connection import Backoff
+from .metrics import REGISTRY, timed
+from .pool import ConnectionPool
 
 logger = getLogger()
 
@@ -15,61 +24,147 @@ class Fetch(Enum):
     ALL = -1
 
 
+PARAMETER = compile(r'%\((\w+)\)s')
+
+
+@lru_cache(maxsize=256)
+def prepare_statement(sql) -> Tuple[str, Tuple[str, ...]]:
+    # Turn named psycopg2 placeholders into positional $n parameters usable by PREPARE
+    params = []
+
+    def placeholder(match):
+        if match.group(1) not in params:
+            params.append(match.group(1))
+        return f'${params.index(match.group(1)) + 1}'
+
+    return PARAMETER.sub(placeholder, sql), tuple(params)
+
+
 class Database:
-    def __init__(self, connection=None, connection_conf=None, keep_retrying=False):
-        self.connection = connection or Database._init_connection(connection_conf, keep_retrying)
+    def __init__(self, connection=None, connection_conf=None, keep_retrying=False,
+                 pool: Optional[ConnectionPool] = None):
+        self.pool = pool or Database._init_pool(connection, connection_conf, keep_retrying)
+        self.prepare = 'true' == getenv('POSTGRES_PREPARE', 'true')
+        # Statements prepared on each pooled connection, by name
+        self._prepared: WeakKeyDictionary = WeakKeyDictionary()
 
     @staticmethod
-    def _init_connection(connection_conf, keep_retrying, backoff=1, backoff_multiplier=2):
-        try:
-            connection_conf = connection_conf or {
-                'user': getenv('POSTGRES_USER'),
-                'password': getenv('POSTGRES_PASSWORD'),
-                'host': getenv('POSTGRES_HOST'),
-                'port': getenv('POSTGRES_PORT'),
-                'dbname': getenv('POSTGRES_DB'),
-            }
-            connection = connect(**connection_conf)
-            logger.info('Successfully connected to database')
-            return connection
-        except Error as e:
-            if keep_retrying:
-                sleep_secs = backoff * backoff_multiplier
-                sleep(sleep_secs)
-                return Database._init_connection(connection_conf, keep_retrying, sleep_secs, backoff_multiplier)
-            else:
-                raise e
-
-    def _open_cursor(self):
-        return self.connection.cursor(cursor_factory=RealDictCursor)
-
-    def _execute_query(self, sql, values=None, fetch: Fetch = Fetch.ONE):
-        with self._open_cursor() as cursor:
+    def _init_pool(connection, connection_conf, keep_retrying):
+        if connection:
+            return ConnectionPool(connection_conf, min_size=1, max_size=1, connections=[connection])
+        # Wait for the database to come up before handing out further connections
+        connection = Database._init_connection(connection_conf, keep_retrying)
+        return ConnectionPool(connection_conf, connections=[connection])
+
+    @staticmethod
+    def _init_connection(connection_conf, keep_retrying, backoff: Optional[Backoff] = None):
+        connection_conf = connection_conf or {
+            'user': getenv('POSTGRES_USER'),
+            'password': getenv('POSTGRES_PASSWORD'),
+            'host': getenv('POSTGRES_HOST'),
+            'port': getenv('POSTGRES_PORT'),
+            'dbname': getenv('POSTGRES_DB'),
+            'connect_timeout': getenv('POSTGRES_CONNECT_TIMEOUT', 5),
+        }
+        for delay in (backoff or Backoff()).delays():
+            try:
+                connection = connect(**connection_conf)
+                logger.info('Successfully connected to database')
+                return connection
+            except Error as e:
+                if not keep_retrying:
+                    raise e
+                logger.warning(f'Database not available yet, retrying in {delay:.2f}s: {e}')
+                sleep(delay)
+
+    def close(self):
+        self.pool.closeall()
+
+    def stats(self):
+        return self.pool.stats()
+
+    @staticmethod
+    def _open_cursor(connection):
+        return connection.cursor(cursor_factory=RealDictCursor)
+
+    @contextmanager
+    def _transaction(self):
+        with self.pool.connection() as connection, self._open_cursor(connection) as cursor:
             try:
-                cursor.execute(sql, values)
+                yield cursor
+                connection.commit()
+            except Error:
+                if not connection.closed:
+                    connection.rollback()
+                raise
+
+    def _execute_prepared(self, cursor, name, sql, values):
+        statement, params = prepare_statement(sql)
+        prepared: Dict[str, str] = self._prepared.setdefault(cursor.connection, {})
+        if prepared.get(name) != statement:
+            if name in prepared:
+                cursor.execute(f'DEALLOCATE {name}')
+                del prepared[name]
+            cursor.execute(f'PREPARE {name} AS {statement}')
+            prepared[name] = statement
+        if params:
+            cursor.execute(f'EXECUTE {name}({", ".join(["%s"] * len(params))})', [values[param] for param in params])
+        else:
+            cursor.execute(f'EXECUTE {name}')
+
+    @staticmethod
+    def _query_latency(name):
+        return REGISTRY.histogram('userservice_db_query_seconds', 'Database query latency', query=name)
+
+    def _execute_query(self, sql, values=None, fetch: Fetch = Fetch.ONE, name=None):
+        try:
+            with timed(self._query_latency(name or 'unnamed')), self._transaction() as cursor:
+                if name and self.prepare:
+                    self._execute_prepared(cursor, name, sql, values)
+                else:
+                    cursor.execute(sql, values)
                 if fetch == Fetch.NONE:
                     result = None
                 elif fetch == Fetch.ONE:
                     result = cursor.fetchone()
                 elif fetch == Fetch.ALL:
                     result = cursor.fetchall()
-                self.connection.commit()
-                return result
+            return result
 
-            except Error as e:
-                logger.exception(f'Failed to execute query "{sql}" with values "{values}"')
-                self.connection.rollback()
-                raise e
+        except Error as e:
+            logger.exception(f'Failed to execute query "{sql}" with values "{values}"')
+            raise e
 
-    def update_user(self, uuid, delta) -> RealDictRow:
-        sql = '''
-            UPDATE users
-            SET delta = %(delta)s, updated_at = now()
-            WHERE uuid = %(uuid)s
-            RETURNING *
-        '''
+    def update_user(self, uuid, delta, version=None) -> Optional[RealDictRow]:
+        # A versioned update only applies over an older version, redelivered and stale events change nothing
+        sql = 'UPDATE users SET delta = %(delta)s, updated_at = now() '
+        if version is not None:
+            sql += ', version = %(version)s '
+        sql += 'WHERE uuid = %(uuid)s '
+        if version is not None:
+            sql += 'AND version < %(version)s '
+        sql += 'RETURNING *'
         values = {
             'uuid': uuid,
-            'delta': delta
+            'delta': delta,
+            'version': version
         }
-        return self._execute_query(sql, values)
+        return self._execute_query(sql, values, name=f'update_user_{version is not None:d}')
+
+    def update_users(self, deltas: Dict[str, int], versions: Optional[Dict[str, int]] = None) -> int:
+        sql = '''
+            UPDATE users
+            SET delta = v.delta, version = COALESCE(v.version, users.version), updated_at = now()
+            FROM (VALUES %s) AS v(uuid, delta, version)
+            WHERE users.uuid = v.uuid AND (v.version IS NULL OR users.version < v.version)
+        '''
+        versions = versions or {}
+        values = [(uuid, delta, versions.get(uuid)) for uuid, delta in deltas.items()]
+        try:
+            with timed(self._query_latency('update_users')), self._transaction() as cursor:
+                execute_values(cursor, sql, values, template='(%s, %s::int, %s::bigint)', page_size=len(values))
+                return cursor.rowcount
+
+        except Error as e:
+            logger.exception(f'Failed to update {len(values)} users')
+            raise e
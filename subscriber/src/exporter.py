@@ -0,0 +1,47 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from os import getenv
+from threading import Thread
+
+from .metrics import REGISTRY, Registry
+
+logger = getLogger()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class MetricsExporter(Thread):
+
+    def __init__(self, registry: Registry = REGISTRY, host='0.0.0.0', port=None):
+        super().__init__(name='metrics-exporter', daemon=True)
+        self.httpd = ThreadingHTTPServer(
+            (host, port if port is not None else int(getenv('SUBSCRIBER_METRICS_PORT', 9100))), MetricsHandler
+        )
+        self.httpd.registry = registry
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def run(self):
+        logger.info(f'Serving metrics on port {self.port}')
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
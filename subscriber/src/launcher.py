@@ -0,0 +1,104 @@
+from logging import getLogger
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
+from os import getenv
+from signal import SIG_DFL, SIGHUP, SIGINT, SIGTERM, default_int_handler, signal
+from time import monotonic, sleep
+from typing import Callable, Dict
+
+logger = getLogger()
+
+# Forked, so children start without re-importing the application
+CONTEXT = get_context('fork')
+
+
+class Launcher:
+    # Runs target(index) in each of `processes` child processes, restarting any that exits on its own. SIGTERM and
+    # SIGINT drain every child and stop, SIGHUP restarts the children one at a time.
+
+    def __init__(self, target: Callable[[int], None], processes=None, drain_timeout=None, restart_delay=1.0):
+        self.target = target
+        self.processes = processes or int(getenv('SUBSCRIBER_PROCESSES', 1))
+        self.drain_timeout = drain_timeout if drain_timeout is not None else float(
+            getenv('SUBSCRIBER_DRAIN_TIMEOUT', 30))
+        self.restart_delay = restart_delay
+        self.children: Dict[int, BaseProcess] = {}
+        self.restarts = 0
+        self.stopping = False
+        self.reloading = False
+
+    def _run_child(self, index):
+        # A forked child inherits the launcher's handlers, which would only set a flag on its copy of the launcher
+        # until the target installs its own. Restore the defaults a fresh process would have.
+        signal(SIGTERM, SIG_DFL)
+        signal(SIGHUP, SIG_DFL)
+        signal(SIGINT, default_int_handler)
+        self.target(index)
+
+    def spawn(self, index):
+        process = CONTEXT.Process(target=self._run_child, args=(index,), name=f'subscriber-{index}')
+        process.start()
+        self.children[index] = process
+        logger.info(f'Started subscriber {index} (pid {process.pid}).')
+
+    def start(self):
+        for index in range(self.processes):
+            self.spawn(index)
+
+    def _join(self, processes, timeout):
+        # Children that outlive the drain timeout are killed, so a stuck write cannot block the shutdown
+        deadline = monotonic() + timeout
+        for process in processes:
+            process.join(max(0.0, deadline - monotonic()))
+            if process.is_alive():
+                logger.warning(f'Subscriber pid {process.pid} did not drain in {timeout}s, killing it.')
+                process.kill()
+                process.join()
+
+    def check(self, timeout=1.0):
+        # Waits for a child to exit, then replaces every child that exited unexpectedly
+        wait([process.sentinel for process in self.children.values()], timeout=timeout)
+        for index, process in list(self.children.items()):
+            if not process.is_alive() and not self.stopping:
+                logger.warning(f'Subscriber {index} exited with code {process.exitcode}, restarting.')
+                self.restarts += 1
+                sleep(self.restart_delay)
+                self.spawn(index)
+
+    def reload(self):
+        # One child at a time, so the other members of the share group keep consuming meanwhile
+        for index, process in list(self.children.items()):
+            if self.stopping:
+                break
+            process.terminate()
+            self._join([process], self.drain_timeout)
+            self.spawn(index)
+
+    def stop(self):
+        self.stopping = True
+        processes = list(self.children.values())
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        self._join(processes, self.drain_timeout)
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reloading = True
+
+    def run(self):
+        signal(SIGTERM, self._on_stop)
+        signal(SIGINT, self._on_stop)
+        signal(SIGHUP, self._on_reload)
+        self.start()
+        try:
+            while not self.stopping:
+                if self.reloading:
+                    self.reloading = False
+                    self.reload()
+                self.check()
+        finally:
+            self.stop()
@@ -0,0 +1,93 @@
+from datetime import datetime, timezone
+from decimal import Decimal, ROUND_HALF_UP
+from threading import Lock
+from typing import Dict, Optional
+
+from psycopg2 import DataError
+
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+class User:
+    __slots__ = ('uuid', 'delta', 'area', 'created_at', 'updated_at', 'version')
+
+    def __init__(self, uuid, delta, area, created_at, updated_at, version=0):
+        self.uuid = uuid
+        self.delta = delta
+        self.area = area
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.version = version
+
+    def as_dict(self) -> dict:
+        return {'uuid': self.uuid, 'delta': self.delta, 'area': self.area, 'created_at': self.created_at,
+                'updated_at': self.updated_at, 'version': self.version}
+
+
+def _integer(value) -> Optional[int]:
+    # Coerced the way Postgres assigns a parameter to the integer delta column
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise DataError(f'cannot coerce {type(value).__name__} to integer')
+    try:
+        number = int(Decimal(str(value).strip()).to_integral_value(ROUND_HALF_UP))
+    except (ArithmeticError, ValueError):
+        raise DataError(f'invalid input syntax for type integer: "{value}"')
+    if not INT_MIN <= number <= INT_MAX:
+        raise DataError('integer out of range')
+    return number
+
+
+class MemoryDatabase:
+    # Stands in for postgres in tests and benchmarks. The subscriber process itself never runs on it, a store of
+    # its own would never see the users created through the server.
+
+    def __init__(self):
+        self.closed = False
+        self._users: Dict[str, User] = {}
+        self._lock = Lock()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'users': len(self._users)}
+
+    def find_user(self, uuid) -> Optional[dict]:
+        user = self._users.get(uuid)
+        return user.as_dict() if user else None
+
+    def insert_user(self, uuid, delta=None, area=None) -> Optional[dict]:
+        with self._lock:
+            if uuid in self._users:
+                return None
+            now = datetime.now(timezone.utc)
+            user = self._users[uuid] = User(uuid, _integer(delta) or 0, area or '', now, now)
+            return user.as_dict()
+
+    def _update(self, now, uuid, delta, version=None) -> Optional[User]:
+        if not (old := self._users.get(uuid)):
+            return None
+        # A versioned update only applies over an older version
+        if version is not None and old.version >= version:
+            return None
+        user = self._users[uuid] = User(uuid, old.delta if delta is None else delta, old.area, old.created_at, now,
+                                        old.version if version is None else version)
+        return user
+
+    def update_user(self, uuid, delta, version=None) -> Optional[dict]:
+        delta = _integer(delta)
+        with self._lock:
+            user = self._update(datetime.now(timezone.utc), uuid, delta, version)
+            return user.as_dict() if user else None
+
+    def update_users(self, deltas: Dict[str, int], versions: Optional[Dict[str, int]] = None) -> int:
+        deltas = {uuid: _integer(delta) for uuid, delta in deltas.items()}
+        versions = versions or {}
+        with self._lock:
+            now = datetime.now(timezone.utc)
+            return sum(self._update(now, uuid, delta, versions.get(uuid)) is not None
+                       for uuid, delta in deltas.items())
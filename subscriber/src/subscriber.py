@@ -1,41 +1,159 @@
 from logging import getLogger
 from os import getenv
+from typing import List, Optional
 
-from paho.mqtt.client import Client
-from ujson import loads
+from paho.mqtt.client import MQTTv311, MQTTv5, Client
 
+from .buffer import WriteBuffer
+from .codec import decode_event, encode_json_envelope, subscription_topic
 from .database import Database
+from .metrics import REGISTRY, Histogram, timed
+from .versions import VersionTracker
+from .workers import WorkerPool
 
 logger = getLogger()
 
 
+def init_database():
+    if 'memory' == getenv('STORAGE_BACKEND', 'postgres'):
+        raise RuntimeError('The subscriber needs the postgres storage backend, it cannot share the server memory')
+    return Database(keep_retrying=True)
+
+
+def share_group() -> str:
+    return getenv('SUBSCRIBER_SHARE_GROUP', '')
+
+
+def written_topic() -> str:
+    # Where the users are announced once their write committed, so that server caches drop them. Empty turns it off.
+    return getenv('USER_CACHE_WRITTEN_TOPIC', '_userservice/written')
+
+
+def written_payload(deltas) -> bytes:
+    return encode_json_envelope([{'action': 'update', 'uuid': uuid, 'delta': delta} for uuid, delta in deltas.items()])
+
+
+def subscription_topics(topics=None, event_format=None, group=None) -> List[str]:
+    # One subscription per comma-separated topic. Within a share group the broker hands each message to only one
+    # of the subscribed processes, instead of every process getting a copy.
+    topics = topics if topics is not None else getenv('USERSERVICE_TOPIC', '')
+    event_format = event_format or getenv('SUBSCRIBER_EVENT_FORMAT', 'json')
+    group = group if group is not None else share_group()
+    prefix = f'$share/{group}/' if group else ''
+    return [prefix + subscription_topic(topic.strip(), event_format) for topic in topics.split(',') if topic.strip()]
+
+
 class Subscriber(Client):
 
-    def __init__(self, db=None, topic=None):
-        super().__init__()
-        self.db = db or Database(keep_retrying=True)
-        self.topic = topic
+    def __init__(self, db=None, topic=None, buffer: Optional[WriteBuffer] = None,
+                 workers: Optional[WorkerPool] = None, protocol=None):
+        # Shared subscriptions are an MQTT 5 feature
+        super().__init__(protocol=protocol or (MQTTv5 if share_group() else MQTTv311))
+        self.db = db or init_database()
+        if topic:
+            self.topics = [topic] if isinstance(topic, str) else list(topic)
+        else:
+            self.topics = subscription_topics()
+        self.buffer = buffer
+        self.workers = workers
+        self.written_topic = written_topic()
+        if buffer:
+            buffer.on_written = self.sub_on_written
+            buffer.on_failed = self.sub_on_failed
+        self.draining = False
+        self.versions = VersionTracker()
+        self.latency = REGISTRY.register('userservice_subscriber_message_seconds',
+                                         'Time to handle one user message', Histogram())
         self.on_connect = self.sub_on_connect
         self.on_subscribe = self.sub_on_subscribe
+        self.on_unsubscribe = self.sub_on_unsubscribe
         self.on_message = self.sub_on_message
 
-    def sub_on_connect(self, client, userdata, flags, rc):
+    def sub_on_connect(self, client, userdata, flags, rc, properties=None):
         logger.info('Successfully connected to mqtt broker.')
-        client.subscribe(
-            topic=self.topic or getenv('USERSERVICE_TOPIC'),
-            qos=int(getenv('USERSERVICE_QOS', 0))
-        )
+        if self.draining:
+            return client.disconnect()
+        qos = int(getenv('USERSERVICE_QOS', 0))
+        client.subscribe([(topic, qos) for topic in self.topics])
+
+    def sub_on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
+        logger.info(f'Successfully subscribed to {", ".join(f"{topic!r}" for topic in self.topics)}.')
+
+    def sub_on_unsubscribe(self, client, userdata, mid, properties=None, reason_codes=None):
+        if self.draining:
+            logger.info('Left the subscriptions, disconnecting.')
+            client.disconnect()
 
-    def sub_on_subscribe(self, client, userdata, mid, granted_qos):
-        logger.info(f'Successfully subscribed to "{self.topic or getenv("USERSERVICE_TOPIC")}" topic.')
+    def drain(self):
+        # Unsubscribe first, so the broker stops handing this process messages, in a share group to the other
+        # members. Whatever already arrived is handled before the unsubscribe is acknowledged.
+        self.draining = True
+        if not self.is_connected():
+            return self.disconnect()
+        self.unsubscribe(self.topics)
+
+    def sub_on_written(self, deltas):
+        if self.written_topic and deltas:
+            self.publish(self.written_topic, written_payload(deltas))
+
+    def sub_on_failed(self, deltas, versions):
+        # Refused versions were never applied, a redelivery must not be dropped as a duplicate
+        for uuid in deltas:
+            self.versions.forget(uuid, versions.get(uuid))
 
     def sub_on_message(self, client, userdata, message):
         logger.info(f'Received message: {message}')
-        payload = loads(message.payload)
+        payload = decode_event(message.payload)
+        if 'events' in payload:
+            # Duplicates and stale events are dropped here, before any of them is queued
+            users = [user for event in payload['events']
+                     if (user := event.get('user')) and self.versions.accept(user.get('uuid'), user.get('version'))]
+            if self.workers:
+                # Envelopes of one topic keep their order on the same worker
+                self.workers.submit(message.topic, self.handle_envelope, users)
+                return
+            return self.handle_envelope(users)
         user = payload.get('user')
-        if user:
-            response = self.db.update_user(
-                uuid=user.get('uuid'),
-                delta=user.get('delta')
-            )
-            return response
+        if user and not self.versions.accept(user.get('uuid'), user.get('version')):
+            return
+        if user and self.workers:
+            self.workers.submit(user.get('uuid'), self.handle_user, user)
+        elif user:
+            return self.handle_user(user)
+
+    def handle_user(self, user):
+        with timed(self.latency):
+            if self.buffer:
+                self.buffer.add(uuid=user.get('uuid'), delta=user.get('delta'), version=user.get('version'))
+                return
+            try:
+                result = self.db.update_user(
+                    uuid=user.get('uuid'),
+                    delta=user.get('delta'),
+                    version=user.get('version')
+                )
+            except Exception:
+                self.versions.forget(user.get('uuid'), user.get('version'))
+                raise
+            if result:
+                self.sub_on_written({user.get('uuid'): user.get('delta')})
+            return result
+
+    def handle_envelope(self, users):
+        # Every update of the envelope in one transaction, a later delta for the same uuid wins
+        with timed(self.latency):
+            if self.buffer:
+                for user in users:
+                    self.buffer.add(uuid=user.get('uuid'), delta=user.get('delta'), version=user.get('version'))
+            elif users:
+                deltas = {user.get('uuid'): user.get('delta') for user in users}
+                versions = {user.get('uuid'): user['version'] for user in users if user.get('version') is not None}
+                try:
+                    written = self.db.update_users(deltas, versions)
+                except Exception:
+                    for user in users:
+                        self.versions.forget(user.get('uuid'), user.get('version'))
+                    raise
+                if written:
+                    self.sub_on_written(deltas)
+                return written
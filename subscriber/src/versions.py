@@ -0,0 +1,48 @@
+from collections import OrderedDict
+from os import getenv
+from threading import Lock
+
+from .metrics import REGISTRY, Counter
+
+
+class VersionTracker:
+    # Last event version accepted per uuid, forgetting the least recently seen uuids beyond max_size. A uuid
+    # that was forgotten is still protected by the conditional update in the database.
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or int(getenv('SUBSCRIBER_VERSION_CACHE_SIZE', 100000))
+        self._versions: OrderedDict = OrderedDict()
+        self._lock = Lock()
+        self.duplicates = REGISTRY.register('userservice_subscriber_dropped_total',
+                                            'Messages dropped before reaching the database', Counter(),
+                                            reason='duplicate')
+        self.stale = REGISTRY.register('userservice_subscriber_dropped_total',
+                                       'Messages dropped before reaching the database', Counter(), reason='stale')
+
+    def accept(self, uuid, version) -> bool:
+        # Unversioned messages are always applied, as before versions existed
+        if version is None:
+            return True
+        with self._lock:
+            last = self._versions.get(uuid)
+            if last is not None and version <= last:
+                (self.duplicates if version == last else self.stale).inc()
+                return False
+            self._versions[uuid] = version
+            self._versions.move_to_end(uuid)
+            if len(self._versions) > self.max_size:
+                self._versions.popitem(last=False)
+            return True
+
+    def forget(self, uuid, version):
+        # A failed write must not make its redelivery look like a duplicate
+        if version is None:
+            return
+        with self._lock:
+            if self._versions.get(uuid) == version:
+                del self._versions[uuid]
+
+    def stats(self):
+        with self._lock:
+            tracked = len(self._versions)
+        return {'tracked': tracked, 'duplicates': self.duplicates.value, 'stale': self.stale.value}
@@ -0,0 +1,70 @@
+from logging import getLogger
+from os import getenv
+from queue import Queue
+from threading import Thread
+from time import perf_counter
+from zlib import crc32
+
+logger = getLogger()
+
+
+class WorkerPool:
+
+    def __init__(self, workers=None, queue_size=None):
+        self.size = workers or int(getenv('SUBSCRIBER_WORKERS', 4))
+        queue_size = queue_size or int(getenv('SUBSCRIBER_QUEUE_SIZE', 1000))
+        self._queues = [Queue(maxsize=queue_size) for _ in range(self.size)]
+        self._threads = [
+            Thread(target=self._work, args=(index,), name=f'subscriber-worker-{index}', daemon=True)
+            for index in range(self.size)
+        ]
+        self._busy = [0.0] * self.size
+        self._processed = [0] * self.size
+        self._failed = [0] * self.size
+        self._started_at = None
+
+    def start(self):
+        self._started_at = perf_counter()
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, task, *args):
+        # Tasks with the same key always land on the same worker, so they run in submission order.
+        # A full queue blocks the caller, pushing back on the mqtt network loop.
+        self._queues[crc32(str(key).encode()) % self.size].put((task, args))
+
+    def _work(self, index):
+        queue = self._queues[index]
+        while True:
+            item = queue.get()
+            if item is None:
+                queue.task_done()
+                return
+            task, args = item
+            start = perf_counter()
+            try:
+                task(*args)
+            except Exception:
+                logger.exception(f'Worker {index} failed to run task')
+                self._failed[index] += 1
+            finally:
+                self._busy[index] += perf_counter() - start
+                self._processed[index] += 1
+                queue.task_done()
+
+    def close(self, timeout=None):
+        for queue in self._queues:
+            queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        logger.info(f'Worker pool closed: {self.stats()}')
+
+    def stats(self):
+        elapsed = perf_counter() - self._started_at if self._started_at else 0
+        return {
+            'workers': self.size,
+            'queue_depth': [queue.qsize() for queue in self._queues],
+            'utilisation': [busy / elapsed if elapsed else 0.0 for busy in self._busy],
+            'processed': sum(self._processed),
+            'failed': sum(self._failed),
+        }
@@ -13,7 +13,29 @@ class Fixtures(Database):
         super().__init__(connection, connection_conf)
 
     def clean_database(self):
-        self._execute_query("TRUNCATE TABLE users", fetch=Fetch.NONE)
+        self._execute_query("TRUNCATE TABLE users, outbox, area_stats, area_versions, user_tombstones", fetch=Fetch.NONE)
 
     def close_connection(self):
-        self.connection.close()
+        self.close()
+
+
+class MemoryFixtures:
+    def __init__(self, db):
+        self.db = db
+
+    def clean_database(self):
+        # The subscriber store only keeps users, the server one indexes and events too
+        with self.db._lock:
+            for name in ('_users', '_uuids', '_areas', '_area_deltas', '_area_sums', '_tombstones', '_changes',
+                         '_events'):
+                if hasattr(self.db, name):
+                    getattr(self.db, name).clear()
+
+    def insert_user(self, uuid, delta=None, area=None):
+        return self.db.insert_user(uuid, delta=delta, area=area)
+
+    def find_user(self, uuid):
+        return self.db.find_user(uuid)
+
+    def close_connection(self):
+        self.db.close()
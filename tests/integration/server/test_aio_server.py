@@ -0,0 +1,133 @@
+import unittest
+from os import environ
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from server.src.aio_server import create_app
+from ..fixtures import Fixtures
+
+
+class TestAsyncServer(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        environ['DISABLE_UPDATES'] = 'true'
+        environ['CHANGE_FEED_LAG'] = '0'
+        cls.fixtures = Fixtures()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.fixtures.clean_database()
+        cls.fixtures.close_connection()
+
+    async def asyncSetUp(self) -> None:
+        self.fixtures.clean_database()
+        self.client = TestClient(TestServer(create_app()))
+        await self.client.start_server()
+
+    async def asyncTearDown(self) -> None:
+        await self.client.close()
+
+    async def test_post_user_successfully(self):
+        uuid = 'f9b358cc522a4cb7a60c27da6fbed8f1'
+
+        response = await self.client.post(f'/users/{uuid}', json={'delta': 42, 'area': 'ABC'})
+        user = self.fixtures.find_user(uuid)
+
+        self.assertEqual(201, response.status)
+        self.assertEqual(42, user['delta'])
+        self.assertEqual('ABC', user['area'])
+
+    async def test_post_user_already_exists(self):
+        uuid = 'f9b358cc522a4cb7a60c27da6fbed8f1'
+        self.fixtures.insert_user(uuid, delta=0, area='XYZ')
+
+        response = await self.client.post(f'/users/{uuid}', json={'delta': 42, 'area': 'ABC'})
+
+        self.assertEqual(409, response.status)
+        self.assertIsNone(await response.json())
+        self.assertEqual('XYZ', self.fixtures.find_user(uuid)['area'])
+
+    async def test_get_user_successfully(self):
+        uuid = 'f9b358cc522a4cb7a60c27da6fbed8f1'
+        self.fixtures.insert_user(uuid, delta=7, area='XYZ')
+
+        response = await self.client.get(f'/users/{uuid}')
+        user = await response.json()
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(7, user['delta'])
+        self.assertTrue(user['updated_at'].endswith('GMT'))
+
+    async def test_get_user_not_modified(self):
+        uuid = 'f9b358cc522a4cb7a60c27da6fbed8f1'
+        self.fixtures.insert_user(uuid, delta=7, area='XYZ')
+
+        etag = (await self.client.get(f'/users/{uuid}')).headers['ETag']
+        user_response = await self.client.get(f'/users/{uuid}', headers={'If-None-Match': etag})
+        users_etag = (await self.client.get('/users?area=XYZ')).headers['ETag']
+        users_response = await self.client.get('/users?area=XYZ', headers={'If-None-Match': users_etag})
+
+        self.assertEqual(304, user_response.status)
+        self.assertEqual(304, users_response.status)
+
+    async def test_patch_user_successfully(self):
+        uuid = 'f9b358cc522a4cb7a60c27da6fbed8f1'
+        self.fixtures.insert_user(uuid, delta=0, area='XYZ')
+
+        response = await self.client.patch(f'/users/{uuid}', json={'delta': 42, 'area': 'ABC'})
+        user = await response.json()
+
+        self.assertEqual(200, response.status)
+        self.assertEqual('XYZ', user['old_area'])
+        self.assertEqual('ABC', self.fixtures.find_user(uuid)['area'])
+
+    async def test_delete_user_fail_if_user_does_not_exists(self):
+        response = await self.client.delete('/users/nonexistent-user-uuid')
+
+        self.assertEqual(404, response.status)
+
+    async def test_bulk_write_successfully(self):
+        self.fixtures.insert_user('86c822ee6f9a4f69b2f57a9c8702e4a2', delta=0, area='XYZ')
+
+        response = await self.client.post('/users/_bulk', json=[
+            {'action': 'create', 'uuid': 'f9b358cc522a4cb7a60c27da6fbed8f1', 'delta': 42, 'area': 'ABC'},
+            {'action': 'create', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2'},
+            {'action': 'update', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'delta': 7},
+            {'action': 'delete', 'uuid': 'f9b358cc522a4cb7a60c27da6fbed8f1'},
+        ])
+
+        self.assertEqual(200, response.status)
+        self.assertEqual([201, 409, 200, 200], [item['status'] for item in await response.json()])
+        self.assertEqual(7, self.fixtures.find_user('86c822ee6f9a4f69b2f57a9c8702e4a2')['delta'])
+        self.assertIsNone(self.fixtures.find_user('f9b358cc522a4cb7a60c27da6fbed8f1'))
+
+    async def test_get_users_paginated_and_streamed(self):
+        uuids = sorted(f'{index:032x}' for index in range(5))
+        for uuid in uuids:
+            self.fixtures.insert_user(uuid, delta=0, area='ABC')
+
+        response = await self.client.get('/users?area=ABC&limit=3')
+        self.assertEqual(uuids[:3], [user['uuid'] for user in await response.json()])
+        self.assertIn(f'after={uuids[2]}', response.headers['Link'])
+
+        response = await self.client.get('/users?stream=true')
+        lines = (await response.text()).splitlines()
+        self.assertEqual('application/x-ndjson', response.content_type)
+        self.assertEqual(5, len(lines))
+
+    async def test_get_users_changed_reports_deletes(self):
+        uuid = 'f9b358cc522a4cb7a60c27da6fbed8f1'
+        self.fixtures.insert_user(uuid, delta=0, area='ABC')
+        self.fixtures.delete_user(uuid)
+
+        response = await self.client.get('/users', params={'updated_since': '2000-01-01T00:00:00Z', 'area': 'ABC'})
+        changes = await response.json()
+
+        self.assertEqual(200, response.status)
+        self.assertEqual([(uuid, True)], [(change['uuid'], change['deleted']) for change in changes])
+        self.assertIn('after=', response.headers['Link'])
+
+
+if __name__ == '__main__':
+    unittest.main()
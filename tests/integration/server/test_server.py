@@ -1,23 +1,37 @@
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
 
+from ujson import loads
+
 from server.app import app
-from ..fixtures import Fixtures
+from server.src import server
+from server.src.cache import UserCache
+from server.src.memory import MemoryDatabase
+from ..fixtures import Fixtures, MemoryFixtures
 
 
 class TestServer(unittest.TestCase):
+    backend = 'postgres'
 
     @classmethod
     def setUpClass(cls) -> None:
         app.config['TESTING'] = True
         environ['DISABLE_UPDATES'] = 'true'
+        environ['CHANGE_FEED_LAG'] = '0'
         cls.client = app.test_client()
-        cls.fixtures = Fixtures()
+        if 'memory' == cls.backend:
+            cls.fixtures = MemoryFixtures(MemoryDatabase())
+            server.server = server.UserServer(db=cls.fixtures.db, send_updates=False, cache=UserCache())
+        else:
+            cls.fixtures = Fixtures()
+            server.server = None
 
     @classmethod
     def tearDownClass(cls) -> None:
         cls.fixtures.clean_database()
         cls.fixtures.close_connection()
+        server.server = None
 
     def setUp(self) -> None:
         self.fixtures.clean_database()
@@ -58,6 +72,38 @@ class TestServer(unittest.TestCase):
         self.assertEqual(42, user['delta'])
         self.assertEqual('ABC', user['area'])
 
+    def test_patch_user_variants_use_prepared_statements(self):
+        if 'postgres' != self.backend:
+            self.skipTest('Prepared statements are specific to the postgres backend')
+        uuid = 'f9b358cc522a4cb7a60c27da6fbed8f1'
+        self.fixtures.insert_user(uuid, delta=0, area='XYZ')
+
+        self.client.patch(f'/users/{uuid}', json={'delta': 1})
+        self.client.patch(f'/users/{uuid}', json={'area': 'ABC'})
+        response = self.client.patch(f'/users/{uuid}', json={'delta': 2})
+        with server.server.db._transaction() as cursor:
+            cursor.execute('SELECT name FROM pg_prepared_statements')
+            names = {row['name'] for row in cursor.fetchall()}
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, response.json['delta'])
+        self.assertEqual('ABC', response.json['area'])
+        self.assertLessEqual({'update_user_01', 'update_user_10'}, names)
+
+    def test_metrics_report_route_and_query_latency(self):
+        self.client.get('/users/f9b358cc522a4cb7a60c27da6fbed8f1')
+
+        response = self.client.get('/metrics')
+        lines = response.get_data(as_text=True).splitlines()
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(any(line.startswith(
+            'userservice_http_request_seconds_count{method="GET",route="/users/<string:uuid>"}'
+        ) for line in lines))
+        if 'postgres' == self.backend:
+            self.assertTrue(any(line.startswith('userservice_db_query_seconds_count{query="find_user"}')
+                                for line in lines))
+
     def test_patch_user_fail_if_user_does_not_exists(self):
         uuid = 'f9b358cc522a4cb7a60c27da6fbed8f1'
         ne_uuid = 'nonexistent-user-uuid'
@@ -97,3 +143,215 @@ class TestServer(unittest.TestCase):
         self.assertIsNotNone(user)
         self.assertEqual(0, user['delta'])
         self.assertEqual('XYZ', user['area'])
+
+    def test_bulk_write_successfully(self):
+        self.fixtures.insert_user('86c822ee6f9a4f69b2f57a9c8702e4a2', delta=0, area='XYZ')
+        self.fixtures.insert_user('94565bc0210546f6990bce590d94be39', delta=0, area='XYZ')
+
+        response = self.client.post('/users/_bulk', json=[
+            {'action': 'create', 'uuid': 'f9b358cc522a4cb7a60c27da6fbed8f1', 'delta': 42, 'area': 'ABC'},
+            {'action': 'create', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'delta': 42, 'area': 'ABC'},
+            {'action': 'update', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'area': 'ABC'},
+            {'action': 'update', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'delta': 7},
+            {'action': 'delete', 'uuid': '94565bc0210546f6990bce590d94be39'},
+            {'action': 'delete', 'uuid': '94565bc0210546f6990bce590d94be39'},
+            {'action': 'update', 'uuid': 'nonexistent-user-uuid', 'delta': 1},
+        ])
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([201, 409, 200, 200, 200, 404, 404], [item['status'] for item in response.json])
+        self.assertEqual(42, self.fixtures.find_user('f9b358cc522a4cb7a60c27da6fbed8f1')['delta'])
+        updated = self.fixtures.find_user('86c822ee6f9a4f69b2f57a9c8702e4a2')
+        self.assertEqual(7, updated['delta'])
+        self.assertEqual('ABC', updated['area'])
+        self.assertIsNone(self.fixtures.find_user('94565bc0210546f6990bce590d94be39'))
+
+    def test_bulk_write_rejects_malformed_item_alone(self):
+        response = self.client.post('/users/_bulk', json=[
+            {'action': 'create', 'uuid': 'f9b358cc522a4cb7a60c27da6fbed8f1', 'delta': 1},
+            {'action': 'create', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'delta': 'abc'},
+        ])
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([201, 400], [item['status'] for item in response.json])
+        self.assertIsNotNone(self.fixtures.find_user('f9b358cc522a4cb7a60c27da6fbed8f1'))
+        self.assertIsNone(self.fixtures.find_user('86c822ee6f9a4f69b2f57a9c8702e4a2'))
+
+    def test_get_users_paginated(self):
+        uuids = sorted(f'{index:032x}' for index in range(5))
+        for uuid in uuids:
+            self.fixtures.insert_user(uuid, delta=0, area='ABC')
+        self.fixtures.insert_user('ffffffffffffffffffffffffffffffff', delta=0, area='XYZ')
+
+        pages, url = [], '/users?area=ABC&limit=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(200, response.status_code)
+            pages.append([user['uuid'] for user in response.json])
+            url = response.headers.get('Link', '').partition('>')[0].lstrip('<')
+
+        self.assertEqual([uuids[0:2], uuids[2:4], uuids[4:]], pages)
+
+    def test_get_users_serializers_agree(self):
+        for index in range(3):
+            self.fixtures.insert_user(f'{index:032x}', delta=index, area='ABC' if index else 'XYZ')
+        self.client.get('/stats')
+
+        bodies = {}
+        for serializer in ('dict', 'tuple', 'postgres'):
+            server.server.serializer = serializer
+            for query in ('', '?area=ABC', '?area=none'):
+                response = self.client.get(f'/users{query}')
+                self.assertEqual(200, response.status_code)
+                self.assertEqual('application/json', response.mimetype)
+                bodies[serializer, query] = sorted(response.json, key=lambda user: user['uuid'])
+        server.server.serializer = 'tuple'
+
+        for query, count in (('', 3), ('?area=ABC', 2), ('?area=none', 0)):
+            self.assertEqual(count, len(bodies['dict', query]))
+            self.assertEqual(bodies['dict', query], bodies['tuple', query])
+            self.assertEqual(bodies['dict', query], bodies['postgres', query])
+        self.assertEqual(['area', 'created_at', 'delta', 'updated_at', 'uuid'], sorted(bodies['dict', ''][0]))
+
+    def test_get_user_not_modified(self):
+        uuid = 'f9b358cc522a4cb7a60c27da6fbed8f1'
+        self.fixtures.insert_user(uuid, delta=0, area='ABC')
+
+        etag = self.client.get(f'/users/{uuid}').headers['ETag']
+        not_modified = self.client.get(f'/users/{uuid}', headers={'If-None-Match': etag})
+        self.client.patch(f'/users/{uuid}', json={'delta': 1})
+        modified = self.client.get(f'/users/{uuid}', headers={'If-None-Match': etag})
+
+        self.assertEqual(304, not_modified.status_code)
+        self.assertEqual(etag, not_modified.headers['ETag'])
+        self.assertEqual(b'', not_modified.data)
+        self.assertEqual(200, modified.status_code)
+        self.assertNotEqual(etag, modified.headers['ETag'])
+        self.assertEqual(1, modified.json['delta'])
+
+    def test_get_users_not_modified(self):
+        for uuid in ('f9b358cc522a4cb7a60c27da6fbed8f1', '86c822ee6f9a4f69b2f57a9c8702e4a2'):
+            self.fixtures.insert_user(uuid, delta=0, area='ABC')
+
+        etag = self.client.get('/users?area=ABC').headers['ETag']
+        statuses = [self.client.get('/users?area=ABC', headers={'If-None-Match': etag}).status_code]
+        self.client.patch('/users/f9b358cc522a4cb7a60c27da6fbed8f1', json={'delta': 1})
+        statuses.append(self.client.get('/users?area=ABC', headers={'If-None-Match': etag}).status_code)
+        etag = self.client.get('/users?area=ABC').headers['ETag']
+        self.client.patch('/users/86c822ee6f9a4f69b2f57a9c8702e4a2', json={'area': 'XYZ'})
+        statuses.append(self.client.get('/users?area=ABC', headers={'If-None-Match': etag}).status_code)
+
+        self.assertEqual([304, 200, 200], statuses)
+
+    def test_get_users_streamed(self):
+        uuids = sorted(f'{index:032x}' for index in range(5))
+        for uuid in uuids:
+            self.fixtures.insert_user(uuid, delta=0, area='ABC')
+
+        response = self.client.get('/users?stream=true')
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/x-ndjson', response.mimetype)
+        self.assertEqual(uuids, [loads(line)['uuid'] for line in response.data.splitlines()])
+
+    def test_get_area_stats_follow_writes(self):
+        self.client.post('/users/f9b358cc522a4cb7a60c27da6fbed8f1', json={'delta': 1, 'area': 'ABC'})
+        self.client.post('/users/668e2987956a4943a9e6a2c77e56dc17', json={'delta': 5, 'area': 'ABC'})
+        self.client.post('/users/86c822ee6f9a4f69b2f57a9c8702e4a2', json={'delta': -3, 'area': 'XYZ'})
+        self.client.patch('/users/668e2987956a4943a9e6a2c77e56dc17', json={'area': 'XYZ'})
+        self.client.post('/users/_bulk', json=[
+            {'action': 'update', 'uuid': 'f9b358cc522a4cb7a60c27da6fbed8f1', 'delta': 4},
+            {'action': 'delete', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2'},
+        ])
+
+        response = self.client.get('/areas')
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([
+            {'area': 'ABC', 'users': 1, 'delta_sum': 4, 'delta_min': 4, 'delta_max': 4},
+            {'area': 'XYZ', 'users': 1, 'delta_sum': 5, 'delta_min': 5, 'delta_max': 5},
+        ], response.json)
+        self.assertEqual(response.json[1], self.client.get('/areas/XYZ/stats').json)
+        self.assertEqual(404, self.client.get('/areas/unknown/stats').status_code)
+
+    def test_get_users_changed_follows_cursor_through_deletes(self):
+        uuids = ['668e2987956a4943a9e6a2c77e56dc17', '86c822ee6f9a4f69b2f57a9c8702e4a2',
+                 '94565bc0210546f6990bce590d94be39']
+        self.client.post('/users/_bulk', json=[{'action': 'create', 'uuid': uuid, 'area': 'ABC'} for uuid in uuids])
+
+        def next_page(response):
+            return response.headers['Link'].split(';')[0].strip('<>')
+
+        first = self.client.get('/users?updated_since=2000-01-01T00:00:00Z&limit=2')
+        self.client.delete(f'/users/{uuids[0]}')
+        self.client.patch(f'/users/{uuids[1]}', json={'delta': 5})
+        second = self.client.get(next_page(first))
+        third = self.client.get(next_page(second))
+
+        self.assertEqual(200, first.status_code)
+        # Created in one statement, so the uuid orders the tied timestamps
+        self.assertEqual(uuids[:2], [user['uuid'] for user in first.json])
+        self.assertEqual([(uuids[2], False, 0), (uuids[0], True, None), (uuids[1], False, 5)],
+                         [(change['uuid'], change['deleted'], change['delta']) for change in second.json + third.json])
+        self.assertEqual(400, self.client.get('/users?updated_since=yesterday').status_code)
+
+    def test_get_users_changed_in_area_reports_users_that_left(self):
+        uuid = '668e2987956a4943a9e6a2c77e56dc17'
+        self.client.post(f'/users/{uuid}', json={'area': 'ABC'})
+
+        self.client.patch(f'/users/{uuid}', json={'area': 'XYZ'})
+        left = self.client.get('/users?updated_since=2000-01-01T00:00:00Z&area=ABC').json
+        everywhere = self.client.get('/users?updated_since=2000-01-01T00:00:00Z').json
+        self.client.patch(f'/users/{uuid}', json={'area': 'ABC'})
+        back = self.client.get('/users?updated_since=2000-01-01T00:00:00Z&area=ABC').json
+
+        self.assertEqual([(uuid, 'ABC', True)], [(change['uuid'], change['area'], change['deleted']) for change in left])
+        self.assertEqual([(uuid, 'XYZ', False)],
+                         [(change['uuid'], change['area'], change['deleted']) for change in everywhere])
+        self.assertEqual([(uuid, 'ABC', False)], [(change['uuid'], change['area'], change['deleted']) for change in back])
+
+    def _parallel(self, request, clients=8):
+        def send(index):
+            return request(app.test_client(), index).status_code
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            return sorted(executor.map(send, range(clients)))
+
+    def test_parallel_post_same_user_creates_it_once(self):
+        uuid = 'f9b358cc522a4cb7a60c27da6fbed8f1'
+
+        codes = self._parallel(lambda client, _: client.post(f'/users/{uuid}', json={'delta': 42, 'area': 'ABC'}))
+
+        self.assertEqual([201] + [409] * 7, codes)
+        self.assertEqual(42, self.fixtures.find_user(uuid)['delta'])
+
+    def test_parallel_delete_same_user_deletes_it_once(self):
+        uuid = 'f9b358cc522a4cb7a60c27da6fbed8f1'
+        self.fixtures.insert_user(uuid, delta=0, area='XYZ')
+
+        codes = self._parallel(lambda client, _: client.delete(f'/users/{uuid}'))
+
+        self.assertEqual([200] + [404] * 7, codes)
+        self.assertIsNone(self.fixtures.find_user(uuid))
+
+    def test_parallel_patch_area_reports_consistent_old_area(self):
+        uuid = 'f9b358cc522a4cb7a60c27da6fbed8f1'
+        self.fixtures.insert_user(uuid, delta=0, area='initial')
+        moves = []
+
+        def move(client, index):
+            response = client.patch(f'/users/{uuid}', json={'area': f'area-{index}'})
+            moves.append((response.json['old_area'], response.json['area']))
+            return response
+
+        codes = self._parallel(move)
+
+        self.assertEqual([200] * 8, codes)
+        # The moves must form a single chain starting from the initial area
+        old_areas = {old_area for old_area, _ in moves}
+        new_areas = {new_area for _, new_area in moves}
+        self.assertEqual(8, len(old_areas))
+        self.assertEqual({'initial'}, old_areas - new_areas)
+
+
+class TestServerMemory(TestServer):
+    backend = 'memory'
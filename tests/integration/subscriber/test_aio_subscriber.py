@@ -0,0 +1,54 @@
+import unittest
+from asyncio import create_task, sleep
+from os import getenv
+
+from paho.mqtt import publish
+from ujson import dumps
+
+from subscriber.src.aio_database import AsyncDatabase
+from subscriber.src.aio_subscriber import AsyncSubscriber
+from ..fixtures import Fixtures
+
+TOPIC = 'dummy-topic-aio'
+
+
+class TestAsyncSubscriber(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.fixtures = Fixtures()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.fixtures.clean_database()
+        cls.fixtures.close_connection()
+
+    async def asyncSetUp(self) -> None:
+        self.fixtures.clean_database()
+        self.db = await AsyncDatabase().connect()
+        self.subscriber = AsyncSubscriber(db=self.db, topic=TOPIC)
+        self.task = create_task(self.subscriber.run())
+        await sleep(0.5)
+
+    async def asyncTearDown(self) -> None:
+        self.task.cancel()
+        await self.subscriber.close()
+        await self.db.close()
+
+    async def test_update_users_on_message_successfully(self):
+        users = [{'uuid': f'{index:032x}', 'delta': index} for index in range(20)]
+        for user in users:
+            self.fixtures.insert_user(user['uuid'], 0)
+        publish.multiple(
+            [{'topic': TOPIC, 'payload': dumps({'user': user, 'action': 'update'}), 'qos': 1} for user in users],
+            hostname=getenv('BROKER_HOST'), port=int(getenv('BROKER_PORT'))
+        )
+        await sleep(0.5)
+
+        for user in users:
+            self.assertEqual(user['delta'], self.fixtures.find_user(user['uuid'])['delta'])
+        self.assertEqual(20, self.subscriber.stats()['processed'])
+
+
+if __name__ == '__main__':
+    unittest.main()
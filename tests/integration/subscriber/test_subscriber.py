@@ -3,10 +3,13 @@ from os import getenv
 from time import sleep
 
 from paho.mqtt import publish
+from paho.mqtt.client import MQTTMessage
 from ujson import dumps
 
+from subscriber.src.codec import encode_binary_envelope
+from subscriber.src.memory import MemoryDatabase
 from subscriber.src.subscriber import Subscriber
-from ..fixtures import Fixtures
+from ..fixtures import Fixtures, MemoryFixtures
 
 TOPIC = 'dummy-topic'
 
@@ -32,19 +35,68 @@ class TestSubscriber(unittest.TestCase):
     def setUp(self) -> None:
         self.fixtures.clean_database()
 
-    def test_update_user_on_message_successfully(self):
-        user = {'uuid': '16f39b703ffa41cb9af4d904b773efe2', 'delta': 42}
-        self.fixtures.insert_user(user['uuid'], 0)
+    def deliver(self, payload):
         publish.single(
-            topic=TOPIC, payload=dumps({'user': user, 'action': 'update'}),
+            topic=TOPIC, payload=payload,
             hostname=getenv('BROKER_HOST'), port=int(getenv('BROKER_PORT')), qos=1
         )
         sleep(0.5)
 
+    def test_update_user_on_message_successfully(self):
+        user = {'uuid': '16f39b703ffa41cb9af4d904b773efe2', 'delta': 42}
+        self.fixtures.insert_user(user['uuid'], 0)
+        self.deliver(dumps({'user': user, 'action': 'update'}))
+
         saved_user = self.fixtures.find_user(user['uuid'])
         self.assertIsNotNone(saved_user)
         self.assertEqual(42, saved_user['delta'])
 
+    def test_versioned_update_only_applies_over_older_version(self):
+        uuid = '16f39b703ffa41cb9af4d904b773efe2'
+        self.fixtures.insert_user(uuid, 0)
+        db = self.subscriber.db
+
+        applied = [db.update_user(uuid=uuid, delta=2, version=2) is not None,
+                   db.update_user(uuid=uuid, delta=1, version=1) is not None,
+                   db.update_user(uuid=uuid, delta=2, version=2) is not None]
+        written = db.update_users({uuid: 5}, {uuid: 2}) + db.update_users({uuid: 3}, {uuid: 3})
+
+        self.assertEqual([True, False, False], applied)
+        self.assertEqual(1, written)
+        user = self.fixtures.find_user(uuid)
+        self.assertEqual((3, 3), (user['delta'], user['version']))
+
+    def test_update_users_on_envelope_successfully(self):
+        uuids = ['16f39b703ffa41cb9af4d904b773efe2', '9f3c2b1d4e5a4f6b8c7d0e1f2a3b4c5d']
+        for uuid in uuids:
+            self.fixtures.insert_user(uuid, 0)
+        self.deliver(encode_binary_envelope([
+            {'action': 'update', 'uuid': uuids[0], 'delta': 1},
+            {'action': 'update', 'uuid': uuids[1], 'delta': 2},
+            {'action': 'update', 'uuid': uuids[0], 'delta': 3},
+        ]))
+
+        self.assertEqual([3, 2], [self.fixtures.find_user(uuid)['delta'] for uuid in uuids])
+
+
+class TestSubscriberMemory(TestSubscriber):
+    # Same assertions without a broker, messages go straight to the handler
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.fixtures = MemoryFixtures(MemoryDatabase())
+        cls.subscriber = Subscriber(db=cls.fixtures.db, topic=TOPIC)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.fixtures.clean_database()
+        cls.fixtures.close_connection()
+
+    def deliver(self, payload):
+        message = MQTTMessage(topic=TOPIC.encode())
+        message.payload = payload if isinstance(payload, bytes) else payload.encode()
+        self.subscriber.on_message(self.subscriber, None, message)
+
 
 if __name__ == '__main__':
     unittest.main()
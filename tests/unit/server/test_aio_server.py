@@ -0,0 +1,96 @@
+import unittest
+import unittest.mock
+
+from asyncio_mqtt import MqttError
+
+from server.src.aio_database import AsyncDatabase
+from server.src.aio_server import AsyncDispatcher, AsyncUserServer, database_unavailable
+from server.src.connection import CircuitOpen
+
+
+class TestAsyncDispatcher(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.dispatcher = AsyncDispatcher(unittest.mock.create_autospec(AsyncDatabase), ack_timeout=1)
+        self.dispatcher.client = unittest.mock.AsyncMock()
+        self.events = [
+            {'id': 1, 'area': 'ABC', 'action': 'create', 'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'delta': 0},
+            {'id': 2, 'area': 'ABC', 'action': 'update', 'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'delta': 1},
+            {'id': 3, 'area': 'XYZ', 'action': 'delete', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'delta': 0},
+        ]
+
+    async def test_publish_returns_all_events(self):
+        sent = await self.dispatcher.publish(self.events)
+
+        self.assertEqual(3, sent)
+        self.assertEqual(3, self.dispatcher.client.publish.await_count)
+        self.assertEqual(3, self.dispatcher.stats()['dispatched'])
+
+    async def test_publish_returns_acknowledged_prefix(self):
+        self.dispatcher.client.publish.side_effect = [None, MqttError('timeout'), None]
+
+        sent = await self.dispatcher.publish(self.events)
+
+        self.assertEqual(1, sent)
+
+    async def test_publish_raises_if_first_event_fails(self):
+        self.dispatcher.client.publish.side_effect = MqttError('disconnected')
+
+        with self.assertRaises(MqttError):
+            await self.dispatcher.publish(self.events)
+
+    async def test_publish_both_formats_counts_events(self):
+        self.dispatcher.event_format = 'both'
+        self.dispatcher.client.publish.side_effect = [None, None, None, MqttError('timeout'), None, None]
+
+        sent = await self.dispatcher.publish(self.events)
+
+        self.assertEqual(1, sent)
+        self.assertEqual(6, self.dispatcher.client.publish.await_count)
+
+
+class TestAsyncUserServer(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.db = unittest.mock.create_autospec(AsyncDatabase)
+        self.server = AsyncUserServer(db=self.db)
+
+    async def test_find_user_not_found(self):
+        self.db.find_user.return_value = None
+
+        result, code = await self.server.find_user('668e2987956a4943a9e6a2c77e56dc17')
+
+        self.assertIsNone(result)
+        self.assertEqual(404, code)
+
+    async def test_bulk_write_reports_statuses(self):
+        self.db.bulk_write.return_value = [{'uuid': '668e2987956a4943a9e6a2c77e56dc17'}, None]
+
+        result, code = await self.server.bulk_write([
+            {'action': 'create', 'uuid': '668e2987956a4943a9e6a2c77e56dc17'},
+            {'action': 'delete', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2'},
+            {'action': 'unknown', 'uuid': '94565bc0210546f6990bce590d94be39'},
+        ])
+
+        self.assertEqual(200, code)
+        self.assertEqual([201, 404, 400], [item['status'] for item in result])
+
+    async def test_create_existing_user_conflicts(self):
+        self.db.insert_user.return_value = None
+
+        result, code = await self.server.create_user('668e2987956a4943a9e6a2c77e56dc17', {'delta': 1})
+
+        self.assertIsNone(result)
+        self.assertEqual(409, code)
+
+
+class TestDatabaseUnavailable(unittest.IsolatedAsyncioTestCase):
+    async def test_open_circuit_answers_503_with_retry_after(self):
+        handler = unittest.mock.AsyncMock(side_effect=CircuitOpen('Database circuit breaker is open', 2.5))
+
+        response = await database_unavailable(unittest.mock.MagicMock(), handler)
+
+        self.assertEqual(503, response.status)
+        self.assertEqual('3', response.headers['Retry-After'])
+
+
+if __name__ == '__main__':
+    unittest.main()
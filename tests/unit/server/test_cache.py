@@ -0,0 +1,90 @@
+import unittest
+import unittest.mock
+
+from paho.mqtt.client import MQTTMessage
+from ujson import dumps
+
+from server.src.cache import CacheInvalidator, UserCache
+
+
+class TestUserCache(unittest.TestCase):
+    def test_get_returns_cached_row(self):
+        cache = UserCache(max_size=10, ttl=60)
+        cache.put('668e2987956a4943a9e6a2c77e56dc17', {'uuid': '668e2987956a4943a9e6a2c77e56dc17'})
+
+        self.assertEqual({'uuid': '668e2987956a4943a9e6a2c77e56dc17'}, cache.get('668e2987956a4943a9e6a2c77e56dc17'))
+        self.assertIsNone(cache.get('86c822ee6f9a4f69b2f57a9c8702e4a2'))
+        self.assertEqual(1, cache.stats()['hits'])
+        self.assertEqual(1, cache.stats()['misses'])
+
+    def test_least_recently_used_row_is_evicted(self):
+        cache = UserCache(max_size=2, ttl=60)
+        cache.put('668e2987956a4943a9e6a2c77e56dc17', {})
+        cache.put('86c822ee6f9a4f69b2f57a9c8702e4a2', {})
+        cache.get('668e2987956a4943a9e6a2c77e56dc17')
+        cache.put('94565bc0210546f6990bce590d94be39', {})
+
+        self.assertIsNone(cache.get('86c822ee6f9a4f69b2f57a9c8702e4a2'))
+        self.assertIsNotNone(cache.get('668e2987956a4943a9e6a2c77e56dc17'))
+        self.assertEqual(1, cache.stats()['evictions'])
+
+    def test_expired_row_is_a_miss(self):
+        cache = UserCache(max_size=10, ttl=0)
+        cache.put('668e2987956a4943a9e6a2c77e56dc17', {})
+
+        self.assertIsNone(cache.get('668e2987956a4943a9e6a2c77e56dc17'))
+        self.assertEqual(1, cache.stats()['expirations'])
+
+    def test_put_after_invalidation_is_ignored(self):
+        cache = UserCache(max_size=10, ttl=60)
+        generation = cache.generation
+        cache.invalidate('668e2987956a4943a9e6a2c77e56dc17')
+        cache.put('668e2987956a4943a9e6a2c77e56dc17', {}, generation)
+
+        self.assertIsNone(cache.get('668e2987956a4943a9e6a2c77e56dc17'))
+
+    def test_put_after_invalidation_of_another_user_is_kept(self):
+        cache = UserCache(max_size=10, ttl=60)
+        generation = cache.generation
+        cache.invalidate('86c822ee6f9a4f69b2f57a9c8702e4a2')
+        cache.put('668e2987956a4943a9e6a2c77e56dc17', {}, generation)
+
+        self.assertEqual({}, cache.get('668e2987956a4943a9e6a2c77e56dc17'))
+
+    def test_put_is_ignored_once_its_invalidation_is_forgotten(self):
+        cache = UserCache(max_size=1, ttl=60)
+        generation = cache.generation
+        cache.invalidate('668e2987956a4943a9e6a2c77e56dc17')
+        cache.invalidate('86c822ee6f9a4f69b2f57a9c8702e4a2')
+        cache.put('668e2987956a4943a9e6a2c77e56dc17', {}, generation)
+
+        self.assertIsNone(cache.get('668e2987956a4943a9e6a2c77e56dc17'))
+
+    def test_invalidator_drops_user_from_event(self):
+        cache = UserCache(max_size=10, ttl=60)
+        cache.put('668e2987956a4943a9e6a2c77e56dc17', {})
+        invalidator = CacheInvalidator(cache, topics=['#'])
+        message = MQTTMessage()
+        message.payload = dumps({'action': 'update', 'user': {'uuid': '668e2987956a4943a9e6a2c77e56dc17'}}).encode()
+
+        invalidator.on_message(invalidator, None, message)
+
+        self.assertIsNone(cache.get('668e2987956a4943a9e6a2c77e56dc17'))
+        self.assertEqual(1, cache.stats()['invalidations'])
+
+    @unittest.mock.patch.dict('os.environ', {'USERSERVICE_TOPIC': '_userservice', 'EVENT_FORMAT': 'json'})
+    def test_invalidator_ignores_deltas_not_written_yet(self):
+        cache = UserCache(max_size=10, ttl=60)
+        cache.put('668e2987956a4943a9e6a2c77e56dc17', {})
+        invalidator = CacheInvalidator(cache)
+        message = MQTTMessage(topic=b'_userservice')
+        message.payload = dumps({'action': 'update', 'user': {'uuid': '668e2987956a4943a9e6a2c77e56dc17'}}).encode()
+
+        invalidator.on_message(invalidator, None, message)
+
+        self.assertEqual({}, cache.get('668e2987956a4943a9e6a2c77e56dc17'))
+        self.assertEqual(['_userservice/written', '+'], invalidator.topics)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+
+from ujson import loads
+
+from server.src.codec import BINARY_V1, BINARY_V2, acknowledged_prefix, decode_event, decode_users, encode_binary, \
+    encode_binary_envelope, encode_event, encode_events, encode_json, encode_json_envelope, subscription_topic
+
+
+class TestCodec(unittest.TestCase):
+    def setUp(self) -> None:
+        self.event = {'id': 1, 'area': 'area', 'action': 'update', 'uuid': '668e2987956a4943a9e6a2c77e56dc17',
+                      'delta': -42}
+        self.decoded = {'action': 'update', 'user': {'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'delta': -42}}
+
+    def test_json_round_trip(self):
+        payload = encode_json('update', '668e2987956a4943a9e6a2c77e56dc17', -42)
+
+        self.assertEqual(self.decoded, loads(payload))
+        self.assertEqual(self.decoded, decode_event(payload))
+
+    def test_binary_round_trip(self):
+        payload = encode_binary('update', '668e2987956a4943a9e6a2c77e56dc17', -42)
+
+        self.assertEqual(BINARY_V1.size, len(payload))
+        self.assertEqual(self.decoded, decode_event(payload))
+
+    def test_binary_falls_back_to_json_for_other_uuids(self):
+        for uuid in ('668e2987-956a-4943-a9e6-a2c77e56dc17', '668E2987956A4943A9E6A2C77E56DC17', 'user'):
+            payload = encode_binary('update', uuid, 1)
+
+            self.assertEqual({'action': 'update', 'user': {'uuid': uuid, 'delta': 1}}, decode_event(payload))
+
+    def test_binary_falls_back_to_json_for_out_of_range_delta(self):
+        payload = encode_binary('update', '668e2987956a4943a9e6a2c77e56dc17', 2 ** 31)
+
+        self.assertEqual(2 ** 31, loads(payload)['user']['delta'])
+
+    def test_decode_rejects_unknown_version(self):
+        payload = b'\x09' + encode_binary('update', '668e2987956a4943a9e6a2c77e56dc17', 1)[1:]
+
+        with self.assertRaises(ValueError):
+            decode_event(payload)
+
+    def test_json_with_leading_whitespace(self):
+        for whitespace in (b'\t', b'\n', b'\r', b'\r\n  '):
+            with self.subTest(whitespace=whitespace):
+                self.assertEqual(self.decoded, decode_event(whitespace + encode_json('update', '668e2987956a4943a9e6a2c77e56dc17', -42)))
+
+    def test_decode_rejects_truncated_payload(self):
+        with self.assertRaises(ValueError):
+            decode_event(encode_binary('update', '668e2987956a4943a9e6a2c77e56dc17', 1)[:-1])
+
+    def test_encode_event_formats(self):
+        self.assertEqual(['area'], [topic for topic, _ in encode_event(self.event, 'json')])
+        self.assertEqual(['area/bin'], [topic for topic, _ in encode_event(self.event, 'binary')])
+        messages = encode_event(self.event, 'both')
+        decoded = {'action': 'update', 'user': {**self.decoded['user'], 'version': 1}}
+
+        self.assertEqual(['area', 'area/bin'], [topic for topic, _ in messages])
+        self.assertEqual([decoded, decoded], [decode_event(payload) for _, payload in messages])
+        self.assertEqual(BINARY_V2.size, len(messages[1][1]))
+
+    def test_subscription_topic(self):
+        self.assertEqual('area', subscription_topic('area'))
+        self.assertEqual('area/bin', subscription_topic('area', 'binary'))
+
+    def test_envelope_round_trip(self):
+        events = [{**self.event, 'id': delta + 1, 'delta': delta} for delta in range(3)]
+        expected = [{'uuid': self.event['uuid'], 'delta': delta, 'version': delta + 1} for delta in range(3)]
+
+        for payload in (encode_json_envelope(events), encode_binary_envelope(events)):
+            self.assertEqual(expected, decode_users(payload))
+        self.assertEqual(3 + 3 * 29, len(encode_binary_envelope(events)))
+
+    def test_unversioned_envelope_round_trip(self):
+        events = [{'action': 'update', 'uuid': self.event['uuid'], 'delta': delta} for delta in range(3)]
+        expected = [{'uuid': self.event['uuid'], 'delta': delta} for delta in range(3)]
+
+        for payload in (encode_json_envelope(events), encode_binary_envelope(events)):
+            self.assertEqual(expected, decode_users(payload))
+        self.assertEqual(3 + 3 * 21, len(encode_binary_envelope(events)))
+
+    def test_versioned_binary_round_trip(self):
+        payload = encode_binary('update', '668e2987956a4943a9e6a2c77e56dc17', -42, 2 ** 40)
+
+        self.assertEqual(BINARY_V2.size, len(payload))
+        self.assertEqual({'action': 'update', 'user': {**self.decoded['user'], 'version': 2 ** 40}},
+                         decode_event(payload))
+
+    def test_binary_envelope_falls_back_to_json(self):
+        payload = encode_binary_envelope([self.event, {**self.event, 'uuid': 'user'}])
+
+        self.assertEqual(2, len(loads(payload)['events']))
+
+    def test_decode_rejects_truncated_envelope(self):
+        with self.assertRaises(ValueError):
+            decode_event(encode_binary_envelope([self.event, self.event])[:-1])
+
+    def test_encode_events_groups_by_area_in_order(self):
+        events = [{**self.event, 'area': area, 'delta': delta} for delta, area in enumerate('abaa')]
+
+        groups = encode_events(events, envelope_size=2)
+
+        self.assertEqual([[0, 2], [3], [1]], [indexes for indexes, _ in groups])
+        self.assertEqual([0, 2], [user['delta'] for user in decode_users(groups[0][1][0][1])])
+        self.assertEqual(4, len(encode_events(events)))
+
+    def test_acknowledged_prefix(self):
+        groups = [([0, 2], []), ([3], []), ([1], [])]
+
+        self.assertEqual(4, acknowledged_prefix(groups, [True, True, True]))
+        self.assertEqual(1, acknowledged_prefix(groups, [True, True, False]))
+        self.assertEqual(3, acknowledged_prefix(groups, [True, False, True]))
+        self.assertEqual(0, acknowledged_prefix(groups, [False, True, True]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+import unittest
+import unittest.mock
+from time import monotonic, sleep
+
+from psycopg2 import OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from server.src.connection import Backoff, CircuitBreaker, CircuitOpen
+from server.src.database import Database
+from server.src.pool import ConnectionPool
+
+
+class FaultyServer:
+    # Stands in for postgres: while down nobody can connect, and a restart breaks every connection opened before it
+    def __init__(self):
+        self.up = True
+        self.restarts = 0
+        self.connects = 0
+
+    def connect(self, **_):
+        self.connects += 1
+        if not self.up:
+            raise OperationalError('could not connect to server: Connection refused')
+        connection = unittest.mock.MagicMock()
+        connection.closed = 0
+        connection.get_transaction_status.return_value = TRANSACTION_STATUS_IDLE
+        started = self.restarts
+
+        def execute(*_):
+            if not self.up or started != self.restarts:
+                connection.closed = 2
+                raise OperationalError('server closed the connection unexpectedly')
+
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.execute.side_effect = execute
+        cursor.fetchone.return_value = {'uuid': 'f51b3db90173408480d5f6c16a5652d0'}
+        return connection
+
+    def stop(self):
+        self.up = False
+        self.restarts += 1
+
+    def start(self):
+        self.up = True
+
+
+class TestBackoff(unittest.TestCase):
+    def test_delays_are_jittered_below_the_cap(self):
+        backoff = Backoff(base=0.1, cap=1)
+
+        delays = [delay for delay, _ in zip(backoff.delays(), range(100))]
+
+        self.assertLessEqual(delays[0], 0.1)
+        self.assertTrue(all(0 <= delay <= 1 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+        self.assertLessEqual(backoff.delay(10 ** 6), 1)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_after_threshold_and_fails_fast(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        failing = unittest.mock.Mock(side_effect=OperationalError)
+
+        for _ in range(2):
+            with self.assertRaises(OperationalError):
+                breaker.call(failing)
+        with self.assertRaises(CircuitOpen) as raised:
+            breaker.call(failing)
+
+        self.assertEqual(2, failing.call_count)
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        self.assertGreater(raised.exception.retry_after, 0)
+
+    def test_half_open_lets_a_single_trial_through(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        with self.assertRaises(OperationalError):
+            breaker.call(unittest.mock.Mock(side_effect=OperationalError))
+
+        breaker.allow()
+        with self.assertRaises(CircuitOpen):
+            breaker.allow()
+        breaker.success()
+
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+        self.assertEqual('ok', breaker.call(lambda: 'ok'))
+
+    def test_failed_trial_opens_again(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+        with self.assertRaises(OperationalError):
+            breaker.call(unittest.mock.Mock(side_effect=OperationalError))
+        sleep(0.05)
+
+        with self.assertRaises(OperationalError):
+            breaker.call(unittest.mock.Mock(side_effect=OperationalError))
+
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        self.assertEqual(2, breaker.stats()['opened'])
+
+
+class TestFaultInjection(unittest.TestCase):
+    def setUp(self) -> None:
+        self.postgres = FaultyServer()
+        patcher = unittest.mock.patch('server.src.pool.connect', side_effect=self.postgres.connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(threshold=3, reset_timeout=0.2)
+        self.db = Database(pool=ConnectionPool({}, min_size=2, max_size=2, breaker=self.breaker))
+        self.db.prepare = False
+        self.db.backoff = Backoff(base=0.01, cap=0.05)
+
+    def test_read_is_retried_after_restart(self):
+        self.postgres.stop()
+        self.postgres.start()
+
+        self.assertIsNotNone(self.db.find_user('f51b3db90173408480d5f6c16a5652d0'))
+
+    def test_write_is_not_retried_after_restart(self):
+        self.postgres.stop()
+        self.postgres.start()
+
+        with self.assertRaises(OperationalError):
+            self.db.update_user('f51b3db90173408480d5f6c16a5652d0', delta=1)
+
+    def test_idle_connections_are_probed_after_a_broken_one(self):
+        self.postgres.stop()
+        self.postgres.start()
+
+        # Only the connection in hand breaks, the other one is found broken before it is handed out
+        with self.assertRaises(OperationalError), self.db.pool.connection() as connection:
+            connection.cursor().__enter__().execute('SELECT 1')
+        with self.db.pool.connection() as connection:
+            connection.cursor().__enter__().execute('SELECT 1')
+
+        self.assertEqual(3, self.postgres.connects)
+
+    def test_fails_fast_while_database_is_down(self):
+        self.postgres.stop()
+
+        for _ in range(5):
+            with self.assertRaises((OperationalError, CircuitOpen)):
+                self.db.find_user('f51b3db90173408480d5f6c16a5652d0')
+        connects = self.postgres.connects
+        start = monotonic()
+        with self.assertRaises(CircuitOpen):
+            self.db.find_user('f51b3db90173408480d5f6c16a5652d0')
+
+        self.assertLess(monotonic() - start, 0.01)
+        self.assertEqual(connects, self.postgres.connects)
+        self.assertEqual(CircuitBreaker.OPEN, self.db.stats()['circuit']['state'])
+
+    def test_recovers_within_breaker_reset_after_outage(self):
+        self.postgres.stop()
+        deadline = monotonic() + 0.5
+        while monotonic() < deadline:
+            with self.assertRaises((OperationalError, CircuitOpen)):
+                self.db.find_user('f51b3db90173408480d5f6c16a5652d0')
+            sleep(0.01)
+
+        self.postgres.start()
+        recovered = monotonic()
+        while True:
+            try:
+                self.db.find_user('f51b3db90173408480d5f6c16a5652d0')
+                break
+            except (OperationalError, CircuitOpen):
+                sleep(0.01)
+        recovery_time = monotonic() - recovered
+
+        # At worst the breaker opened just before the database came back
+        self.assertLess(recovery_time, self.breaker.reset_timeout + 0.1)
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+
+
+if __name__ == '__main__':
+    unittest.main()
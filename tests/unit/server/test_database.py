@@ -0,0 +1,20 @@
+import unittest
+
+from server.src.database import prepare_statement
+
+
+class TestPrepareStatement(unittest.TestCase):
+    def test_named_placeholders_become_positional(self):
+        statement, params = prepare_statement(
+            'SELECT * FROM users WHERE uuid = %(uuid)s AND (area = %(area)s OR %(area)s IS NULL)'
+        )
+
+        self.assertEqual('SELECT * FROM users WHERE uuid = $1 AND (area = $2 OR $2 IS NULL)', statement)
+        self.assertEqual(('uuid', 'area'), params)
+
+    def test_statement_without_placeholders(self):
+        self.assertEqual(('SELECT * FROM users', ()), prepare_statement('SELECT * FROM users'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+import unittest.mock
+
+from paho.mqtt.client import MQTTMessageInfo, MQTT_ERR_NO_CONN, MQTT_ERR_SUCCESS
+from ujson import loads
+
+from server.src.database import Database
+from server.src.dispatcher import Dispatcher
+from server.src.publisher import Publisher
+
+
+def message_info(mid, published=True, rc=MQTT_ERR_SUCCESS):
+    info = MQTTMessageInfo(mid)
+    info.rc = rc
+    if published:
+        info._set_as_published()
+    return info
+
+
+class TestDispatcher(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db = unittest.mock.create_autospec(Database)
+        self.publisher = unittest.mock.create_autospec(Publisher)
+        self.publisher.qos = 0
+        self.publisher.wait_published.side_effect = lambda info, timeout: info.is_published()
+        self.dispatcher = Dispatcher(db=self.db, publisher=self.publisher, batch_size=10, ack_timeout=0.01)
+        self.events = [
+            {'id': 1, 'area': 'old_area', 'action': 'delete', 'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'delta': 1},
+            {'id': 2, 'area': 'new_area', 'action': 'create', 'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'delta': 1},
+        ]
+
+    def test_publish_sends_events_in_order(self):
+        self.publisher.send.side_effect = [message_info(1), message_info(2)]
+
+        sent = self.dispatcher.publish(self.events)
+
+        self.assertEqual(2, sent)
+        topics = [call.kwargs['topic'] for call in self.publisher.send.call_args_list]
+        self.assertEqual(['old_area', 'new_area'], topics)
+        payload = loads(self.publisher.send.call_args_list[0].kwargs['payload'])
+        self.assertEqual({'action': 'delete',
+                          'user': {'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'delta': 1, 'version': 1}}, payload)
+
+    def test_publish_stops_at_first_unacknowledged_event(self):
+        self.publisher.send.side_effect = [message_info(1, published=False), message_info(2)]
+
+        sent = self.dispatcher.publish(self.events)
+
+        self.assertEqual(0, sent)
+
+    def test_publish_stops_at_first_rejected_event(self):
+        self.publisher.send.side_effect = [message_info(1), message_info(2, published=False, rc=MQTT_ERR_NO_CONN)]
+
+        sent = self.dispatcher.publish(self.events)
+
+        self.assertEqual(1, sent)
+        self.assertEqual(1, self.dispatcher.dispatched)
+
+    def test_publish_counts_queued_event_as_sent_with_qos(self):
+        self.publisher.qos = 1
+        self.publisher.send.side_effect = [message_info(1), message_info(2, published=False, rc=MQTT_ERR_NO_CONN)]
+
+        sent = self.dispatcher.publish(self.events)
+
+        self.assertEqual(2, sent)
+        self.publisher.wait_published.assert_called_once()
+
+    def test_publish_both_formats_needs_every_message_acknowledged(self):
+        self.dispatcher.event_format = 'both'
+        self.publisher.send.side_effect = [message_info(1), message_info(2), message_info(3),
+                                           message_info(4, published=False)]
+
+        sent = self.dispatcher.publish(self.events)
+
+        self.assertEqual(1, sent)
+        topics = [call.kwargs['topic'] for call in self.publisher.send.call_args_list]
+        self.assertEqual(['old_area', 'old_area/bin', 'new_area', 'new_area/bin'], topics)
+
+    def test_publish_envelopes_groups_events_by_area(self):
+        self.dispatcher.envelope_size = 2
+        events = [{**event, 'id': index, 'area': area}
+                  for index, area in enumerate(['a', 'b', 'a', 'a'], 1) for event in self.events[:1]]
+        self.publisher.send.side_effect = [message_info(1), message_info(2), message_info(3)]
+
+        sent = self.dispatcher.publish(events)
+
+        self.assertEqual(4, sent)
+        topics = [call.kwargs['topic'] for call in self.publisher.send.call_args_list]
+        self.assertEqual(['a', 'a', 'b'], topics)
+        payload = loads(self.publisher.send.call_args_list[0].kwargs['payload'])
+        self.assertEqual(2, len(payload['events']))
+        self.assertEqual(3, self.dispatcher.stats()['messages'])
+
+    def test_publish_envelopes_stops_before_first_unacknowledged_event(self):
+        self.dispatcher.envelope_size = 10
+        events = [{**self.events[0], 'id': index, 'area': area} for index, area in enumerate(['a', 'b', 'a'], 1)]
+        self.publisher.send.side_effect = [message_info(1), message_info(2, published=False)]
+
+        sent = self.dispatcher.publish(events)
+
+        self.assertEqual(1, sent)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import unittest
+from os import path
+from tempfile import TemporaryDirectory
+
+from psycopg2 import DataError
+
+from server.src.memory import MemoryDatabase
+
+
+class TestMemoryDatabase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db = MemoryDatabase(outbox=True, snapshot_path='')
+
+    def test_area_index_follows_moves_and_deletes(self):
+        self.db.insert_user('b', delta=1, area='ABC')
+        self.db.insert_user('a', delta=2, area='ABC')
+        self.db.insert_user('c', delta=3, area='XYZ')
+
+        self.db.update_user('b', area='XYZ')
+        self.db.delete_user('c')
+
+        self.assertEqual(['a'], [user['uuid'] for user in self.db.find_users_by_area('ABC')])
+        self.assertEqual(['b'], [user['uuid'] for user in self.db.find_users_by_area('XYZ')])
+        self.assertEqual(2, self.db.stats()['areas'])
+
+    def test_area_stats_follow_writes(self):
+        self.db.insert_user('a', delta=1, area='ABC')
+        self.db.insert_user('b', delta=5, area='ABC')
+        self.db.insert_user('c', delta=-3, area='XYZ')
+        self.db.insert_user('d', delta=7)
+
+        self.db.update_user('b', area='XYZ')
+        self.db.update_user('a', delta=4)
+        self.db.delete_user('c')
+
+        self.assertEqual([
+            {'area': 'ABC', 'users': 1, 'delta_sum': 4, 'delta_min': 4, 'delta_max': 4},
+            {'area': 'XYZ', 'users': 1, 'delta_sum': 5, 'delta_min': 5, 'delta_max': 5},
+        ], self.db.find_areas())
+        self.db.delete_user('a')
+        self.assertIsNone(self.db.find_area_stats('ABC'))
+
+    def test_users_version_grows_with_writes_to_the_collection(self):
+        self.db.insert_user('a', delta=1, area='ABC')
+        self.db.insert_user('b', delta=1, area='XYZ')
+        versions = [self.db.find_users_version('ABC'), self.db.find_users_version()]
+
+        self.db.update_user('b', delta=2)
+        versions += [self.db.find_users_version('ABC'), self.db.find_users_version()]
+        self.db.update_user('b', area='ABC')
+        versions.append(self.db.find_users_version('ABC'))
+
+        changes = [version['changes'] for version in versions]
+        self.assertEqual(changes[0], changes[2])
+        self.assertLess(changes[1], changes[3])
+        self.assertLess(changes[2], changes[4])
+        self.assertEqual({'changes': 0}, self.db.find_users_version('unknown'))
+
+    def test_find_users_changed_reports_updates_and_deletes_in_order(self):
+        for uuid in ('a', 'b', 'c'):
+            self.db.insert_user(uuid, area='ABC')
+        since = self.db.find_user('c')['updated_at']
+        self.db.update_user('a', delta=1)
+        self.db.delete_user('b')
+
+        changes = self.db.find_users_changed(since)
+        last = changes[1]
+        rest = self.db.find_users_changed(last['updated_at'], after=last['uuid'])
+
+        self.assertEqual([('c', False), ('a', False), ('b', True)],
+                         [(change['uuid'], change['deleted']) for change in changes])
+        self.assertEqual(['b'], [change['uuid'] for change in rest])
+        self.db.insert_user('b', area='XYZ')
+        self.assertEqual([('b', False)], [(change['uuid'], change['deleted'])
+                                          for change in self.db.find_users_changed(since, area='XYZ')])
+
+    def test_find_users_changed_reports_moves_to_the_area_left(self):
+        self.db.insert_user('a', area='ABC')
+        since = self.db.find_user('a')['updated_at']
+
+        def changes(area=None):
+            return [(change['uuid'], change['area'], change['deleted'])
+                    for change in self.db.find_users_changed(since, area=area)]
+
+        self.db.update_user('a', area='XYZ')
+        self.assertEqual([('a', 'ABC', True)], changes('ABC'))
+        self.assertEqual([('a', 'XYZ', False)], changes('XYZ'))
+        self.assertEqual([('a', 'XYZ', False)], changes())
+
+        self.db.update_user('a', area='ABC')
+        self.assertEqual([('a', 'ABC', False)], changes('ABC'))
+        self.assertEqual([('a', 'XYZ', True)], changes('XYZ'))
+
+        self.db.delete_user('a')
+        self.db.bulk_write([{'action': 'create', 'uuid': 'a', 'delta': 0, 'area': 'XYZ'},
+                            {'action': 'update', 'uuid': 'a', 'delta': None, 'area': 'ABC'}])
+        self.assertEqual([('a', 'ABC', False)], changes())
+        self.assertEqual([('a', 'XYZ', True)], changes('XYZ'))
+
+    def test_find_users_page_is_ordered_by_uuid(self):
+        for uuid in ('d', 'b', 'a', 'c'):
+            self.db.insert_user(uuid, area='ABC')
+
+        self.assertEqual(['a', 'b'], [user['uuid'] for user in self.db.find_users_page(area='ABC', limit=2)])
+        self.assertEqual(['c', 'd'], [user['uuid'] for user in self.db.find_users_page(after='b', limit=2)])
+        self.assertEqual([['a', 'b', 'c'], ['d']],
+                         [[user['uuid'] for user in rows] for rows in self.db.iter_users(chunk_size=3)])
+
+    def test_update_reports_old_area_and_events(self):
+        self.db.insert_user('a', delta=0, area='ABC')
+
+        user = self.db.update_user('a', delta=5, area='XYZ')
+
+        self.assertEqual(('ABC', 'XYZ', 5), (user['old_area'], user['area'], user['delta']))
+        self.assertEqual([('ABC', 'create'), ('ABC', 'delete'), ('XYZ', 'create')],
+                         [(event['area'], event['action']) for event in self.db._events])
+
+    def test_values_are_coerced_like_postgres(self):
+        self.assertEqual(5, self.db.insert_user('a', delta='5', area=7)['delta'])
+        self.assertEqual('7', self.db.find_user('a')['area'])
+        self.assertEqual(3, self.db.update_user('a', delta=2.5)['delta'])
+        with self.assertRaises(DataError):
+            self.db.update_user('a', delta=True)
+        with self.assertRaises(DataError):
+            self.db.insert_user('b', delta=2 ** 31)
+
+    def test_bulk_write_applies_nothing_if_an_operation_is_invalid(self):
+        with self.assertRaises(DataError):
+            self.db.bulk_write([
+                {'action': 'create', 'uuid': 'a', 'delta': 1, 'area': 'ABC'},
+                {'action': 'create', 'uuid': 'b', 'delta': 'x', 'area': 'ABC'},
+            ])
+
+        self.assertIsNone(self.db.find_user('a'))
+
+    def test_dispatch_events_removes_acknowledged_prefix(self):
+        for uuid in ('a', 'b', 'c'):
+            self.db.insert_user(uuid, area='ABC')
+
+        sent = self.db.dispatch_events(lambda events: 2, limit=10)
+
+        self.assertEqual(2, sent)
+        self.assertEqual(['c'], [event['uuid'] for event in self.db._events])
+
+    def test_snapshot_restores_users_and_unsent_events(self):
+        with TemporaryDirectory() as directory:
+            snapshot = path.join(directory, 'users.jsonl')
+            db = MemoryDatabase(outbox=True, snapshot_path=snapshot)
+            db.insert_user('a', delta=1, area='ABC')
+            db.insert_user('b', delta=2, area='ABC')
+            db.update_user('a', delta=3, area='XYZ')
+            db.delete_user('b')
+            db.insert_user('c', delta=4, area='ABC')
+            db.delete_user('c')
+            db.dispatch_events(lambda events: 2, limit=10)
+            db.close()
+
+            restored = MemoryDatabase(outbox=True, snapshot_path=snapshot)
+            restored.close()
+
+        self.assertEqual(db.find_all_users(), restored.find_all_users())
+        self.assertEqual(['a'], [user['uuid'] for user in restored.find_users_by_area('XYZ')])
+        self.assertEqual(db._events, restored._events)
+        self.assertEqual(db._changes, restored._changes)
+        self.assertEqual(db._tombstones, restored._tombstones)
+
+
+if __name__ == '__main__':
+    unittest.main()
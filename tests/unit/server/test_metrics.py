@@ -0,0 +1,58 @@
+import unittest
+
+from server.src.metrics import Histogram, Registry
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry = Registry()
+
+    def test_render_histogram_in_prometheus_format(self):
+        histogram = self.registry.histogram('request_seconds', 'Request latency', route='/users/<string:uuid>')
+        histogram.observe(0.0004)
+        histogram.observe(0.003)
+        histogram.observe(20)
+
+        lines = self.registry.render().splitlines()
+
+        self.assertEqual('# HELP request_seconds Request latency', lines[0])
+        self.assertEqual('# TYPE request_seconds histogram', lines[1])
+        self.assertIn('request_seconds_bucket{route="/users/<string:uuid>",le="0.0005"} 1', lines)
+        self.assertIn('request_seconds_bucket{route="/users/<string:uuid>",le="0.005"} 2', lines)
+        self.assertIn('request_seconds_bucket{route="/users/<string:uuid>",le="10.0"} 2', lines)
+        self.assertIn('request_seconds_bucket{route="/users/<string:uuid>",le="+Inf"} 3', lines)
+        self.assertIn('request_seconds_count{route="/users/<string:uuid>"} 3', lines)
+
+    def test_histogram_is_shared_per_labels(self):
+        first = self.registry.histogram('query_seconds', 'Query latency', query='find_user')
+        second = self.registry.histogram('query_seconds', 'Query latency', query='find_user')
+        other = self.registry.histogram('query_seconds', 'Query latency', query='delete_user')
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+
+    def test_register_replaces_previous_histogram(self):
+        self.registry.register('publish_seconds', 'Publish latency', Histogram())
+        histogram = self.registry.register('publish_seconds', 'Publish latency', Histogram())
+        histogram.observe(1)
+
+        self.assertIn('publish_seconds_count 1', self.registry.render().splitlines())
+
+    def test_render_counter_in_prometheus_format(self):
+        self.registry.counter('dropped_total', 'Dropped messages', reason='stale').inc()
+        self.registry.counter('dropped_total', 'Dropped messages', reason='stale').inc(2)
+        self.registry.counter('dropped_total', 'Dropped messages', reason='duplicate')
+
+        lines = self.registry.render().splitlines()
+
+        self.assertEqual(['# HELP dropped_total Dropped messages', '# TYPE dropped_total counter',
+                          'dropped_total{reason="stale"} 3', 'dropped_total{reason="duplicate"} 0'], lines)
+
+    def test_label_values_are_escaped(self):
+        self.registry.histogram('query_seconds', 'Query latency', query='a"b\\c')
+
+        self.assertIn('query_seconds_count{query="a\\"b\\\\c"} 0', self.registry.render().splitlines())
+
+
+if __name__ == '__main__':
+    unittest.main()
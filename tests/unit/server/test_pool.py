@@ -0,0 +1,86 @@
+import unittest
+import unittest.mock
+from threading import Thread
+
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+from server.src.pool import ConnectionPool, PoolTimeout
+
+
+def mock_connection():
+    connection = unittest.mock.MagicMock()
+    connection.closed = 0
+    connection.get_transaction_status.return_value = TRANSACTION_STATUS_IDLE
+    return connection
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self) -> None:
+        patcher = unittest.mock.patch('server.src.pool.connect', side_effect=lambda **_: mock_connection())
+        self.connect = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_opens_min_size_connections(self):
+        pool = ConnectionPool({}, min_size=2, max_size=4)
+
+        self.assertEqual(2, self.connect.call_count)
+        self.assertEqual(2, pool.stats()['idle'])
+
+    def test_checkout_and_checkin(self):
+        pool = ConnectionPool({}, min_size=1, max_size=2)
+
+        with pool.connection() as first, pool.connection() as second:
+            self.assertIsNot(first, second)
+            self.assertEqual(2, pool.stats()['in_use'])
+
+        stats = pool.stats()
+        self.assertEqual(0, stats['in_use'])
+        self.assertEqual(2, stats['idle'])
+        self.assertEqual(2, stats['wait_time']['count'])
+
+    def test_checkout_times_out_when_exhausted(self):
+        pool = ConnectionPool({}, min_size=1, max_size=1, timeout=0.05)
+
+        with pool.connection():
+            with self.assertRaises(PoolTimeout):
+                pool.getconn()
+
+    def test_waiting_checkout_gets_released_connection(self):
+        pool = ConnectionPool({}, min_size=1, max_size=1, timeout=5)
+        connection = pool.getconn()
+        borrowed = []
+
+        waiter = Thread(target=lambda: borrowed.append(pool.getconn()))
+        waiter.start()
+        pool.putconn(connection)
+        waiter.join(timeout=5)
+
+        self.assertEqual([connection], borrowed)
+
+    def test_unhealthy_connection_is_replaced(self):
+        pool = ConnectionPool({}, min_size=1, max_size=1)
+        with pool.connection() as connection:
+            connection.closed = 1
+
+        with pool.connection() as replacement:
+            self.assertIsNot(connection, replacement)
+        self.assertEqual(2, self.connect.call_count)
+
+    def test_checkin_rolls_back_open_transaction(self):
+        pool = ConnectionPool({}, min_size=1, max_size=1)
+        with pool.connection() as connection:
+            connection.get_transaction_status.return_value = TRANSACTION_STATUS_INTRANS
+
+        connection.rollback.assert_called_with()
+
+    def test_stale_connection_is_probed(self):
+        pool = ConnectionPool({}, min_size=1, max_size=1, health_check_interval=0)
+
+        with pool.connection() as connection:
+            pass
+
+        connection.cursor.return_value.__enter__.return_value.execute.assert_called_with('SELECT 1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import unittest.mock
+
+from paho.mqtt.client import MQTTMessageInfo, MQTT_ERR_NO_CONN, MQTT_ERR_QUEUE_SIZE, MQTT_ERR_SUCCESS
+
+from server.src.publisher import Publisher
+
+
+def message_info(mid, rc=MQTT_ERR_SUCCESS):
+    info = MQTTMessageInfo(mid)
+    info.rc = rc
+    return info
+
+
+class TestPublisher(unittest.TestCase):
+    def setUp(self) -> None:
+        self.publisher = Publisher(host='localhost', port=1884, qos=1)
+        self.publisher.publish = unittest.mock.MagicMock()
+
+    def test_send_records_latency_on_ack(self):
+        self.publisher.publish.return_value = message_info(1)
+
+        self.publisher.send(topic='area_name', payload='{}')
+        self.publisher.on_publish(self.publisher, None, 1)
+
+        self.publisher.publish.assert_called_with(topic='area_name', payload='{}', qos=1)
+        self.assertEqual(1, self.publisher.latency.count)
+        self.assertEqual(0, self.publisher.stats()['pending'])
+
+    def test_send_records_latency_when_ack_comes_first(self):
+        def publish(**_):
+            self.publisher.on_publish(self.publisher, None, 2)
+            return message_info(2)
+        self.publisher.publish.side_effect = publish
+
+        self.publisher.send(topic='area_name', payload='{}')
+
+        self.assertEqual(1, self.publisher.latency.count)
+        self.assertEqual(0, self.publisher.stats()['pending'])
+
+    def test_wait_published_returns_once_acknowledged(self):
+        self.publisher.publish.return_value = info = message_info(5)
+        self.publisher.send(topic='area_name', payload='{}')
+
+        self.assertFalse(self.publisher.wait_published(info, timeout=0))
+        self.publisher.on_publish(self.publisher, None, 5)
+
+        self.assertTrue(self.publisher.wait_published(info, timeout=0))
+
+    def test_wait_published_when_ack_comes_first(self):
+        def publish(**_):
+            self.publisher.on_publish(self.publisher, None, 6)
+            return message_info(6)
+        self.publisher.publish.side_effect = publish
+
+        info = self.publisher.send(topic='area_name', payload='{}')
+
+        self.assertTrue(self.publisher.wait_published(info, timeout=0))
+
+    def test_send_keeps_message_queued_while_disconnected(self):
+        self.publisher.publish.return_value = message_info(3, rc=MQTT_ERR_NO_CONN)
+
+        self.publisher.send(topic='area_name', payload='{}')
+
+        self.assertEqual(0, self.publisher.dropped)
+        self.assertEqual(1, self.publisher.stats()['pending'])
+
+    def test_send_drops_message_when_queue_is_full(self):
+        self.publisher.publish.return_value = message_info(4, rc=MQTT_ERR_QUEUE_SIZE)
+
+        self.publisher.send(topic='area_name', payload='{}')
+
+        self.assertEqual(1, self.publisher.dropped)
+        self.assertEqual(0, self.publisher.stats()['pending'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import unittest.mock
+
+from server.src import server as server_module
+from server.src.database import Database
+from server.src.dispatcher import Dispatcher
+from server.src.runner import post_fork, runner_options, worker_exit
+from server.src.server import UserServer
+
+
+class TestRunner(unittest.TestCase):
+    def tearDown(self) -> None:
+        server_module.server = None
+
+    def test_options_from_environment(self):
+        with unittest.mock.patch.dict('os.environ', {'SERVER_WORKERS': '3', 'SERVER_THREADS': '8',
+                                                     'STORAGE_BACKEND': 'postgres'}):
+            options = runner_options(8080)
+
+        self.assertEqual('0.0.0.0:8080', options['bind'])
+        self.assertEqual((3, 8, 'gthread'), (options['workers'], options['threads'], options['worker_class']))
+
+    def test_memory_backend_runs_a_single_worker(self):
+        with unittest.mock.patch.dict('os.environ', {'SERVER_WORKERS': '3', 'STORAGE_BACKEND': 'memory'}):
+            self.assertEqual(1, runner_options(80)['workers'])
+
+    def test_several_workers_refuse_local_cache_invalidation(self):
+        environment = {'SERVER_WORKERS': '3', 'STORAGE_BACKEND': 'postgres', 'USER_CACHE_SIZE': '10',
+                       'USER_CACHE_INVALIDATION': 'local'}
+        with unittest.mock.patch.dict('os.environ', environment), self.assertRaises(RuntimeError):
+            runner_options(80)
+
+        for overrides in ({'USER_CACHE_INVALIDATION': 'mqtt'}, {'USER_CACHE_SIZE': '0'}, {'SERVER_WORKERS': '1'}):
+            with unittest.mock.patch.dict('os.environ', {**environment, **overrides}):
+                self.assertIn('workers', runner_options(80))
+
+    def test_each_worker_opens_and_closes_its_own_server(self):
+        db = unittest.mock.create_autospec(Database)
+        dispatcher = unittest.mock.create_autospec(Dispatcher)
+        worker = UserServer(db=db, dispatcher=dispatcher)
+        with unittest.mock.patch.object(server_module, 'init_server', return_value=worker) as init_server:
+            post_fork(None, None)
+
+        init_server.assert_called_once_with()
+        self.assertIs(worker, server_module.server)
+
+        worker_exit(None, None)
+
+        dispatcher.stop.assert_called_once_with()
+        dispatcher.join.assert_called_once_with()
+        db.close.assert_called_once_with()
+        self.assertIsNone(server_module.server)
+
+
+if __name__ == '__main__':
+    unittest.main()
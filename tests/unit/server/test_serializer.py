@@ -0,0 +1,44 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from flask import jsonify
+
+from server.app import app
+from server.src.database import USER_COLUMNS
+from server.src.serializer import format_http_date, row_encoder
+
+
+class TestSerializer(unittest.TestCase):
+    def setUp(self) -> None:
+        # The app the server runs in, so that its JSON settings apply
+        self.app = app
+        created_at = datetime(2021, 3, 7, 9, 5, 1, 123456, tzinfo=timezone.utc)
+        self.rows = [
+            ('f51b3db90173408480d5f6c16a5652d0', 42, 'A/B "north"', created_at, created_at + timedelta(days=300)),
+            ('86c822ee6f9a4f69b2f57a9c8702e4a2', -7, 'zoné', created_at, created_at),
+        ]
+
+    def test_encode_matches_jsonify(self):
+        with self.app.app_context():
+            expected = jsonify([dict(zip(USER_COLUMNS, row)) for row in self.rows]).get_data(as_text=True)
+
+        self.assertEqual(expected, row_encoder(USER_COLUMNS).encode(self.rows))
+        self.assertTrue(expected.startswith('[{"uuid":'))
+
+    def test_encode_takes_dates_rendered_by_the_database(self):
+        rows = [(*row[:3], format_http_date(row[3]), format_http_date(row[4])) for row in self.rows]
+
+        self.assertEqual(row_encoder(USER_COLUMNS).encode(self.rows), row_encoder(USER_COLUMNS).encode(rows))
+
+    def test_encode_empty(self):
+        self.assertEqual('[]\n', row_encoder(USER_COLUMNS).encode([]))
+
+    def test_format_http_date_converts_to_utc(self):
+        value = datetime(2021, 3, 7, 23, 30, tzinfo=timezone(timedelta(hours=-2)))
+
+        self.assertEqual('Mon, 08 Mar 2021 01:30:00 GMT', format_http_date(value))
+        self.assertIsNone(format_http_date(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,11 @@
 import unittest
 import unittest.mock
+from datetime import datetime, timezone
+from os import environ
 
+from server.src.cache import UserCache
 from server.src.database import Database
-from server.src.server import UserServer
+from server.src.server import UserServer, change_cursor, init_cache, parse_change_cursor, user_etag
 
 
 class TestServer(unittest.TestCase):
@@ -34,6 +37,66 @@ class TestServer(unittest.TestCase):
         self.assertEqual(expected_result, result)
         self.assertEqual(200, code)
 
+    def test_find_users_page_returns_next_cursor_when_page_is_full(self):
+        self.db.find_users_page.return_value = expected_result = [
+            {'uuid': '668e2987956a4943a9e6a2c77e56dc17'},
+            {'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2'}
+        ]
+        result, code, after = self.server.find_users_page(data={'area': 'area_name', 'limit': '2'})
+
+        self.db.find_users_page.assert_called_with(area='area_name', after=None, limit=2)
+        self.assertEqual(expected_result, result)
+        self.assertEqual(200, code)
+        self.assertEqual('86c822ee6f9a4f69b2f57a9c8702e4a2', after)
+
+    def test_find_users_page_last_page_has_no_cursor(self):
+        self.db.find_users_page.return_value = [{'uuid': '94565bc0210546f6990bce590d94be39'}]
+        result, code, after = self.server.find_users_page(
+            data={'after': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'limit': '2'}
+        )
+
+        self.db.find_users_page.assert_called_with(area=None, after='86c822ee6f9a4f69b2f57a9c8702e4a2', limit=2)
+        self.assertEqual(200, code)
+        self.assertIsNone(after)
+
+    def test_find_users_page_invalid_limit(self):
+        for limit in ('abc', '0', '100000'):
+            result, code, after = self.server.find_users_page(data={'limit': limit})
+            self.assertEqual(400, code)
+
+    def test_find_users_changed_returns_cursor_of_last_change(self):
+        updated_at = datetime(2021, 3, 1, 12, 0, 0, 123456, tzinfo=timezone.utc)
+        self.db.find_users_changed.return_value = expected_result = [
+            {'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'updated_at': updated_at}
+        ]
+        result, code, after = self.server.find_users_changed(data={'updated_since': '2021-03-01T00:00:00Z'})
+
+        self.db.find_users_changed.assert_called_with(datetime(2021, 3, 1, tzinfo=timezone.utc), after=None,
+                                                      area=None, limit=100)
+        self.assertEqual(expected_result, result)
+        self.assertEqual(200, code)
+        self.assertEqual((updated_at, '668e2987956a4943a9e6a2c77e56dc17'), parse_change_cursor(after))
+
+    def test_find_users_changed_resumes_from_cursor(self):
+        updated_at = datetime(2021, 3, 1, 12, 0, 0, 123456, tzinfo=timezone.utc)
+        cursor = change_cursor({'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'updated_at': updated_at})
+        self.db.find_users_changed.return_value = []
+        result, code, after = self.server.find_users_changed(
+            data={'updated_since': '2021-03-01T00:00:00', 'after': cursor, 'area': 'area_name'}
+        )
+
+        self.db.find_users_changed.assert_called_with(updated_at, after='668e2987956a4943a9e6a2c77e56dc17',
+                                                      area='area_name', limit=100)
+        self.assertEqual(200, code)
+        self.assertEqual(cursor, after)
+
+    def test_find_users_changed_invalid_parameters(self):
+        for data in ({'updated_since': 'yesterday'}, {'updated_since': '2021-03-01', 'after': 'x-y'}):
+            result, code, after = self.server.find_users_changed(data=data)
+
+            self.assertIsNone(result)
+            self.assertEqual(400, code)
+
     def test_find_user_successfully(self):
         self.db.find_user.return_value = expected_result = {
             'uuid': '668e2987956a4943a9e6a2c77e56dc17'
@@ -52,6 +115,63 @@ class TestServer(unittest.TestCase):
         self.assertEqual(expected_result, result)
         self.assertEqual(404, code)
 
+    def test_find_user_is_served_from_cache(self):
+        server = UserServer(db=self.db, send_updates=False, cache=UserCache(max_size=10, ttl=60))
+        self.db.find_user.reset_mock()
+        self.db.find_user.return_value = expected_result = {
+            'uuid': '668e2987956a4943a9e6a2c77e56dc17'
+        }
+        server.find_user(uuid='668e2987956a4943a9e6a2c77e56dc17')
+        result, code = server.find_user(uuid='668e2987956a4943a9e6a2c77e56dc17')
+
+        self.db.find_user.assert_called_once_with('668e2987956a4943a9e6a2c77e56dc17')
+        self.assertEqual(expected_result, result)
+        self.assertEqual(200, code)
+
+        server.update_user(uuid='668e2987956a4943a9e6a2c77e56dc17', data={'delta': 1})
+        server.find_user(uuid='668e2987956a4943a9e6a2c77e56dc17')
+        self.assertEqual(2, self.db.find_user.call_count)
+
+    def test_find_user_etag_prefers_cached_row(self):
+        updated_at = datetime(2021, 3, 7, tzinfo=timezone.utc)
+        server = UserServer(db=self.db, send_updates=False, cache=UserCache(max_size=10, ttl=60))
+        self.db.find_user_version.reset_mock()
+        self.db.find_user_version.return_value = updated_at
+        self.db.find_user.return_value = {'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'updated_at': updated_at}
+
+        etag = server.find_user_etag('668e2987956a4943a9e6a2c77e56dc17')
+        server.find_user('668e2987956a4943a9e6a2c77e56dc17')
+
+        self.assertEqual(user_etag(updated_at), etag)
+        self.assertEqual(etag, server.find_user_etag('668e2987956a4943a9e6a2c77e56dc17'))
+        self.db.find_user_version.assert_called_once_with('668e2987956a4943a9e6a2c77e56dc17')
+
+    def test_find_all_users_etag_changes_with_version(self):
+        etags = set()
+        for changes in (0, 1, 2):
+            self.db.find_users_version.return_value = {'changes': changes}
+            etags.add(self.server.find_all_users_etag({'area': 'ABC'}))
+
+        self.db.find_users_version.assert_called_with('ABC')
+        self.assertEqual(3, len(etags))
+
+    def test_find_area_stats_successfully(self):
+        self.db.find_area_stats.return_value = expected_result = {
+            'area': 'area_name', 'users': 2, 'delta_sum': 3, 'delta_min': 1, 'delta_max': 2
+        }
+        result, code = self.server.find_area_stats('area_name')
+
+        self.db.find_area_stats.assert_called_with('area_name')
+        self.assertEqual(expected_result, result)
+        self.assertEqual(200, code)
+
+    def test_find_area_stats_unknown_area(self):
+        self.db.find_area_stats.return_value = None
+        result, code = self.server.find_area_stats('area_name')
+
+        self.assertIsNone(result)
+        self.assertEqual(404, code)
+
     def test_update_user_successfully(self):
         self.db.update_user.return_value = expected_result = {
             'uuid': '668e2987956a4943a9e6a2c77e56dc17',
@@ -119,6 +239,50 @@ class TestServer(unittest.TestCase):
         self.assertEqual(expected_result, result)
         self.assertEqual(409, code)
 
+    def test_bulk_write_returns_per_item_status(self):
+        created = {'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'delta': 100, 'area': 'area_name'}
+        deleted = {'uuid': '94565bc0210546f6990bce590d94be39', 'delta': 0, 'area': 'area_name'}
+        self.db.bulk_write.return_value = [created, None, None, deleted]
+        result, code = self.server.bulk_write(data=[
+            {'action': 'create', 'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'delta': 100, 'area': 'area_name'},
+            {'action': 'create', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2'},
+            {'action': 'rename', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2'},
+            {'action': 'update', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'delta': 1},
+            {'action': 'delete', 'uuid': '94565bc0210546f6990bce590d94be39'},
+        ])
+
+        self.db.bulk_write.assert_called_with([
+            {'action': 'create', 'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'delta': 100, 'area': 'area_name'},
+            {'action': 'create', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'delta': None, 'area': None},
+            {'action': 'update', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'delta': 1, 'area': None},
+            {'action': 'delete', 'uuid': '94565bc0210546f6990bce590d94be39', 'delta': None, 'area': None},
+        ])
+        self.assertEqual([201, 409, 400, 404, 200], [item['status'] for item in result])
+        self.assertEqual(created, result[0]['user'])
+        self.assertEqual(200, code)
+
+    def test_bulk_write_rejects_malformed_fields_per_item(self):
+        created = {'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'delta': 1, 'area': ''}
+        self.db.bulk_write.return_value = [created]
+        result, code = self.server.bulk_write(data=[
+            {'action': 'create', 'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'delta': 1},
+            {'action': 'create', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'delta': 'abc'},
+            {'action': 'create', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'delta': True},
+            {'action': 'update', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'delta': 2 ** 31},
+            {'action': 'update', 'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'area': 1},
+        ])
+
+        self.db.bulk_write.assert_called_with([
+            {'action': 'create', 'uuid': '668e2987956a4943a9e6a2c77e56dc17', 'delta': 1, 'area': None},
+        ])
+        self.assertEqual([201, 400, 400, 400, 400], [item['status'] for item in result])
+        self.assertEqual(200, code)
+
+    def test_bulk_write_rejects_non_list_body(self):
+        result, code = self.server.bulk_write(data={'action': 'create'})
+        self.assertIsNone(result)
+        self.assertEqual(400, code)
+
     def test_remove_user_successfully(self):
         self.db.find_user.return_value = self.db.delete_user.return_value = expected_result = {
             'uuid': '668e2987956a4943a9e6a2c77e56dc17',
@@ -136,5 +300,21 @@ class TestServer(unittest.TestCase):
         self.assertEqual(404, code)
 
 
+class TestInitCache(unittest.TestCase):
+    @unittest.mock.patch.dict('os.environ', {'USER_CACHE_SIZE': '10'})
+    @unittest.mock.patch('server.src.server.CacheInvalidator')
+    def test_cache_is_invalidated_over_mqtt_by_default(self, invalidator):
+        with unittest.mock.patch.dict('os.environ'):
+            environ.pop('USER_CACHE_INVALIDATION', None)
+            cache = init_cache()
+
+        invalidator.assert_called_once_with(cache)
+        invalidator.return_value.start.assert_called_once_with()
+
+    @unittest.mock.patch.dict('os.environ', {'USER_CACHE_SIZE': '0'})
+    def test_cache_is_off_without_size(self):
+        self.assertIsNone(init_cache())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import unittest.mock
+from asyncio import Event, Queue, TimeoutError, create_task, sleep, wait_for
+
+from subscriber.src.aio_database import AsyncDatabase
+from subscriber.src.aio_subscriber import AsyncSubscriber
+
+
+class TestAsyncSubscriber(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.db = unittest.mock.create_autospec(AsyncDatabase)
+        self.subscriber = AsyncSubscriber(db=self.db, topic='dummy-topic', concurrency=2)
+
+    async def test_on_message_updates_user(self):
+        message = unittest.mock.Mock(payload=b'{"action": "update", "user": {"uuid": "a", "delta": 42}}')
+
+        await self.subscriber.on_message(message)
+        await self.subscriber.close()
+
+        self.db.update_user.assert_awaited_once_with(uuid='a', delta=42, version=None)
+        self.assertEqual(1, self.subscriber.stats()['processed'])
+
+    async def test_stale_versions_are_dropped(self):
+        for version in (3, 1, 3):
+            await self.subscriber.handle_user({'uuid': 'a', 'delta': version, 'version': version})
+        await self.subscriber.close()
+
+        self.db.update_user.assert_awaited_once_with(uuid='a', delta=3, version=3)
+        self.assertEqual(1, self.subscriber.stats()['versions']['stale'])
+
+    async def test_same_user_writes_are_ordered_and_coalesced(self):
+        release = Event()
+        written = []
+
+        async def update_user(uuid, delta, version=None):
+            await release.wait()
+            written.append(delta)
+
+        self.db.update_user.side_effect = update_user
+        for delta in range(5):
+            await self.subscriber.handle_user({'uuid': 'a', 'delta': delta})
+        release.set()
+        await self.subscriber.close()
+
+        self.assertEqual([0, 4], written)
+        self.assertEqual(3, self.subscriber.stats()['coalesced'])
+
+    async def test_concurrency_is_limited(self):
+        release = Event()
+        running = []
+
+        async def update_user(uuid, delta, version=None):
+            running.append(uuid)
+            await release.wait()
+
+        self.db.update_user.side_effect = update_user
+        await self.subscriber.handle_user({'uuid': 'a', 'delta': 1})
+        await self.subscriber.handle_user({'uuid': 'b', 'delta': 1})
+        blocked = self.subscriber.handle_user({'uuid': 'c', 'delta': 1})
+        with self.assertRaises(TimeoutError):
+            await wait_for(blocked, 0.05)
+        self.assertEqual(['a', 'b'], running)
+
+        release.set()
+        await self.subscriber.handle_user({'uuid': 'c', 'delta': 1})
+        await self.subscriber.close()
+        self.assertEqual(3, self.subscriber.stats()['processed'])
+
+    async def test_failed_write_is_counted(self):
+        self.db.update_user.side_effect = OSError('connection lost')
+
+        await self.subscriber.handle_user({'uuid': 'a', 'delta': 1})
+        await self.subscriber.close()
+
+        self.assertEqual(1, self.subscriber.stats()['failed'])
+        self.assertEqual(0, self.subscriber.stats()['in_flight'])
+
+    async def test_drain_unsubscribes_then_handles_what_already_arrived(self):
+        inbox = Queue()
+
+        async def messages():
+            while True:
+                yield await inbox.get()
+
+        async def unsubscribe(topics):
+            # Sent by the broker before it acknowledged the unsubscribe
+            inbox.put_nowait(unittest.mock.Mock(payload=b'{"user": {"uuid": "b", "delta": 2}}'))
+
+        self.subscriber.client = unittest.mock.Mock(unsubscribe=unittest.mock.AsyncMock(side_effect=unsubscribe))
+        inbox.put_nowait(unittest.mock.Mock(payload=b'{"user": {"uuid": "a", "delta": 1}}'))
+        consuming = create_task(self.subscriber.consume(messages()))
+        while not self.db.update_user.await_count:
+            await sleep(0.01)
+        self.subscriber.drain()
+        await wait_for(consuming, 1)
+        await self.subscriber.close()
+
+        self.subscriber.client.unsubscribe.assert_awaited_once_with(['dummy-topic'])
+        self.assertEqual(['a', 'b'], [call.kwargs['uuid'] for call in self.db.update_user.await_args_list])
+        self.assertTrue(self.subscriber.draining)
+
+
+if __name__ == '__main__':
+    unittest.main()
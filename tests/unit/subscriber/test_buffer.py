@@ -0,0 +1,109 @@
+import unittest
+import unittest.mock
+
+from psycopg2 import DataError, OperationalError
+
+from subscriber.src.buffer import WriteBuffer
+from subscriber.src.connection import Backoff, CircuitOpen
+from subscriber.src.database import Database
+
+
+class TestWriteBuffer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db = unittest.mock.create_autospec(Database)
+        self.db.update_users.side_effect = lambda deltas, versions=None: len(deltas)
+
+    def test_coalesces_to_last_delta_per_user(self):
+        buffer = WriteBuffer(self.db, max_size=100, max_delay=10)
+        buffer.start()
+        buffer.add(uuid='f51b3db90173408480d5f6c16a5652d0', delta=1, version=7)
+        buffer.add(uuid='a1d8f0e2d5a44f5f8c2b9e1a5f3c7d90', delta=2)
+        buffer.add(uuid='f51b3db90173408480d5f6c16a5652d0', delta=3, version=8)
+        buffer.close(timeout=5)
+
+        self.db.update_users.assert_called_once_with({
+            'f51b3db90173408480d5f6c16a5652d0': 3,
+            'a1d8f0e2d5a44f5f8c2b9e1a5f3c7d90': 2
+        }, {'f51b3db90173408480d5f6c16a5652d0': 8})
+        stats = buffer.stats()
+        self.assertEqual(3, stats['received'])
+        self.assertEqual(1, stats['coalesced'])
+        self.assertEqual(2, stats['written'])
+        self.assertEqual(1, stats['flush_latency']['count'])
+
+    def test_written_batch_is_reported(self):
+        buffer = WriteBuffer(self.db)
+        buffer.on_written = unittest.mock.MagicMock()
+
+        buffer.flush({'f51b3db90173408480d5f6c16a5652d0': 1})
+
+        buffer.on_written.assert_called_once_with({'f51b3db90173408480d5f6c16a5652d0': 1})
+
+    def test_flushes_when_batch_is_full(self):
+        buffer = WriteBuffer(self.db, max_size=2, max_delay=10)
+        buffer.start()
+        buffer.add(uuid='f51b3db90173408480d5f6c16a5652d0', delta=1)
+        buffer.add(uuid='a1d8f0e2d5a44f5f8c2b9e1a5f3c7d90', delta=2)
+
+        for _ in range(500):
+            if self.db.update_users.called:
+                break
+            buffer.join(timeout=0.01)
+        self.db.update_users.assert_called_once()
+        buffer.close(timeout=5)
+
+    def test_connection_error_keeps_deltas_for_next_flush(self):
+        buffer = WriteBuffer(self.db)
+        self.db.update_users.side_effect = OperationalError()
+        buffer.add(uuid='f51b3db90173408480d5f6c16a5652d0', delta=4)
+
+        buffer.flush({'f51b3db90173408480d5f6c16a5652d0': 1, 'a1d8f0e2d5a44f5f8c2b9e1a5f3c7d90': 2})
+
+        self.assertEqual(2, buffer.stats()['pending'])
+        self.assertEqual(4, buffer._deltas['f51b3db90173408480d5f6c16a5652d0'])
+
+    def test_data_error_drops_batch(self):
+        buffer = WriteBuffer(self.db)
+        buffer.on_failed = unittest.mock.MagicMock()
+        self.db.update_users.side_effect = DataError()
+
+        buffer.flush({'f51b3db90173408480d5f6c16a5652d0': 1}, {'f51b3db90173408480d5f6c16a5652d0': 7})
+
+        self.assertEqual(0, buffer.stats()['pending'])
+        self.assertEqual(1, buffer.stats()['failed'])
+        buffer.on_failed.assert_called_once_with({'f51b3db90173408480d5f6c16a5652d0': 1},
+                                                 {'f51b3db90173408480d5f6c16a5652d0': 7})
+
+    def test_close_retries_deltas_of_failed_flush(self):
+        buffer = WriteBuffer(self.db, max_delay=10)
+        buffer.backoff = Backoff(base=0.001)
+        self.db.update_users.side_effect = [OperationalError(), CircuitOpen('Database circuit is open'), 1]
+        buffer.start()
+        buffer.add(uuid='f51b3db90173408480d5f6c16a5652d0', delta=1)
+
+        self.assertTrue(buffer.close(timeout=5))
+        self.assertEqual(3, self.db.update_users.call_count)
+        self.assertEqual(1, buffer.stats()['written'])
+
+    def test_close_drops_deltas_once_flush_timeout_passed(self):
+        buffer = WriteBuffer(self.db, max_delay=10, flush_timeout=0.05)
+        buffer.backoff = Backoff(base=0.001)
+        self.db.update_users.side_effect = OperationalError()
+        buffer.start()
+        buffer.add(uuid='f51b3db90173408480d5f6c16a5652d0', delta=1)
+
+        self.assertFalse(buffer.close(timeout=5))
+        self.assertEqual(1, buffer.stats()['dropped'])
+        self.assertEqual(0, buffer.stats()['pending'])
+
+    def test_add_after_close_fails(self):
+        buffer = WriteBuffer(self.db)
+        buffer.start()
+        buffer.close(timeout=5)
+
+        with self.assertRaises(RuntimeError):
+            buffer.add(uuid='f51b3db90173408480d5f6c16a5652d0', delta=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import unittest.mock
+
+from psycopg2 import OperationalError
+
+from subscriber.src.aio_database import AsyncDatabase
+from subscriber.src.connection import Backoff
+from subscriber.src.database import Database
+
+
+class TestInitConnection(unittest.TestCase):
+    @unittest.mock.patch('subscriber.src.database.sleep')
+    @unittest.mock.patch('subscriber.src.database.connect')
+    def test_keeps_retrying_with_capped_backoff(self, connect, sleep):
+        connection = unittest.mock.MagicMock()
+        connect.side_effect = [OperationalError] * 20 + [connection]
+
+        result = Database._init_connection({}, keep_retrying=True, backoff=Backoff(base=0.1, cap=2))
+
+        self.assertIs(connection, result)
+        self.assertEqual(20, sleep.call_count)
+        self.assertTrue(all(0 <= call.args[0] <= 2 for call in sleep.call_args_list))
+
+    @unittest.mock.patch('subscriber.src.database.sleep')
+    @unittest.mock.patch('subscriber.src.database.connect', side_effect=OperationalError)
+    def test_raises_without_retrying(self, connect, sleep):
+        with self.assertRaises(OperationalError):
+            Database._init_connection({}, keep_retrying=False)
+
+        sleep.assert_not_called()
+
+
+class TestAsyncConnect(unittest.IsolatedAsyncioTestCase):
+    @unittest.mock.patch('subscriber.src.aio_database.sleep')
+    @unittest.mock.patch('subscriber.src.aio_database.create_pool', new_callable=unittest.mock.AsyncMock)
+    async def test_keeps_retrying_with_capped_backoff(self, create_pool, sleep):
+        pool = unittest.mock.MagicMock()
+        create_pool.side_effect = [ConnectionRefusedError] * 20 + [pool]
+
+        db = await AsyncDatabase().connect({}, keep_retrying=True, backoff=Backoff(base=0.1, cap=2))
+
+        self.assertIs(pool, db.pool)
+        self.assertEqual(20, sleep.await_count)
+        self.assertTrue(all(0 <= call.args[0] <= 2 for call in sleep.await_args_list))
+
+    @unittest.mock.patch('subscriber.src.aio_database.sleep')
+    @unittest.mock.patch('subscriber.src.aio_database.create_pool', side_effect=ConnectionRefusedError)
+    async def test_raises_without_retrying(self, create_pool, sleep):
+        with self.assertRaises(ConnectionRefusedError):
+            await AsyncDatabase().connect({})
+
+        sleep.assert_not_awaited()
+
+
+if __name__ == '__main__':
+    unittest.main()
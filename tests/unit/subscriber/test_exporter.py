@@ -0,0 +1,34 @@
+import unittest
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from subscriber.src.exporter import MetricsExporter
+from subscriber.src.metrics import Registry
+
+
+class TestMetricsExporter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry = Registry()
+        self.registry.histogram('message_seconds', 'Message latency').observe(0.01)
+        self.exporter = MetricsExporter(registry=self.registry, host='127.0.0.1', port=0)
+        self.exporter.start()
+
+    def tearDown(self) -> None:
+        self.exporter.stop()
+
+    def test_serves_metrics(self):
+        with urlopen(f'http://127.0.0.1:{self.exporter.port}/metrics') as response:
+            body = response.read().decode()
+
+        self.assertEqual('text/plain; version=0.0.4', response.headers['Content-Type'])
+        self.assertIn('message_seconds_count 1', body.splitlines())
+
+    def test_unknown_path_is_not_found(self):
+        with self.assertRaises(HTTPError) as context:
+            urlopen(f'http://127.0.0.1:{self.exporter.port}/other')
+
+        self.assertEqual(404, context.exception.code)
+
+
+if __name__ == '__main__':
+    unittest.main()
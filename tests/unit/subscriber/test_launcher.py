@@ -0,0 +1,111 @@
+import os
+import signal
+import sys
+import time
+import unittest
+from functools import partial
+from select import select
+
+from subscriber.src.launcher import Launcher
+
+
+def drains_on_sigterm(started, index):
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    os.write(started, b'.')
+    while True:
+        time.sleep(0.01)
+
+
+def never_installs_handlers(started, index):
+    os.write(started, b'.')
+    while True:
+        time.sleep(0.01)
+
+
+def ignores_sigterm(started, index):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    os.write(started, b'.')
+    while True:
+        time.sleep(0.01)
+
+
+class TestLauncher(unittest.TestCase):
+    def setUp(self) -> None:
+        # A plain pipe, as children get killed and must not die holding a lock the test waits on
+        self.ready, self.started = os.pipe()
+
+    def tearDown(self) -> None:
+        os.close(self.ready)
+        os.close(self.started)
+
+    def launcher(self, target, processes, **kwargs) -> Launcher:
+        launcher = Launcher(partial(target, self.started), processes=processes, **kwargs)
+        launcher.start()
+        self.wait_started(processes)
+        return launcher
+
+    def wait_started(self, processes):
+        # Signals sent before a child installed its handlers would not exercise the drain
+        for _ in range(processes):
+            self.assertTrue(select([self.ready], [], [], 5)[0])
+            os.read(self.ready, 1)
+
+    def test_starts_one_process_per_index(self):
+        launcher = self.launcher(drains_on_sigterm, processes=3, drain_timeout=5)
+        try:
+            self.assertEqual([0, 1, 2], sorted(launcher.children))
+            self.assertEqual(3, len({process.pid for process in launcher.children.values()}))
+        finally:
+            launcher.stop()
+
+        self.assertEqual([0, 0, 0], [process.exitcode for process in launcher.children.values()])
+
+    def test_restarts_a_process_that_died(self):
+        launcher = self.launcher(drains_on_sigterm, processes=2, drain_timeout=5, restart_delay=0)
+        try:
+            crashed = launcher.children[1]
+            os.kill(crashed.pid, signal.SIGKILL)
+            crashed.join()
+            launcher.check(timeout=0)
+
+            self.assertEqual(1, launcher.restarts)
+            self.assertIsNot(crashed, launcher.children[1])
+            self.wait_started(1)
+            self.assertTrue(launcher.children[1].is_alive())
+        finally:
+            launcher.stop()
+
+    def test_reload_replaces_every_process(self):
+        launcher = self.launcher(drains_on_sigterm, processes=2, drain_timeout=5)
+        try:
+            before = dict(launcher.children)
+            launcher.reload()
+            self.wait_started(2)
+
+            self.assertEqual([0, 0], [process.exitcode for process in before.values()])
+            self.assertTrue(all(process.is_alive() for process in launcher.children.values()))
+            self.assertFalse(set(before.values()) & set(launcher.children.values()))
+        finally:
+            launcher.stop()
+
+    def test_stop_kills_processes_that_do_not_drain_in_time(self):
+        launcher = self.launcher(ignores_sigterm, processes=1, drain_timeout=0.2)
+        launcher.stop()
+
+        self.assertEqual(-signal.SIGKILL, launcher.children[0].exitcode)
+        self.assertEqual(0, launcher.restarts)
+
+    def test_children_do_not_inherit_the_launcher_handlers(self):
+        # As in run(), where the launcher's own handlers are installed before any child is forked
+        previous = signal.signal(signal.SIGTERM, lambda signum, frame: None)
+        try:
+            launcher = self.launcher(never_installs_handlers, processes=1, drain_timeout=5)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+        launcher.stop()
+
+        self.assertEqual(-signal.SIGTERM, launcher.children[0].exitcode)
+
+
+if __name__ == '__main__':
+    unittest.main()
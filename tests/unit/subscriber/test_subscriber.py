@@ -1,11 +1,14 @@
 import unittest
 import unittest.mock
 
-from paho.mqtt.client import MQTTMessage
-from ujson import dumps
+from paho.mqtt.client import MQTTMessage, MQTTv5
+from psycopg2 import DataError, OperationalError
+from ujson import dumps, loads
 
+from subscriber.src.buffer import WriteBuffer
 from subscriber.src.database import Database
-from subscriber.src.subscriber import Subscriber
+from subscriber.src.subscriber import Subscriber, init_database, subscription_topics
+from subscriber.src.workers import WorkerPool
 
 
 class TestSubscriber(unittest.TestCase):
@@ -28,9 +31,149 @@ class TestSubscriber(unittest.TestCase):
             message=message
         )
 
-        self.db.update_user.assert_called_with(uuid=user.get('uuid'), delta=user.get('delta'))
+        self.db.update_user.assert_called_with(uuid=user.get('uuid'), delta=user.get('delta'), version=None)
         self.assertEqual(user, result)
 
+    def test_update_is_announced_once_written(self):
+        subscriber = Subscriber(db=self.db)
+        subscriber.publish = unittest.mock.MagicMock()
+        self.db.update_user.return_value = user = {'uuid': 'f51b3db90173408480d5f6c16a5652d0', 'delta': 42}
+        message = MQTTMessage()
+        message.payload = dumps({'user': user}).encode()
+
+        subscriber.on_message(client=subscriber, userdata=None, message=message)
+
+        topic, payload = subscriber.publish.call_args.args
+        self.assertEqual('_userservice/written', topic)
+        self.assertEqual({'events': [{'action': 'update', 'user': user}]}, loads(payload))
+
+    def test_on_message_buffers_update_when_batching(self):
+        buffer = unittest.mock.create_autospec(WriteBuffer)
+        subscriber = Subscriber(db=self.db, buffer=buffer)
+        user = {'uuid': 'f51b3db90173408480d5f6c16a5652d0', 'delta': 42}
+        message = MQTTMessage()
+        message.payload = dumps({'user': user}).encode()
+
+        subscriber.on_message(client=subscriber, userdata=None, message=message)
+
+        buffer.add.assert_called_with(uuid=user.get('uuid'), delta=user.get('delta'), version=None)
+
+    def test_on_message_submits_update_to_workers_by_uuid(self):
+        workers = unittest.mock.create_autospec(WorkerPool)
+        subscriber = Subscriber(db=self.db, workers=workers)
+        user = {'uuid': 'f51b3db90173408480d5f6c16a5652d0', 'delta': 42}
+        message = MQTTMessage()
+        message.payload = dumps({'user': user}).encode()
+
+        subscriber.on_message(client=subscriber, userdata=None, message=message)
+
+        workers.submit.assert_called_with(user.get('uuid'), subscriber.handle_user, user)
+
+    def test_on_message_drops_duplicate_and_stale_versions(self):
+        db = unittest.mock.create_autospec(Database)
+        subscriber = Subscriber(db=db)
+        for version in (2, 2, 1, 3):
+            message = MQTTMessage()
+            message.payload = dumps({'user': {'uuid': 'f51b3db90173408480d5f6c16a5652d0', 'delta': version,
+                                              'version': version}}).encode()
+            subscriber.on_message(client=subscriber, userdata=None, message=message)
+
+        self.assertEqual([2, 3], [call.kwargs['version'] for call in db.update_user.call_args_list])
+        self.assertEqual({'tracked': 1, 'duplicates': 1, 'stale': 1}, subscriber.versions.stats())
+
+    def test_failed_update_does_not_drop_redelivery(self):
+        db = unittest.mock.create_autospec(Database)
+        db.update_user.side_effect = [OperationalError(), {'uuid': 'f51b3db90173408480d5f6c16a5652d0'}]
+        subscriber = Subscriber(db=db)
+        message = MQTTMessage()
+        message.payload = dumps({'user': {'uuid': 'f51b3db90173408480d5f6c16a5652d0', 'delta': 1,
+                                          'version': 1}}).encode()
+
+        with self.assertRaises(OperationalError):
+            subscriber.on_message(client=subscriber, userdata=None, message=message)
+        subscriber.on_message(client=subscriber, userdata=None, message=message)
+
+        self.assertEqual(2, db.update_user.call_count)
+
+    def test_refused_buffered_batch_does_not_drop_redelivery(self):
+        db = unittest.mock.create_autospec(Database)
+        db.update_users.side_effect = DataError()
+        buffer = WriteBuffer(db)
+        subscriber = Subscriber(db=db, buffer=buffer)
+        message = MQTTMessage()
+        message.payload = dumps({'user': {'uuid': 'f51b3db90173408480d5f6c16a5652d0', 'delta': 1,
+                                          'version': 1}}).encode()
+
+        subscriber.on_message(client=subscriber, userdata=None, message=message)
+        buffer.flush(*buffer._take())
+
+        self.assertTrue(subscriber.versions.accept('f51b3db90173408480d5f6c16a5652d0', 1))
+
+    def test_on_message_applies_envelope_in_one_transaction(self):
+        db = unittest.mock.create_autospec(Database)
+        db.update_users.return_value = 2
+        subscriber = Subscriber(db=db)
+        message = MQTTMessage()
+        message.payload = dumps({'events': [
+            {'action': 'update', 'user': {'uuid': 'f51b3db90173408480d5f6c16a5652d0', 'delta': 1}},
+            {'action': 'update', 'user': {'uuid': '86c822ee6f9a4f69b2f57a9c8702e4a2', 'delta': 2}},
+            {'action': 'update', 'user': {'uuid': 'f51b3db90173408480d5f6c16a5652d0', 'delta': 3}},
+        ]}).encode()
+
+        result = subscriber.on_message(client=subscriber, userdata=None, message=message)
+
+        db.update_users.assert_called_once_with({'f51b3db90173408480d5f6c16a5652d0': 3,
+                                                 '86c822ee6f9a4f69b2f57a9c8702e4a2': 2}, {})
+        db.update_user.assert_not_called()
+        self.assertEqual(2, result)
+
+    def test_on_message_submits_envelope_to_workers_by_topic(self):
+        workers = unittest.mock.create_autospec(WorkerPool)
+        subscriber = Subscriber(db=self.db, workers=workers)
+        user = {'uuid': 'f51b3db90173408480d5f6c16a5652d0', 'delta': 42}
+        message = MQTTMessage(topic=b'area')
+        message.payload = dumps({'events': [{'action': 'update', 'user': user}]}).encode()
+
+        subscriber.on_message(client=subscriber, userdata=None, message=message)
+
+        workers.submit.assert_called_with('area', subscriber.handle_envelope, [user])
+
+
+class TestInitDatabase(unittest.TestCase):
+    @unittest.mock.patch.dict('os.environ', {'STORAGE_BACKEND': 'memory'})
+    def test_refuses_memory_backend(self):
+        with self.assertRaises(RuntimeError):
+            init_database()
+
+
+class TestSubscriptions(unittest.TestCase):
+    def test_subscription_topics_per_format_and_share_group(self):
+        self.assertEqual(['north', 'south'], subscription_topics('north, south', 'json', ''))
+        self.assertEqual(['$share/ingest/north/bin', '$share/ingest/south/bin'],
+                         subscription_topics('north,south', 'binary', 'ingest'))
+
+    def test_share_group_subscribes_over_mqtt_5(self):
+        client = unittest.mock.Mock()
+        with unittest.mock.patch.dict('os.environ', {'USERSERVICE_TOPIC': 'north,south', 'USERSERVICE_QOS': '1',
+                                                     'SUBSCRIBER_SHARE_GROUP': 'ingest'}):
+            subscriber = Subscriber(db=unittest.mock.create_autospec(Database))
+            subscriber.on_connect(client, None, {}, 0, None)
+
+        self.assertEqual(MQTTv5, subscriber._protocol)
+        client.subscribe.assert_called_once_with([('$share/ingest/north', 1), ('$share/ingest/south', 1)])
+
+    def test_drain_unsubscribes_before_disconnecting(self):
+        subscriber = Subscriber(db=unittest.mock.create_autospec(Database), topic=['north', 'south'])
+        with unittest.mock.patch.object(subscriber, 'is_connected', return_value=True), \
+                unittest.mock.patch.object(subscriber, 'unsubscribe') as unsubscribe, \
+                unittest.mock.patch.object(subscriber, 'disconnect') as disconnect:
+            subscriber.drain()
+            unsubscribe.assert_called_once_with(['north', 'south'])
+            disconnect.assert_not_called()
+
+            subscriber.on_unsubscribe(subscriber, None, 1)
+            disconnect.assert_called_once_with()
+
 
 if __name__ == '__main__':
     unittest.main()
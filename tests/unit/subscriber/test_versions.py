@@ -0,0 +1,42 @@
+import unittest
+
+from subscriber.src.versions import VersionTracker
+
+
+class TestVersionTracker(unittest.TestCase):
+    def setUp(self) -> None:
+        self.versions = VersionTracker(max_size=2)
+
+    def test_drops_duplicates_and_stale_versions(self):
+        accepted = [self.versions.accept('a', version) for version in (2, 2, 1, 3)]
+
+        self.assertEqual([True, False, False, True], accepted)
+        self.assertEqual({'tracked': 1, 'duplicates': 1, 'stale': 1}, self.versions.stats())
+
+    def test_unversioned_messages_are_always_accepted(self):
+        self.versions.accept('a', 2)
+
+        self.assertTrue(self.versions.accept('a', None))
+        self.assertTrue(self.versions.accept('a', None))
+
+    def test_least_recently_seen_uuid_is_forgotten(self):
+        self.versions.accept('a', 1)
+        self.versions.accept('b', 1)
+        self.versions.accept('a', 2)
+        self.versions.accept('c', 1)
+
+        self.assertTrue(self.versions.accept('b', 1))
+        self.assertFalse(self.versions.accept('c', 1))
+
+    def test_forget_allows_redelivery_of_failed_write(self):
+        self.versions.accept('a', 1)
+        self.versions.accept('a', 2)
+        self.versions.forget('a', 1)
+        self.assertFalse(self.versions.accept('a', 2))
+
+        self.versions.forget('a', 2)
+        self.assertTrue(self.versions.accept('a', 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
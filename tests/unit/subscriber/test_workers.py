@@ -0,0 +1,58 @@
+import unittest
+from threading import current_thread, Event
+
+from subscriber.src.workers import WorkerPool
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self) -> None:
+        self.pool = WorkerPool(workers=4, queue_size=100)
+        self.pool.start()
+
+    def tearDown(self) -> None:
+        self.pool.close(timeout=5)
+
+    def test_same_key_runs_in_order_on_same_worker(self):
+        handled = []
+        for delta in range(50):
+            self.pool.submit('f51b3db90173408480d5f6c16a5652d0', lambda d: handled.append((d, current_thread().name)),
+                             delta)
+        self.pool.close(timeout=5)
+
+        self.assertEqual(list(range(50)), [delta for delta, _ in handled])
+        self.assertEqual(1, len({thread for _, thread in handled}))
+
+    def test_different_keys_run_in_parallel(self):
+        release = Event()
+        self.pool.submit('f51b3db90173408480d5f6c16a5652d0', release.wait, 5)
+        other_keys = [f'user-{index}' for index in range(20)]
+        done = []
+        for key in other_keys:
+            self.pool.submit(key, done.append, key)
+
+        # Keys sharded away from the blocked worker are handled while it waits
+        for _ in range(500):
+            if done:
+                break
+            release.wait(0.01)
+        self.assertTrue(done)
+        release.set()
+
+    def test_failed_task_does_not_stop_worker(self):
+        def fail():
+            raise ValueError()
+        handled = []
+        self.pool.submit('f51b3db90173408480d5f6c16a5652d0', fail)
+        self.pool.submit('f51b3db90173408480d5f6c16a5652d0', handled.append, 1)
+        self.pool.close(timeout=5)
+
+        self.assertEqual([1], handled)
+        stats = self.pool.stats()
+        self.assertEqual(2, stats['processed'])
+        self.assertEqual(1, stats['failed'])
+        self.assertEqual(4, len(stats['queue_depth']))
+        self.assertEqual(4, len(stats['utilisation']))
+
+
+if __name__ == '__main__':
+    unittest.main()